@@ -0,0 +1,113 @@
+"""
+Benchmark AdMob SSV signature verification throughput.
+
+Compares the original per-callback VerifyingKey.from_pem with the cached key
+path, run inline and through AdVerifier's process pool.
+
+Usage:
+    python -m bench.ssvBenchmark [--callbacks 500] [--workers 2] [--concurrency 64]
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import os
+import time
+
+from ecdsa import NIST256p, SigningKey
+from ecdsa.keys import VerifyingKey
+from ecdsa.util import sigdecode_der, sigencode_der
+
+from repo.adLogMemory import AdLogMemoryRepo
+from util.adVerifier import SIGNATURE_BACKENDS, AdVerifier
+
+KEY_ID = "1234567890"
+
+
+class BenchAdVerifier(AdVerifier):
+    """
+    AdVerifier with a locally generated key instead of the gstatic key list
+    """
+
+    def __init__(self, pem: str, **kwargs):
+        super().__init__(AdLogMemoryRepo(), key_snapshot_path=os.devnull, **kwargs)
+        self.set_admob_key([dict(keyId=KEY_ID, pem=pem, base64="")])
+
+
+def make_callbacks(count: int):
+    sk = SigningKey.generate(curve=NIST256p, hashfunc=hashlib.sha256)
+    pem = sk.get_verifying_key().to_pem().decode("utf-8")
+
+    callbacks = []
+    for i in range(count):
+        message = f"ad_network=5450213213286189855&ad_unit=1234567890&reward_amount=10&reward_item=point&timestamp={1700000000000 + i}&transaction_id={i:032x}&user_id=user{i}"
+        signature = sk.sign(message.encode("utf-8"), sigencode=sigencode_der)
+        callbacks.append((message, base64.urlsafe_b64encode(
+            signature).decode("utf-8").rstrip("=")))
+    return pem, callbacks
+
+
+def report(name: str, count: int, elapsed: float):
+    print(f"{name:<40} {count / elapsed:10.1f} callbacks/sec")
+
+
+def bench_baseline(pem: str, callbacks: list):
+    """
+    Original implementation: parse the PEM on every callback
+    """
+    start = time.perf_counter()
+    for message, signature in callbacks:
+        vk = VerifyingKey.from_pem(pem)
+        raw = base64.urlsafe_b64decode(signature + '=' * (-len(signature) % 4))
+        vk.verify(raw, message.encode("utf-8"),
+                  hashfunc=hashlib.sha256, sigdecode=sigdecode_der)
+    report("baseline (from_pem per call, inline)",
+           len(callbacks), time.perf_counter() - start)
+
+
+def bench_inline(pem: str, callbacks: list, backend: str):
+    verifier = BenchAdVerifier(pem, verify_workers=0, backend=backend)
+    start = time.perf_counter()
+    for message, signature in callbacks:
+        assert verifier.verify_admob_ssv(message, KEY_ID, signature)
+    report(f"cached key, inline ({backend})",
+           len(callbacks), time.perf_counter() - start)
+
+
+async def bench_pool(pem: str, callbacks: list, backend: str, workers: int, concurrency: int):
+    verifier = BenchAdVerifier(pem, verify_workers=workers, backend=backend)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def verify(message, signature):
+        async with semaphore:
+            assert await verifier.verify_admob_ssv_async(message, KEY_ID, signature)
+
+    # Warm up the pool so process start-up is not measured
+    await verify(*callbacks[0])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(verify(message, signature) for message, signature in callbacks))
+    elapsed = time.perf_counter() - start
+    verifier.close()
+    label = f"process pool x{workers}" if workers else "thread pool"
+    report(f"cached key, {label} ({backend})", len(callbacks), elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callbacks", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    pem, callbacks = make_callbacks(args.callbacks)
+
+    bench_baseline(pem, callbacks)
+    for backend in SIGNATURE_BACKENDS:
+        bench_inline(pem, callbacks, backend)
+        asyncio.run(bench_pool(pem, callbacks, backend,
+                    args.workers, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 from enum import IntEnum
-from typing import Optional
+from typing import Any, Optional
 
 from pydantic import BaseModel, Field
 
@@ -45,12 +45,30 @@ class ChallengeItemMeta(BaseModel):
 
 class ChallengeRecordItem(BaseModel):
     id: str
+    challengeId: str = ''
     userId: str
     imageId: str
     date: str
     approved: bool = False
 
 
+class DonationParticipationItem(BaseModel):
+    id: str = ''
+    donationId: str
+    userId: str
+    points: int = Field(..., ge=0)
+    timestamp: int
+
+
+class DonorTotalItem(BaseModel):
+    donationId: str
+    userId: str
+    points: int
+    count: int
+    lastDonatedAt: int
+    user: Optional[UserItemMeta] = None
+
+
 class RewardItemMeta(BaseModel):
     id: str
     itemName: str
@@ -66,6 +84,21 @@ class UserItem(UserItemMeta):
     point: int = Field(..., ge=0)
     couponList: list[CouponItemMeta] = []
     thumbnailId: str = ''
+    version: int = 0
+
+
+class LeaderboardEntry(UserItemMeta):
+    rank: int
+    point: int
+
+
+class PointLedgerItem(BaseModel):
+    id: str = ''
+    userId: str
+    amount: int
+    reason: str
+    refId: Optional[str] = None
+    timestamp: int
 
 
 class DonationItem(DonationItemMeta, use_enum_values=True):
@@ -86,6 +119,14 @@ class CouponItem(CouponItemMeta):
     thumbnailId: Optional[str] = None
     couponId: str
     expiredAt: str
+    expiresAt: Optional[int] = None
+    ownerId: str = ''
+    state: ItemState = ItemState.ACTIVE
+
+
+class CouponPage(BaseModel):
+    items: list[CouponItem] = []
+    nextCursor: Optional[str] = None
 
 
 class ChallengeItem(ChallengeItemMeta):
@@ -93,11 +134,17 @@ class ChallengeItem(ChallengeItemMeta):
     name: str
     totalParticipants: int = Field(..., ge=0)
     currentParticipants: int
+    participantIds: list[str] = []
     participants: list[UserItemMeta] = []
-    participantRecords: list[ChallengeRecordItem] = []
     dateEnd: str
+    dateEndAt: Optional[int] = None
     description: str
     state: ItemState = ItemState.UNDEFINED
+    settled: bool = False
+    recordCount: int = 0
+    approvedRecordCount: int = 0
+    userRecordCounts: dict[str, int] = {}
+    version: int = 0
 
 
 class RewardItem(RewardItemMeta):
@@ -110,13 +157,59 @@ class RewardItem(RewardItemMeta):
     thumbnailId: str
     price: int = Field(..., ge=0)
     provider: str
+    stock: int = 0
+
+
+class CouponUnitItem(BaseModel):
+    id: str
+    rewardId: str
+    couponId: str
+
+
+class AdLogItem(BaseModel):
+    userId: str
+    rewardAmount: int
+    timestamp: int
+
+
+class IdempotencyRecord(BaseModel):
+    key: str
+    fingerprint: str = ''
+    done: bool = False
+    statusCode: int = 0
+    body: Optional[str] = None
+
+
+class BatchRequestItem(BaseModel):
+    id: Optional[str] = None
+    path: str
+
+
+class BatchRequest(BaseModel):
+    requests: list[BatchRequestItem]
 
 
-class FileData(BaseModel):
+class BatchResponseItem(BaseModel):
+    id: Optional[str] = None
+    status: int
+    contentType: Optional[str] = None
+    body: Any = None
+    encoding: Optional[str] = None
+
+
+class FileDataMeta(BaseModel):
     id: str
     owner: str
     name: str
     size: int
     contentType: str
-    file: bytes
     isPrivate: bool = False
+
+
+class FileBatchItem(FileDataMeta):
+    # Base64 encoded content, only for files small enough to inline
+    data: Optional[str] = None
+
+
+class FileData(FileDataMeta):
+    file: bytes
@@ -27,28 +27,43 @@ class UserRepository(ABC):
         pass
 
     @abstractmethod
-    def getUser(self, userId: str) -> UserItem:
+    def getUser(self, userId: str, fields: frozenset[str] = None) -> UserItem:
         """
         Get a user by id
 
         Args:
             userId (str): User id
+            fields (frozenset[str]): Only load these fields if given
 
         Returns:
-            UserItem: UserItem object
+            UserItem: UserItem object, trimmed to fields if given
+        """
+        pass
+
+    @abstractmethod
+    def getUsers(self, userIds: list[str]) -> list[UserItem]:
+        """
+        Get many users by id in one query
+
+        Args:
+            userIds (list[str]): User ids
+
+        Returns:
+            list[UserItem]: Found users, in no particular order
         """
         pass
 
     @abstractmethod
     def updateUser(self, userItem: UserItem) -> UserItem:
         """
-        Update a user
+        Update a user if it is still at userItem.version
 
         Args:
             userItem (UserItem): UserItem object
 
         Raises:
-            HTTPException(status_code=500): If failed to update
+            HTTPException(status_code=404): If the user is not found
+            VersionConflictError: If the user was modified since it was read
 
         Returns:
             UserItem: UserItem object
@@ -68,6 +83,110 @@ class UserRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def addSettlementPoints(self, settlementId: str, points: dict[str, int]) -> int:
+        """
+        Add points to many users at once, at most once per settlement
+
+        Args:
+            settlementId (str): Id of the settlement, users already paid by it are skipped
+            points (dict[str, int]): Points to add by user id
+
+        Returns:
+            int: Number of users paid
+        """
+        pass
+
+    @abstractmethod
+    def addPoints(self, userId: str, amount: int, reason: str, refId: str = None) -> int:
+        """
+        Credit points to a user
+
+        Args:
+            userId (str): User id
+            amount (int): Points to add
+            reason (str): Why the points are added, e.g. "adReward"
+            refId (str): Id of the related item if any
+
+        Returns:
+            int: Balance of the user after the credit
+        """
+        pass
+
+    @abstractmethod
+    def spendPoints(self, userId: str, amount: int, reason: str, refId: str = None) -> bool:
+        """
+        Debit points from a user if the balance allows it
+
+        Args:
+            userId (str): User id
+            amount (int): Points to spend
+            reason (str): Why the points are spent, e.g. "rewardPurchase"
+            refId (str): Id of the related item if any
+
+        Returns:
+            bool: True if the points were spent, False if the balance is too low
+        """
+        pass
+
+    @abstractmethod
+    def getPointHistory(self, userId: str, offset: int = 0, limit: int = 20) -> list[PointLedgerItem]:
+        """
+        Get a page of the point credits and debits of a user, newest first
+
+        Args:
+            userId (str): User id
+            offset (int): Number of entries to skip
+            limit (int): Maximum number of entries
+
+        Returns:
+            list[PointLedgerItem]: Ledger entries
+        """
+        pass
+
+    @abstractmethod
+    def compactPointLedger(self) -> int:
+        """
+        Fold settled ledger entries into the balance snapshots of the users
+
+        Returns:
+            int: Number of users whose snapshot was updated
+        """
+        pass
+
+    @abstractmethod
+    def getLeaderboard(self, limit: int) -> list[LeaderboardEntry]:
+        """
+        Get the users with the most points
+
+        Args:
+            limit (int): Maximum number of entries
+
+        Returns:
+            list[LeaderboardEntry]: Entries ordered by rank
+        """
+        pass
+
+    @abstractmethod
+    def getUserRank(self, userId: str) -> LeaderboardEntry:
+        """
+        Get the rank of a user
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            LeaderboardEntry: Entry of the user, None if the user is not found
+        """
+        pass
+
+    @abstractmethod
+    def reloadLeaderboard(self):
+        """
+        Rebuild the leaderboard from storage, picking up writes made elsewhere
+        """
+        pass
+
 
 class DonationRepository(ABC):
     """
@@ -142,6 +261,69 @@ class DonationRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def addDonationPoints(self, donationId: str, points: int):
+        """
+        Add points to the total of a donation without rewriting the donation
+
+        Args:
+            donationId (str): The ID of the donation item
+            points (int): Points to add
+        """
+        pass
+
+    @abstractmethod
+    def materializeDonationTotals(self) -> int:
+        """
+        Write the current totals onto the donation items, for listings
+
+        Returns:
+            int: Number of donation items whose total changed
+        """
+        pass
+
+    @abstractmethod
+    def addParticipation(self, participationItem: DonationParticipationItem) -> DonationParticipationItem:
+        """
+        Record a participation and add it to the totals of the donor
+
+        Args:
+            participationItem (DonationParticipationItem): The participation to record
+
+        Returns:
+            DonationParticipationItem: The recorded participation
+        """
+        pass
+
+    @abstractmethod
+    def getTopDonors(self, donationId: str, limit: int) -> list[DonorTotalItem]:
+        """
+        Get the donors who gave the most points to a donation
+
+        Args:
+            donationId (str): The ID of the donation item
+            limit (int): Maximum number of donors
+
+        Returns:
+            list[DonorTotalItem]: Totals of the donors, most points first
+        """
+        pass
+
+    @abstractmethod
+    def getDonorTotals(self, userId: str, offset: int = 0, limit: int = 20) -> list[DonorTotalItem]:
+        """
+        Get a page of the totals of a user per donation
+
+        Args:
+            userId (str): User id
+            offset (int): Number of totals to skip
+            limit (int): Maximum number of totals
+
+        Returns:
+            list[DonorTotalItem]: Totals of the user, most recently donated first
+        """
+        pass
+
 
 class CouponRepository(ABC):
     """
@@ -206,6 +388,35 @@ class CouponRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def listForUser(self, userId: str, activeOnly: bool = True, cursor: str = None, limit: int = 20) -> CouponPage:
+        """
+        Get a page of the coupons of a user, newest first
+
+        Args:
+            userId (str): Owner id
+            activeOnly (bool): Skip expired coupons
+            cursor (str): nextCursor of the previous page, None for the first page
+            limit (int): Maximum number of coupons
+
+        Returns:
+            CouponPage: Coupons and the cursor of the next page, None if there is none
+        """
+        pass
+
+    @abstractmethod
+    def expireCoupons(self, now: int) -> int:
+        """
+        Mark active coupons past their expiry as expired
+
+        Args:
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            int: Number of expired coupons
+        """
+        pass
+
 
 class ChallengeRepository(ABC):
     """
@@ -239,28 +450,30 @@ class ChallengeRepository(ABC):
         pass
 
     @abstractmethod
-    def getChallenge(self, challengeId: str) -> ChallengeItem:
+    def getChallenge(self, challengeId: str, fields: frozenset[str] = None) -> ChallengeItem:
         """
         Get a challenge by id
 
         Args:
             challengeId (str): Challenge id
+            fields (frozenset[str]): Only load these fields if given
 
         Returns:
-            ChallengeItem: ChallengeItem object if found, None otherwise
+            ChallengeItem: ChallengeItem object trimmed to fields if given, None if not found
         """
         pass
 
     @abstractmethod
     def updateChallenge(self, challengeItem: ChallengeItem) -> ChallengeItem:
         """
-        Update a challenge
+        Update a challenge if it is still at challengeItem.version
 
         Args:
             challengeItem (ChallengeItem): ChallengeItem object
 
         Raises:
-            HTTPException(status_code=500): If failed to update challenge
+            HTTPException(status_code=404): If the challenge is not found
+            VersionConflictError: If the challenge was modified since it was read
 
         Returns:
             ChallengeItem: Updated ChallengeItem object
@@ -280,6 +493,208 @@ class ChallengeRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def expireChallenges(self, now: int) -> int:
+        """
+        Finish every pending or active challenge whose end time has passed
+
+        Args:
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            int: Number of finished challenges
+        """
+        pass
+
+    @abstractmethod
+    def finishChallenge(self, challengeId: str, now: int) -> bool:
+        """
+        Finish a pending or active challenge if its end time has passed
+
+        Args:
+            challengeId (str): Challenge id
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            bool: True if the challenge was finished, False otherwise
+        """
+        pass
+
+    @abstractmethod
+    def addParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Add a user to the participants of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if added, False if the user already participates
+        """
+        pass
+
+    @abstractmethod
+    def removeParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Remove a user from the participants of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if removed, False if the user did not participate
+        """
+        pass
+
+    @abstractmethod
+    def isParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Check whether a user participates in a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if the user participates, False otherwise
+        """
+        pass
+
+    @abstractmethod
+    def getParticipantIds(self, challengeId: str) -> list[str]:
+        """
+        Get the ids of the participants of a challenge, in joining order
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            list[str]: List of user ids
+        """
+        pass
+
+    @abstractmethod
+    def getChallengesForUser(self, userId: str) -> list[ChallengeItemMeta]:
+        """
+        Get the challenges a user participates in, most recently joined first
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            list[ChallengeItemMeta]: List of ChallengeItemMeta objects
+        """
+        pass
+
+    @abstractmethod
+    def addRecord(self, recordItem: ChallengeRecordItem) -> ChallengeRecordItem:
+        """
+        Add a record to a challenge
+
+        Args:
+            recordItem (ChallengeRecordItem): Record with challengeId set
+
+        Raises:
+            HTTPException(status_code=500): If failed to add record
+
+        Returns:
+            ChallengeRecordItem: Added record
+        """
+        pass
+
+    @abstractmethod
+    def getRecords(self, challengeId: str, userId: str = None, offset: int = 0, limit: int = 20) -> list[ChallengeRecordItem]:
+        """
+        Get a page of the records of a challenge, oldest first
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): Only records of this user if given
+            offset (int): Number of records to skip
+            limit (int): Maximum number of records
+
+        Returns:
+            list[ChallengeRecordItem]: List of records
+        """
+        pass
+
+    @abstractmethod
+    def setRecordApproval(self, challengeId: str, recordId: str, approved: bool) -> ChallengeRecordItem:
+        """
+        Approve or disapprove a record
+
+        Args:
+            challengeId (str): Challenge id
+            recordId (str): Record id
+            approved (bool): Approval state
+
+        Returns:
+            ChallengeRecordItem: Updated record if found, None otherwise
+        """
+        pass
+
+    @abstractmethod
+    def countRecords(self, challengeId: str, userId: str = None) -> int:
+        """
+        Count the records of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): Only records of this user if given
+
+        Returns:
+            int: Number of records
+        """
+        pass
+
+    @abstractmethod
+    def countRecordsByUser(self, challengeId: str) -> dict[str, int]:
+        """
+        Count the records of a challenge per user
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            dict[str, int]: Number of records by user id
+        """
+        pass
+
+    @abstractmethod
+    def getUnsettledChallenges(self) -> list[str]:
+        """
+        Get finished challenges whose rewards have not been settled
+
+        Returns:
+            list[str]: List of challenge ids
+        """
+        pass
+
+    @abstractmethod
+    def markChallengeSettled(self, challengeId: str) -> bool:
+        """
+        Mark a finished challenge as settled
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            bool: True if the challenge was marked, False if not finished or already settled
+        """
+        pass
+
+    @abstractmethod
+    def getChallengeDeadlines(self) -> list[tuple[str, int]]:
+        """
+        Get the end time of every pending or active challenge
+
+        Returns:
+            list[tuple[str, int]]: List of (challenge id, dateEndAt) pairs
+        """
+        pass
+
 
 class RewardRepository(ABC):
     """
@@ -354,6 +769,91 @@ class RewardRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def addInventory(self, rewardId: str, couponIds: list[str]) -> int:
+        """
+        Add coupon units to the inventory of a reward
+
+        Args:
+            rewardId (str): Reward ID
+            couponIds (list[str]): Coupon IDs, each handed out at most once
+
+        Returns:
+            int: Number of units added, coupons already in the inventory are skipped
+        """
+        pass
+
+    @abstractmethod
+    def claimUnit(self, rewardId: str, userId: str) -> CouponUnitItem:
+        """
+        Atomically claim an available coupon unit of a reward
+
+        Args:
+            rewardId (str): Reward ID
+            userId (str): User claiming the unit
+
+        Returns:
+            CouponUnitItem: Claimed unit, or None if out of stock
+        """
+        pass
+
+    @abstractmethod
+    def reserveUnit(self, rewardId: str, owner: str, ttl: int) -> CouponUnitItem:
+        """
+        Reserve an available coupon unit for a process, to be claimed later
+
+        Args:
+            rewardId (str): Reward ID
+            owner (str): Unique id of the reserving process
+            ttl (int): Seconds until the reservation lapses and the unit is available again
+
+        Returns:
+            CouponUnitItem: Reserved unit, or None if out of stock
+        """
+        pass
+
+    @abstractmethod
+    def claimReservedUnit(self, unit: CouponUnitItem, owner: str, userId: str) -> bool:
+        """
+        Claim a unit reserved by owner
+
+        Args:
+            unit (CouponUnitItem): Reserved unit
+            owner (str): Unique id of the reserving process
+            userId (str): User claiming the unit
+
+        Returns:
+            bool: True if claimed, False if the reservation lapsed or the unit is gone
+        """
+        pass
+
+    @abstractmethod
+    def releaseUnit(self, unit: CouponUnitItem, userId: str) -> bool:
+        """
+        Return a unit claimed by a user to the inventory, e.g. when the purchase failed
+
+        Args:
+            unit (CouponUnitItem): Claimed unit
+            userId (str): User who claimed the unit
+
+        Returns:
+            bool: True if released, False if the unit is not claimed by the user
+        """
+        pass
+
+    @abstractmethod
+    def releaseReservations(self, owner: str) -> int:
+        """
+        Make every unit reserved by owner available again
+
+        Args:
+            owner (str): Unique id of the reserving process
+
+        Returns:
+            int: Number of released units
+        """
+        pass
+
 
 class FileRepository(ABC):
     """
@@ -390,6 +890,20 @@ class FileRepository(ABC):
         """
         pass
 
+    @abstractmethod
+    def getFiles(self, fileIds: list[str], inlineSize: int = 0) -> list[FileBatchItem]:
+        """
+        Get many files by ID in one query
+
+        Args:
+            fileIds (list[str]): IDs of the files
+            inlineSize (int): Include the content of files up to this many bytes
+
+        Returns:
+            list[FileBatchItem]: Found files, in no particular order
+        """
+        pass
+
     @abstractmethod
     def updateFile(self, file: UploadFile, fileData: FileData) -> FileData:
         """
@@ -419,3 +933,157 @@ class FileRepository(ABC):
             bool: True if file is deleted, False otherwise
         """
         pass
+
+
+class AdLogRepository(ABC):
+    """
+    Repository interface for verified ad reward logs
+    """
+
+    # Seconds a verified ad log stays consumable
+    LOG_EXPIRY = 60 * 5
+
+    @abstractmethod
+    def addLog(self, adLogItem: AdLogItem) -> AdLogItem:
+        """
+        Add a verified ad log
+
+        Args:
+            adLogItem (AdLogItem): Ad log to add
+
+        Raises:
+            HTTPException(status_code=500): If failed to add log
+
+        Returns:
+            AdLogItem: Added ad log
+        """
+        pass
+
+    @abstractmethod
+    def consumeLog(self, userId: str) -> AdLogItem:
+        """
+        Atomically take the oldest unexpired ad log of a user
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            AdLogItem: Consumed ad log if found, None otherwise
+        """
+        pass
+
+    @abstractmethod
+    def removeOldLogs(self) -> int:
+        """
+        Remove expired ad logs
+
+        Returns:
+            int: Number of removed logs
+        """
+        pass
+
+
+class LeaseRepository(ABC):
+    """
+    Repository interface for named leases used to elect a single leader between processes
+    """
+
+    @abstractmethod
+    def acquireLease(self, name: str, owner: str, ttl: int) -> bool:
+        """
+        Acquire a lease, or extend it if already held by owner
+
+        Args:
+            name (str): Lease name
+            owner (str): Unique id of the requesting process
+            ttl (int): Seconds until the lease expires unless renewed
+
+        Returns:
+            bool: True if owner holds the lease, False otherwise
+        """
+        pass
+
+    @abstractmethod
+    def releaseLease(self, name: str, owner: str) -> bool:
+        """
+        Release a lease held by owner
+
+        Args:
+            name (str): Lease name
+            owner (str): Unique id of the releasing process
+
+        Returns:
+            bool: True if the lease was released, False otherwise
+        """
+        pass
+
+
+class IdempotencyRepository(ABC):
+    """
+    Repository interface for responses stored by Idempotency-Key
+    """
+
+    @abstractmethod
+    def reserveKey(self, key: str, fingerprint: str, ttl: int) -> IdempotencyRecord:
+        """
+        Reserve a key for the request about to run
+
+        Args:
+            key (str): Scoped idempotency key
+            fingerprint (str): Hash of the request, to detect a key reused for another request
+            ttl (int): Seconds until an unfinished reservation lapses
+
+        Returns:
+            IdempotencyRecord: None if the key was reserved, the existing record otherwise
+        """
+        pass
+
+    @abstractmethod
+    def extendKey(self, key: str, ttl: int) -> bool:
+        """
+        Keep an unfinished reservation from lapsing while its request runs
+
+        Args:
+            key (str): Scoped idempotency key
+            ttl (int): Seconds from now until the reservation lapses
+
+        Returns:
+            bool: True if extended, False if the reservation is gone or finished
+        """
+        pass
+
+    @abstractmethod
+    def completeKey(self, key: str, statusCode: int, body: str, ttl: int):
+        """
+        Store the response of a reserved key
+
+        Args:
+            key (str): Scoped idempotency key
+            statusCode (int): Response status code
+            body (str): JSON encoded response body
+            ttl (int): Seconds the response is replayed for
+        """
+        pass
+
+    @abstractmethod
+    def releaseKey(self, key: str):
+        """
+        Drop a reservation so the request can be retried
+
+        Args:
+            key (str): Scoped idempotency key
+        """
+        pass
+
+    @abstractmethod
+    def getKey(self, key: str) -> IdempotencyRecord:
+        """
+        Get the record of a key
+
+        Args:
+            key (str): Scoped idempotency key
+
+        Returns:
+            IdempotencyRecord: The record if found and not expired, None otherwise
+        """
+        pass
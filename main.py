@@ -1,4 +1,5 @@
 # Import libraries and modules
+import asyncio
 import os
 import logging
 from typing import *
@@ -11,24 +12,40 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 
-from core.repo import (ChallengeRepository, CouponRepository,
-                       DonationRepository, FileRepository, RewardRepository,
-                       UserRepository)
+from core.repo import (AdLogRepository, ChallengeRepository,
+                       CouponRepository, DonationRepository, FileRepository,
+                       IdempotencyRepository, LeaseRepository,
+                       RewardRepository, UserRepository)
+from repo.adLogMemory import AdLogMemoryRepo
+from repo.adLogMongo import AdLogMongoRepo
 from repo.challengeMongo import ChallengeMongoRepo
 from repo.couponMongo import CouponMongoRepo
 from repo.donationMongo import DonationMongoRepo
 from repo.fileMongo import FileMongoRepo
+from repo.idempotencyMemory import IdempotencyMemoryRepo
+from repo.idempotencyMongo import IdempotencyMongoRepo
+from repo.leaseMongo import LeaseMongoRepo
 from repo.rewardMongo import RewardMongoRepo
 from repo.userMongo import UserMongoRepo
 from router.adRouter import AdRouter
+from router.batchRouter import BatchRouter
 from router.challengeRouter import ChallengeRouter
 from router.donationRouter import DonationRouter
 from router.fileRouter import FileRouter
+from router.metricsRouter import MetricsRouter
 from router.tempRewardRouter import RewardRouter
 from router.userRouter import UserRouter
 from util.adVerifier import AdVerifier
 from util.authParser import AuthParser
-from util.schedule import check_ad_log, check_challenge_expiry
+from util.couponPrefetcher import CouponPrefetcher
+from util.deadlineScheduler import ChallengeDeadlineScheduler
+from util.idempotency import IdempotencyGuard
+from util.leaderJobs import LeaderJobRunner
+from util.optimistic import OptimisticRetry
+from util.schedule import check_ad_log, check_challenge_expiry, check_coupon_expiry
+from util.settlement import ChallengeSettlement
+from util.singleFlight import SingleFlight
+from util.ssvQueue import SSVQueue
 
 # Load environment variables
 load_dotenv(verbose=True, dotenv_path=".env.development", override=True)
@@ -41,33 +58,113 @@ MONGO_DB = os.getenv("MONGO_DB")
 
 ADMIN_ID = os.getenv("ADMIN_ID").split(",")
 
+# "memory" keeps ad logs per process, "mongo" shares them between workers
+AD_LOG_STORE = os.getenv("AD_LOG_STORE", "memory")
+SSV_VERIFY_WORKERS = int(os.getenv("SSV_VERIFY_WORKERS", "2"))
+SSV_VERIFY_BACKEND = os.getenv("SSV_VERIFY_BACKEND", "auto")
+ADMOB_KEY_SNAPSHOT = os.getenv("ADMOB_KEY_SNAPSHOT", ".admob_keys.json")
+ADMOB_KEY_REFRESH_INTERVAL = int(os.getenv("ADMOB_KEY_REFRESH_INTERVAL", str(60 * 60)))
+# "sync" verifies SSV callbacks before answering, "queue" acknowledges them and verifies in the background
+SSV_INGEST_MODE = os.getenv("SSV_INGEST_MODE", "sync")
+SSV_QUEUE_SIZE = int(os.getenv("SSV_QUEUE_SIZE", "10000"))
+SSV_QUEUE_WORKERS = int(os.getenv("SSV_QUEUE_WORKERS", "4"))
+JOB_LEASE_TTL = int(os.getenv("JOB_LEASE_TTL", "60"))
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "100"))
+DONATION_COUNTER_SHARDS = int(os.getenv("DONATION_COUNTER_SHARDS", "16"))
+# Coupon units reserved ahead per reward and process, 0 claims from the inventory on every purchase
+COUPON_PREFETCH_SIZE = int(os.getenv("COUPON_PREFETCH_SIZE", "5"))
+# "memory" keeps idempotency keys per process, "mongo" shares them between workers
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "mongo")
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(60 * 60 * 24)))
+# How long finished reads are shared with identical requests arriving late, 0 only shares in-flight reads
+SINGLE_FLIGHT_WINDOW_US = int(os.getenv("SINGLE_FLIGHT_WINDOW_US", "500"))
+
 ########## MongoDB Connection ##########
 client = pymongo.MongoClient(host=MONGO_HOST, port=int(
     MONGO_PORT), username=MONGO_USER, password=MONGO_PASSWORD)
 db = client[MONGO_DB]
 
 ########## Dependency Injection ##########
-user_repo: UserRepository = UserMongoRepo(db)
+user_repo: UserRepository = UserMongoRepo(db, leaderboardSize=LEADERBOARD_SIZE)
 file_repo: FileRepository = FileMongoRepo(db)
 reward_repo: RewardRepository = RewardMongoRepo(db)
 coupon_repo: CouponRepository = CouponMongoRepo(db)
-donation_repo: DonationRepository = DonationMongoRepo(db)
-challenge_repo: ChallengeRepository = ChallengeMongoRepo(db)
-
-ad_verifier: AdVerifier = AdVerifier()
-
-user_router = UserRouter(user_repo, ad_verifier)
+donation_repo: DonationRepository = DonationMongoRepo(db, counterShards=DONATION_COUNTER_SHARDS)
+single_flight = SingleFlight(window=SINGLE_FLIGHT_WINDOW_US / 1_000_000)
+challenge_repo: ChallengeRepository = ChallengeMongoRepo(db, singleFlight=single_flight)
+lease_repo: LeaseRepository = LeaseMongoRepo(db)
+
+if AD_LOG_STORE == "mongo":
+    ad_log_repo: AdLogRepository = AdLogMongoRepo(db)
+else:
+    ad_log_repo: AdLogRepository = AdLogMemoryRepo()
+
+if IDEMPOTENCY_STORE == "memory":
+    idempotency_repo: IdempotencyRepository = IdempotencyMemoryRepo()
+else:
+    idempotency_repo: IdempotencyRepository = IdempotencyMongoRepo(db)
+idempotency_guard = IdempotencyGuard(idempotency_repo, ttl=IDEMPOTENCY_TTL)
+
+ad_verifier: AdVerifier = AdVerifier(
+    ad_log_repo, verify_workers=SSV_VERIFY_WORKERS, backend=SSV_VERIFY_BACKEND,
+    key_snapshot_path=ADMOB_KEY_SNAPSHOT)
+
+ssv_queue: SSVQueue = None
+if SSV_INGEST_MODE == "queue":
+    ssv_queue = SSVQueue(user_repo, ad_verifier,
+                         maxsize=SSV_QUEUE_SIZE, workers=SSV_QUEUE_WORKERS)
+
+optimistic_retry = OptimisticRetry()
+user_router = UserRouter(user_repo, ad_verifier, coupon_repo, optimistic_retry)
 file_router = FileRouter(user_repo, file_repo)
-reward_router = RewardRouter(user_repo, reward_repo, coupon_repo, file_repo, ADMIN_ID)
-donation_router = DonationRouter(user_repo, donation_repo, ad_verifier, ADMIN_ID)
-challenge_router = ChallengeRouter(user_repo, challenge_repo, file_repo)
-ad_router = AdRouter(user_repo, ad_verifier)
+coupon_prefetcher = CouponPrefetcher(reward_repo, bufferSize=COUPON_PREFETCH_SIZE)
+reward_router = RewardRouter(user_repo, reward_repo, coupon_repo, file_repo, ADMIN_ID, coupon_prefetcher,
+                             idempotency_guard)
+donation_router = DonationRouter(user_repo, donation_repo, ad_verifier, ADMIN_ID, idempotency_guard)
+challenge_settlement = ChallengeSettlement(user_repo, challenge_repo)
+challenge_deadline_scheduler = ChallengeDeadlineScheduler(challenge_repo)
+challenge_deadline_scheduler.addListener(challenge_settlement.settleChallenge)
+challenge_router = ChallengeRouter(
+    user_repo, challenge_repo, file_repo, challenge_settlement, challenge_deadline_scheduler,
+    idempotency_guard, optimistic_retry, single_flight)
+ad_router = AdRouter(user_repo, ad_verifier, ssv_queue)
+metrics_router = MetricsRouter(ADMIN_ID)
+batch_router = BatchRouter()
+metrics_router.register("couponPrefetch", coupon_prefetcher.metrics)
+metrics_router.register("idempotency", idempotency_guard.metrics)
+metrics_router.register("versionConflicts", optimistic_retry.metrics)
+metrics_router.register("singleFlight", single_flight.metrics)
+
+if ssv_queue is not None:
+    metrics_router.register("ssvQueue", ssv_queue.metrics)
 
 ########## Scheduler ##########
 scheduler = BackgroundScheduler()
-
+leader_jobs = LeaderJobRunner(lease_repo, ttl=JOB_LEASE_TTL)
+metrics_router.register("jobs", leader_jobs.metrics)
+
+# Shared jobs run in one worker only
+scheduler.add_job(leader_jobs.wrap("challengeExpiry", lambda: check_challenge_expiry(challenge_repo, challenge_settlement)),
+                  CronTrigger(hour=0, minute=0, timezone="Asia/Seoul"))
+# Retry settlements that failed right after a deadline
+scheduler.add_job(leader_jobs.wrap("challengeSettlement", challenge_settlement.settlePending),
+                  IntervalTrigger(minutes=5))
+# Keep donation listings close to the counter totals
+scheduler.add_job(leader_jobs.wrap("donationTotals", donation_repo.materializeDonationTotals),
+                  IntervalTrigger(minutes=1))
+scheduler.add_job(leader_jobs.wrap("couponExpiry", lambda: check_coupon_expiry(coupon_repo)),
+                  IntervalTrigger(minutes=10))
+# Fold point ledger entries into the balance snapshots
+scheduler.add_job(leader_jobs.wrap("pointCompaction", user_repo.compactPointLedger),
+                  IntervalTrigger(minutes=1))
+scheduler.add_job(leader_jobs.heartbeat, IntervalTrigger(seconds=max(1, JOB_LEASE_TTL // 3)))
+
+# Per-process jobs: in-memory ad logs and the deadline heap live in each worker
 scheduler.add_job(lambda: check_ad_log(ad_verifier), IntervalTrigger(minutes=1))
-scheduler.add_job(lambda: check_challenge_expiry(challenge_repo), CronTrigger(hour=0, minute=0, timezone="Asia/Seoul"))
+# Pick up challenges created or changed by other workers
+scheduler.add_job(challenge_deadline_scheduler.reload, IntervalTrigger(minutes=10))
+# Pick up points changed by other workers
+scheduler.add_job(user_repo.reloadLeaderboard, IntervalTrigger(minutes=1))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -75,12 +172,24 @@ logger = logging.getLogger(__name__)
 
 async def lifespan(app: FastAPI):
     scheduler.start()
+    challenge_deadline_scheduler.start()
     logger.info("Scheduler started")
+    key_refresh_task = asyncio.create_task(
+        ad_verifier.run_key_refresh(ADMOB_KEY_REFRESH_INTERVAL))
+    if ssv_queue is not None:
+        await ssv_queue.start()
 
     yield
 
     logger.info("Scheduler shutdown")
+    challenge_deadline_scheduler.stop()
+    if ssv_queue is not None:
+        await ssv_queue.stop()
+    key_refresh_task.cancel()
     scheduler.shutdown()
+    leader_jobs.releaseAll()
+    coupon_prefetcher.releaseAll()
+    ad_verifier.close()
 
 ########## FastAPI App ##########
 security = AuthParser()
@@ -114,5 +223,7 @@ app_router.include_router(reward_router, tags=["Reward"])
 app_router.include_router(donation_router, tags=["Donation"])
 app_router.include_router(challenge_router, tags=["Challenge"])
 app_router.include_router(ad_router, tags=["Ad"])
+app_router.include_router(metrics_router, tags=["Metrics"])
+app_router.include_router(batch_router, tags=["Batch"])
 
 app.include_router(app_router)
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from core.model import AdLogItem
+from core.repo import AdLogRepository
+
+
+class AdLogMemoryRepo(AdLogRepository):
+    """
+    Implementation of AdLogRepository in process memory
+
+    Logs are only visible to the worker that received the SSV callback,
+    so this is suitable for single worker deployments only.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # userId -> OrderedDict(seq -> AdLogItem), oldest log first
+        self._logs: dict[str, OrderedDict] = dict()
+        # (expireAt, userId, seq) in insertion order
+        self._expiryQueue: deque = deque()
+        self._seq = 0
+        # Accessed from the event loop and from the scheduler thread
+        self._lock = threading.Lock()
+
+    def _expireAt(self, adLogItem: AdLogItem) -> float:
+        return adLogItem.timestamp / 1000 + self.LOG_EXPIRY
+
+    def addLog(self, adLogItem: AdLogItem) -> AdLogItem:
+        """
+        Add a verified ad log
+
+        Args:
+            adLogItem (AdLogItem): Ad log to add
+
+        Returns:
+            AdLogItem: Added ad log
+        """
+        expireAt = self._expireAt(adLogItem)
+        with self._lock:
+            self._seq += 1
+            self._logs.setdefault(adLogItem.userId, OrderedDict())[
+                self._seq] = adLogItem
+            self._expiryQueue.append((expireAt, adLogItem.userId, self._seq))
+        return adLogItem
+
+    def consumeLog(self, userId: str) -> AdLogItem:
+        """
+        Take the oldest unexpired ad log of a user
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            AdLogItem: Consumed ad log if found, None otherwise
+        """
+        now = time.time()
+        with self._lock:
+            userLogs = self._logs.get(userId)
+            while userLogs:
+                _, log = userLogs.popitem(last=False)
+                if now < self._expireAt(log):
+                    if not userLogs:
+                        del self._logs[userId]
+                    return log
+            self._logs.pop(userId, None)
+        return None
+
+    def removeOldLogs(self) -> int:
+        """
+        Drop expired logs from the head of the expiry queue.
+        Consumed logs are skipped lazily, so each entry is visited once.
+
+        Returns:
+            int: Number of removed logs
+        """
+        now = time.time()
+        removed = 0
+        with self._lock:
+            while self._expiryQueue and self._expiryQueue[0][0] <= now:
+                _, userId, seq = self._expiryQueue.popleft()
+                userLogs = self._logs.get(userId)
+                if userLogs is None:
+                    continue
+                if userLogs.pop(seq, None) is not None:
+                    removed += 1
+                if not userLogs:
+                    del self._logs[userId]
+        return removed
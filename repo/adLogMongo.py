@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from pymongo import ASCENDING
+from pymongo.database import Database
+
+from core.model import AdLogItem
+from core.repo import AdLogRepository
+
+
+class AdLogMongoRepo(AdLogRepository):
+    """
+    Implementation of AdLogRepository using MongoDB
+
+    Logs are shared by every worker, expired by a TTL index and consumed
+    with find-and-delete so a log is rewarded at most once.
+    """
+
+    def __init__(self, db: Database):
+        super().__init__()
+        self._db = db
+
+        if self._db.get_collection("adLogs") is None:
+            self._db.create_collection("adLogs")
+        self._collection = self._db["adLogs"]
+        self._collection.create_index(
+            [("createdAt", ASCENDING)], expireAfterSeconds=self.LOG_EXPIRY)
+        self._collection.create_index(
+            [("userId", ASCENDING), ("createdAt", ASCENDING)])
+
+    def addLog(self, adLogItem: AdLogItem) -> AdLogItem:
+        """
+        Add a verified ad log
+
+        Args:
+            adLogItem (AdLogItem): Ad log to add
+
+        Raises:
+            HTTPException(status_code=500): If failed to add log
+
+        Returns:
+            AdLogItem: Added ad log
+        """
+        log = adLogItem.model_dump()
+        log["createdAt"] = datetime.fromtimestamp(
+            adLogItem.timestamp / 1000, tz=timezone.utc)
+        result = self._collection.insert_one(log)
+        if not result.acknowledged:
+            raise HTTPException(status_code=500, detail="Failed to add ad log")
+
+        return adLogItem
+
+    def consumeLog(self, userId: str) -> AdLogItem:
+        """
+        Atomically take the oldest unexpired ad log of a user
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            AdLogItem: Consumed ad log if found, None otherwise
+        """
+        # The TTL monitor runs about once a minute, so filter expired logs too
+        expiredBefore = datetime.now(timezone.utc) - \
+            timedelta(seconds=self.LOG_EXPIRY)
+        log = self._collection.find_one_and_delete(
+            {"userId": userId, "createdAt": {"$gt": expiredBefore}},
+            sort=[("createdAt", ASCENDING)])
+        if log:
+            return AdLogItem(**log)
+        else:
+            return None
+
+    def removeOldLogs(self) -> int:
+        """
+        Expired logs are removed by the TTL index
+
+        Returns:
+            int: Always 0
+        """
+        return 0
@@ -1,23 +1,175 @@
+import time
+
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
 from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
 
-from core.model import ChallengeItem, ChallengeItemMeta, ItemState, UserItemMeta
+from core.model import (ChallengeItem, ChallengeItemMeta, ChallengeRecordItem,
+                        ItemState)
 from core.repo import ChallengeRepository
+from util.fields import partialModel, projection
+from util.optimistic import VersionConflictError
+from util.singleFlight import SingleFlight
 
 
 class ChallengeMongoRepo(ChallengeRepository):
     """
     Implementation of ChallengeRepository using MongoDB
+
+    With a SingleFlight, concurrent reads of the same challenge share one query.
     """
 
-    def __init__(self, db: Database):
+    # States of challenges that have not ended yet
+    OPEN_STATES = [int(ItemState.PENDING), int(ItemState.ACTIVE)]
+    # Fields maintained atomically by the repository, never overwritten by updateChallenge
+    MAINTAINED_FIELDS = {"settled", "recordCount", "approvedRecordCount"}
+    # Fields resolved at read time, never stored in the challenge document
+    RESOLVED_FIELDS = {"participantIds", "participants", "userRecordCounts"}
+    PARTICIPANT_FIELDS = {"participantIds", "participants"}
+    # joinedAt values below this are list indexes left by an earlier migration, not timestamps
+    MIGRATED_JOINED_AT_LIMIT = 1_000_000
+
+    def __init__(self, db: Database, singleFlight: SingleFlight = None):
         super().__init__()
         self._db = db
+        self._singleFlight = singleFlight
 
         if self._db.get_collection("challenges") is None:
             self._db.create_collection("challenges")
         self._collection = self._db["challenges"]
+        self._migrateDateEnd()
+        self._collection.create_index(
+            [("state", ASCENDING), ("dateEndAt", ASCENDING)])
+        self._collection.update_many(
+            {"version": {"$exists": False}}, {"$set": {"version": 0}})
+
+        if self._db.get_collection("challengeRecords") is None:
+            self._db.create_collection("challengeRecords")
+        self._recordCollection = self._db["challengeRecords"]
+        self._recordCollection.create_index(
+            [("challengeId", ASCENDING), ("id", ASCENDING)], unique=True)
+        self._recordCollection.create_index(
+            [("challengeId", ASCENDING), ("userId", ASCENDING), ("date", ASCENDING)])
+        self._recordCollection.create_index(
+            [("challengeId", ASCENDING), ("date", ASCENDING)])
+        self._migrateRecords()
+
+        # Per-user record counters, kept out of the challenge document
+        if self._db.get_collection("challengeUserCounters") is None:
+            self._db.create_collection("challengeUserCounters")
+        self._userCounterCollection = self._db["challengeUserCounters"]
+        self._userCounterCollection.create_index(
+            [("challengeId", ASCENDING), ("userId", ASCENDING)], unique=True)
+        self._migrateRecordCounters()
+
+        if self._db.get_collection("challengeParticipants") is None:
+            self._db.create_collection("challengeParticipants")
+        self._participantCollection = self._db["challengeParticipants"]
+        self._participantCollection.create_index(
+            [("challengeId", ASCENDING), ("userId", ASCENDING)], unique=True)
+        self._participantCollection.create_index(
+            [("userId", ASCENDING), ("joinedAt", DESCENDING)])
+        self._migrateParticipants()
+
+    def _migrateDateEnd(self):
+        """
+        Fill the numeric dateEndAt field of challenges stored before it existed
+        """
+        self._collection.update_many({"dateEndAt": {"$exists": False}}, [
+            {"$set": {"dateEndAt": {"$convert": {
+                "input": {"$convert": {"input": "$dateEnd", "to": "double", "onError": None}},
+                "to": "long", "onError": None}}}}
+        ])
+
+    def _migrateRecords(self):
+        """
+        Move records embedded in challenge documents into the challengeRecords collection
+        """
+        for challenge in self._collection.find(
+                {"participantRecords": {"$exists": True}}, {"id": 1, "participantRecords": 1}):
+            records = [dict(record, challengeId=challenge["id"])
+                       for record in challenge["participantRecords"]]
+            for record in records:
+                self._recordCollection.update_one(
+                    {"challengeId": record["challengeId"], "id": record["id"]},
+                    {"$setOnInsert": record}, upsert=True)
+            self._collection.update_one(
+                {"_id": challenge["_id"]}, {"$unset": {"participantRecords": ""}})
+
+    @staticmethod
+    def _migratedJoinedAt(challenge: dict, index: int) -> float:
+        # Join times were not kept; order joins after the challenge's creation
+        return challenge["_id"].generation_time.timestamp() + index
+
+    def _migrateParticipants(self):
+        """
+        Move participants embedded in challenge documents into the participant index
+        """
+        for challenge in self._collection.find({"participants": {"$exists": True}}, {"id": 1, "participants": 1}):
+            for index, participant in enumerate(challenge.get("participants") or []):
+                self._participantCollection.update_one(
+                    {"challengeId": challenge["id"], "userId": participant["id"]},
+                    {"$setOnInsert": {"joinedAt": self._migratedJoinedAt(challenge, index)}}, upsert=True)
+            self._collection.update_one(
+                {"_id": challenge["_id"]}, {"$unset": {"participants": ""}})
+
+        # Earlier migrations stored the list index as joinedAt
+        for challengeId in self._participantCollection.distinct(
+                "challengeId", {"joinedAt": {"$lt": self.MIGRATED_JOINED_AT_LIMIT}}):
+            challenge = self._collection.find_one({"id": challengeId}, {"_id": 1})
+            if challenge is None:
+                continue
+            for participant in self._participantCollection.find(
+                    {"challengeId": challengeId, "joinedAt": {"$lt": self.MIGRATED_JOINED_AT_LIMIT}}):
+                self._participantCollection.update_one({"_id": participant["_id"]}, {"$set": {
+                    "joinedAt": self._migratedJoinedAt(challenge, int(participant["joinedAt"]))}})
+
+    def _migrateRecordCounters(self):
+        """
+        Compute record counters of challenges stored before they existed, and move
+        the per-user counts once kept in the challenge document to their own collection
+        """
+        for challenge in self._collection.find({"recordCount": {"$exists": False}}, {"id": 1}):
+            recordCount = self._recordCollection.count_documents(
+                {"challengeId": challenge["id"]})
+            approvedRecordCount = self._recordCollection.count_documents(
+                {"challengeId": challenge["id"], "approved": True})
+            self._collection.update_one({"_id": challenge["_id"]}, {"$set": {
+                "recordCount": recordCount,
+                "approvedRecordCount": approvedRecordCount,
+            }})
+
+        if self._userCounterCollection.count_documents({}, limit=1) == 0:
+            # Counted from the records; counters written meanwhile by another worker are kept
+            self._recordCollection.aggregate([
+                {"$group": {
+                    "_id": {"challengeId": "$challengeId", "userId": "$userId"},
+                    "recordCount": {"$sum": 1},
+                    "approvedRecordCount": {"$sum": {"$cond": ["$approved", 1, 0]}},
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "challengeId": "$_id.challengeId",
+                    "userId": "$_id.userId",
+                    "recordCount": 1,
+                    "approvedRecordCount": 1,
+                }},
+                {"$merge": {
+                    "into": "challengeUserCounters", "on": ["challengeId", "userId"],
+                    "whenMatched": "keepExisting", "whenNotMatched": "insert",
+                }},
+            ])
+        self._collection.update_many(
+            {"userRecordCounts": {"$exists": True}}, {"$unset": {"userRecordCounts": ""}})
+
+    @staticmethod
+    def _parseDateEnd(dateEnd: str) -> int:
+        try:
+            return int(float(dateEnd))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid dateEnd")
 
     def createChallenge(self, challengeItem: ChallengeItem) -> ChallengeItem:
         """
@@ -34,7 +186,13 @@ class ChallengeMongoRepo(ChallengeRepository):
         """
         challengeItem.id = str(ObjectId())
         challengeItem.state = ItemState.ACTIVE
-        self._collection.insert_one(challengeItem.model_dump())
+        challengeItem.dateEndAt = self._parseDateEnd(challengeItem.dateEnd)
+        challengeItem.settled = False
+        challengeItem.recordCount = 0
+        challengeItem.approvedRecordCount = 0
+        challengeItem.version = 0
+        self._collection.insert_one(
+            challengeItem.model_dump(exclude=self.RESOLVED_FIELDS))
 
         challenge = self._collection.find_one({"id": challengeItem.id})
         if challenge:
@@ -53,50 +211,84 @@ class ChallengeMongoRepo(ChallengeRepository):
         challenges = self._collection.find()
         return [ChallengeItemMeta(**challenge) for challenge in challenges]
 
-    def getChallenge(self, challengeId: str) -> ChallengeItem:
+    def getChallenge(self, challengeId: str, fields: frozenset[str] = None) -> ChallengeItem:
         """
         Get a challenge by id
 
         Args:
             challengeId (str): Challenge id
+            fields (frozenset[str]): Only load these fields if given.
+                Requesting participants also loads participantIds to resolve them from.
+                userRecordCounts is read from the per-user counters.
 
         Returns:
-            ChallengeItem: ChallengeItem object if found, None otherwise
+            ChallengeItem: ChallengeItem object trimmed to fields if given, None if not found
         """
-        challenge = self._collection.find_one({"id": challengeId})
+        if self._singleFlight is None:
+            return self._loadChallenge(challengeId, fields)
+        # Callers may modify the challenge they get, so each gets its own copy
+        return self._singleFlight.do(
+            ("challenge", challengeId, fields), lambda: self._loadChallenge(challengeId, fields),
+            copy=lambda challenge: challenge.model_copy(deep=True))
+
+    def _forget(self, challengeId: str = None):
+        # Without an id every challenge is forgotten
+        if self._singleFlight is None:
+            return
+        if challengeId is None:
+            self._singleFlight.forget("challenge")
+        else:
+            self._singleFlight.forget("challenge", challengeId)
+
+    def _loadChallenge(self, challengeId: str, fields: frozenset[str]) -> ChallengeItem:
+        if fields is None:
+            challenge = self._collection.find_one({"id": challengeId})
+            if not challenge:
+                raise HTTPException(status_code=404, detail="Challenge not found")
+            return ChallengeItem(participantIds=self.getParticipantIds(challengeId),
+                                 userRecordCounts=self.countRecordsByUser(challengeId), **challenge)
 
+        if fields & self.PARTICIPANT_FIELDS:
+            fields = fields | {"participantIds"}
+        challenge = self._collection.find_one(
+            {"id": challengeId}, projection(fields - self.RESOLVED_FIELDS))
         if not challenge:
             raise HTTPException(status_code=404, detail="Challenge not found")
-        participants = [UserItemMeta(**participant) for participant in challenge.get("participants")]
-        challenge.pop("participants")
-        if challenge:
-            return ChallengeItem(participants=participants, **challenge)
-        else:
-            return None
+        if "participantIds" in fields:
+            challenge["participantIds"] = self.getParticipantIds(challengeId)
+        if "userRecordCounts" in fields:
+            challenge["userRecordCounts"] = self.countRecordsByUser(challengeId)
+        return partialModel(ChallengeItem, fields)(**challenge)
 
     def updateChallenge(self, challengeItem: ChallengeItem) -> ChallengeItem:
         """
-        Update a challenge
+        Update a challenge if it is still at challengeItem.version, and bump the version
 
         Args:
             challengeItem (ChallengeItem): ChallengeItem object
 
         Raises:
-            HTTPException(status_code=500): If failed to update challenge
+            HTTPException(status_code=404): If the challenge is not found
+            VersionConflictError: If the challenge was modified since it was read
 
         Returns:
             ChallengeItem: Updated ChallengeItem object
         """
-        self._collection.update_one({"id": challengeItem.id}, {
-                                    "$set": challengeItem.model_dump()})
+        challengeItem.dateEndAt = self._parseDateEnd(challengeItem.dateEnd)
+        excluded = self.MAINTAINED_FIELDS | self.RESOLVED_FIELDS | {"version"}
+        challenge = self._collection.find_one_and_update(
+            {"id": challengeItem.id, "version": challengeItem.version},
+            {"$set": challengeItem.model_dump(exclude=excluded), "$inc": {"version": 1}},
+            return_document=ReturnDocument.AFTER)
+        if challenge is None:
+            if self._collection.count_documents({"id": challengeItem.id}, limit=1) == 0:
+                raise HTTPException(status_code=404, detail="Challenge not found")
+            raise VersionConflictError("Challenge was modified concurrently, please retry")
 
-        challenge = self._collection.find_one({"id": challengeItem.id})
-        challenge = ChallengeItem(**challenge)
-        if challengeItem == challenge:
-            return challenge
-        else:
-            raise HTTPException(
-                status_code=500, detail="Failed to update challenge")
+        self._forget(challengeItem.id)
+
+        return ChallengeItem(participantIds=challengeItem.participantIds,
+                             userRecordCounts=challengeItem.userRecordCounts, **challenge)
 
     def deleteChallenge(self, challengeId: str) -> bool:
         """
@@ -109,4 +301,291 @@ class ChallengeMongoRepo(ChallengeRepository):
             bool: True if challenge is deleted, False otherwise
         """
         result = self._collection.delete_one({"id": challengeId})
+        self._forget(challengeId)
+        if result.deleted_count > 0:
+            self._recordCollection.delete_many({"challengeId": challengeId})
+            self._participantCollection.delete_many(
+                {"challengeId": challengeId})
+            self._userCounterCollection.delete_many(
+                {"challengeId": challengeId})
+        return result.deleted_count > 0
+
+    def expireChallenges(self, now: int) -> int:
+        """
+        Finish every pending or active challenge whose end time has passed
+
+        Args:
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            int: Number of finished challenges
+        """
+        result = self._collection.update_many(
+            {"state": {"$in": self.OPEN_STATES}, "dateEndAt": {"$lt": now}},
+            {"$set": {"state": int(ItemState.FINISHED)}, "$inc": {"version": 1}})
+        if result.modified_count > 0:
+            self._forget()
+        return result.modified_count
+
+    def finishChallenge(self, challengeId: str, now: int) -> bool:
+        """
+        Finish a pending or active challenge if its end time has passed
+
+        Args:
+            challengeId (str): Challenge id
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            bool: True if the challenge was finished, False otherwise
+        """
+        result = self._collection.update_one(
+            {"id": challengeId, "state": {"$in": self.OPEN_STATES},
+             "dateEndAt": {"$lte": now}},
+            {"$set": {"state": int(ItemState.FINISHED)}, "$inc": {"version": 1}})
+        if result.modified_count == 0:
+            return False
+        self._forget(challengeId)
+        return True
+
+    def getChallengeDeadlines(self) -> list[tuple[str, int]]:
+        """
+        Get the end time of every pending or active challenge
+
+        Returns:
+            list[tuple[str, int]]: List of (challenge id, dateEndAt) pairs
+        """
+        challenges = self._collection.find(
+            {"state": {"$in": self.OPEN_STATES}, "dateEndAt": {"$ne": None}},
+            {"_id": 0, "id": 1, "dateEndAt": 1})
+        return [(challenge["id"], challenge["dateEndAt"]) for challenge in challenges]
+
+    def addParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Add a user to the participants of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if added, False if the user already participates
+        """
+        try:
+            self._participantCollection.insert_one(
+                {"challengeId": challengeId, "userId": userId, "joinedAt": time.time()})
+            self._forget(challengeId)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def removeParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Remove a user from the participants of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if removed, False if the user did not participate
+        """
+        result = self._participantCollection.delete_one(
+            {"challengeId": challengeId, "userId": userId})
+        self._forget(challengeId)
         return result.deleted_count > 0
+
+    def isParticipant(self, challengeId: str, userId: str) -> bool:
+        """
+        Check whether a user participates in a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): User id
+
+        Returns:
+            bool: True if the user participates, False otherwise
+        """
+        return self._participantCollection.find_one(
+            {"challengeId": challengeId, "userId": userId}, {"_id": 1}) is not None
+
+    def getParticipantIds(self, challengeId: str) -> list[str]:
+        """
+        Get the ids of the participants of a challenge, in joining order
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            list[str]: List of user ids
+        """
+        participants = self._participantCollection.find(
+            {"challengeId": challengeId}, {"_id": 0, "userId": 1}).sort("joinedAt", ASCENDING)
+        return [participant["userId"] for participant in participants]
+
+    def getChallengesForUser(self, userId: str) -> list[ChallengeItemMeta]:
+        """
+        Get the challenges a user participates in, most recently joined first
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            list[ChallengeItemMeta]: List of ChallengeItemMeta objects
+        """
+        challengeIds = [participant["challengeId"] for participant in self._participantCollection.find(
+            {"userId": userId}, {"_id": 0, "challengeId": 1}).sort("joinedAt", DESCENDING)]
+        challenges = {challenge["id"]: ChallengeItemMeta(**challenge) for challenge in self._collection.find(
+            {"id": {"$in": challengeIds}}, {field: 1 for field in ChallengeItemMeta.model_fields})}
+        return [challenges[challengeId] for challengeId in challengeIds if challengeId in challenges]
+
+    def addRecord(self, recordItem: ChallengeRecordItem) -> ChallengeRecordItem:
+        """
+        Add a record to a challenge
+
+        Args:
+            recordItem (ChallengeRecordItem): Record with challengeId set
+
+        Raises:
+            HTTPException(status_code=500): If failed to add record
+
+        Returns:
+            ChallengeRecordItem: Added record
+        """
+        recordItem.id = str(ObjectId())
+        result = self._recordCollection.insert_one(recordItem.model_dump())
+        if not result.acknowledged:
+            raise HTTPException(
+                status_code=500, detail="Failed to add challenge record")
+
+        increments = {"recordCount": 1}
+        if recordItem.approved:
+            increments["approvedRecordCount"] = 1
+        self._collection.update_one(
+            {"id": recordItem.challengeId}, {"$inc": increments})
+        self._userCounterCollection.update_one(
+            {"challengeId": recordItem.challengeId, "userId": recordItem.userId},
+            {"$inc": increments}, upsert=True)
+        self._forget(recordItem.challengeId)
+
+        return recordItem
+
+    def getRecords(self, challengeId: str, userId: str = None, offset: int = 0, limit: int = 20) -> list[ChallengeRecordItem]:
+        """
+        Get a page of the records of a challenge, oldest first
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): Only records of this user if given
+            offset (int): Number of records to skip
+            limit (int): Maximum number of records
+
+        Returns:
+            list[ChallengeRecordItem]: List of records
+        """
+        query = {"challengeId": challengeId}
+        if userId is not None:
+            query["userId"] = userId
+        records = self._recordCollection.find(query).sort(
+            "date", ASCENDING).skip(offset).limit(limit)
+        return [ChallengeRecordItem(**record) for record in records]
+
+    def setRecordApproval(self, challengeId: str, recordId: str, approved: bool) -> ChallengeRecordItem:
+        """
+        Approve or disapprove a record
+
+        Args:
+            challengeId (str): Challenge id
+            recordId (str): Record id
+            approved (bool): Approval state
+
+        Returns:
+            ChallengeRecordItem: Updated record if found, None otherwise
+        """
+        # Only a real state change moves the approved counter
+        record = self._recordCollection.find_one_and_update(
+            {"challengeId": challengeId, "id": recordId,
+                "approved": {"$ne": approved}},
+            {"$set": {"approved": approved}},
+            return_document=ReturnDocument.AFTER)
+        if record:
+            increments = {"approvedRecordCount": 1 if approved else -1}
+            self._collection.update_one({"id": challengeId}, {"$inc": increments})
+            self._userCounterCollection.update_one(
+                {"challengeId": challengeId, "userId": record["userId"]},
+                {"$inc": increments}, upsert=True)
+            self._forget(challengeId)
+        else:
+            record = self._recordCollection.find_one(
+                {"challengeId": challengeId, "id": recordId})
+
+        if record:
+            return ChallengeRecordItem(**record)
+        else:
+            return None
+
+    def countRecords(self, challengeId: str, userId: str = None) -> int:
+        """
+        Count the records of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            userId (str): Only records of this user if given
+
+        Returns:
+            int: Number of records
+        """
+        if userId is None:
+            counter = self._collection.find_one(
+                {"id": challengeId}, {"_id": 0, "recordCount": 1})
+        else:
+            counter = self._userCounterCollection.find_one(
+                {"challengeId": challengeId, "userId": userId}, {"_id": 0, "recordCount": 1})
+        if not counter:
+            return 0
+        return counter.get("recordCount", 0)
+
+    def countRecordsByUser(self, challengeId: str) -> dict[str, int]:
+        """
+        Count the records of a challenge per user
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            dict[str, int]: Number of records by user id
+        """
+        counters = self._userCounterCollection.find(
+            {"challengeId": challengeId, "recordCount": {"$gt": 0}},
+            {"_id": 0, "userId": 1, "recordCount": 1})
+        return {counter["userId"]: counter["recordCount"] for counter in counters}
+
+    def getUnsettledChallenges(self) -> list[str]:
+        """
+        Get finished challenges whose rewards have not been settled
+
+        Returns:
+            list[str]: List of challenge ids
+        """
+        challenges = self._collection.find(
+            {"state": int(ItemState.FINISHED), "settled": {"$ne": True}},
+            {"_id": 0, "id": 1})
+        return [challenge["id"] for challenge in challenges]
+
+    def markChallengeSettled(self, challengeId: str) -> bool:
+        """
+        Mark a finished challenge as settled
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            bool: True if the challenge was marked, False if not finished or already settled
+        """
+        result = self._collection.update_one(
+            {"id": challengeId, "state": int(ItemState.FINISHED),
+             "settled": {"$ne": True}},
+            {"$set": {"settled": True}})
+        if result.modified_count == 0:
+            return False
+        self._forget(challengeId)
+        return True
@@ -1,16 +1,25 @@
+import logging
+import time
+
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING
 from pymongo.database import Database
 
-from core.model import CouponItem, CouponItemMeta
+from core.model import CouponItem, CouponPage, ItemState
 from core.repo import CouponRepository
 
+logger = logging.getLogger(__name__)
+
 
 class CouponMongoRepo(CouponRepository):
     """
     Implementation of CouponRepository using MongoDB
     """
 
+    # Validity given to coupons whose expiredAt cannot be parsed, as for purchases
+    DEFAULT_EXPIRY_SECONDS = 60 * 60 * 24 * 7
+
     def __init__(self, db: Database):
         super().__init__()
         self._db = db
@@ -18,6 +27,52 @@ class CouponMongoRepo(CouponRepository):
         if self._db.get_collection("coupons") is None:
             self._db.create_collection("coupons")
         self._collection = db["coupons"]
+        self._migrateExpiry()
+        self._migrateOwners()
+        self._collection.create_index([("state", ASCENDING), ("expiresAt", ASCENDING)])
+        self._collection.create_index([("ownerId", ASCENDING), ("id", DESCENDING)])
+
+    def _migrateExpiry(self):
+        """
+        Fill the numeric expiry of coupons stored before it existed, or stored without one
+        """
+        self._collection.update_many(
+            {"state": {"$exists": False}}, {"$set": {"state": int(ItemState.ACTIVE)}})
+        # Matches coupons without expiresAt as well as those where it is null
+        for coupon in self._collection.find({"expiresAt": None}, {"id": 1, "expiredAt": 1}):
+            expiredAt, expiresAt = self._parseExpiry(coupon.get("id"), coupon.get("expiredAt"))
+            self._collection.update_one({"_id": coupon["_id"]}, {"$set": {
+                "expiredAt": expiredAt,
+                "expiresAt": expiresAt,
+            }})
+
+    def _migrateOwners(self):
+        """
+        Move coupon lists embedded in user documents onto the coupons
+        """
+        users = self._db["users"]
+        for user in users.find({"couponList": {"$exists": True}}, {"id": 1, "couponList": 1}):
+            couponIds = [coupon["id"] for coupon in user.get("couponList") or []]
+            if couponIds:
+                self._collection.update_many(
+                    {"id": {"$in": couponIds}}, {"$set": {"ownerId": user["id"]}})
+            users.update_one({"_id": user["_id"]}, {"$unset": {"couponList": ""}})
+
+    @classmethod
+    def _parseExpiry(cls, couponId: str, expiredAt: str) -> tuple[str, int]:
+        """
+        Parse the expiry of a coupon, falling back to DEFAULT_EXPIRY_SECONDS from now
+
+        Returns:
+            tuple[str, int]: expiredAt and the numeric expiresAt, in unix seconds
+        """
+        try:
+            return expiredAt, int(float(expiredAt))
+        except (TypeError, ValueError):
+            expiresAt = int(time.time()) + cls.DEFAULT_EXPIRY_SECONDS
+            logger.warning("Coupon %s has an invalid expiredAt %r, expiring it at %d",
+                           couponId, expiredAt, expiresAt)
+            return str(expiresAt), expiresAt
 
     def createCoupon(self, couponItem: CouponItem) -> CouponItem:
         """
@@ -34,6 +89,8 @@ class CouponMongoRepo(CouponRepository):
         """
         if not couponItem.id:
             couponItem.id = str(ObjectId())
+        couponItem.expiredAt, couponItem.expiresAt = self._parseExpiry(
+            couponItem.id, couponItem.expiredAt)
         self._collection.insert_one(couponItem.model_dump())
 
         coupon = self._collection.find_one({"id": couponItem.id})
@@ -72,12 +129,16 @@ class CouponMongoRepo(CouponRepository):
         Returns:
             CouponItem: Updated coupon item
         """
+        couponItem.expiredAt, couponItem.expiresAt = self._parseExpiry(
+            couponItem.id, couponItem.expiredAt)
+        if couponItem.expiresAt > time.time():
+            couponItem.state = ItemState.ACTIVE
         self._collection.update_one({"id": couponItem.id}, {
                                     "$set": couponItem.model_dump()})
 
-        coupon = self._collection.find_one({"id": couponItem.id})
+        coupon = self.getCoupon(couponItem.id)
         if couponItem == coupon:
-            return CouponItem(**coupon)
+            return coupon
         else:
             raise HTTPException(
                 status_code=500, detail="Failed to update coupon")
@@ -94,3 +155,45 @@ class CouponMongoRepo(CouponRepository):
         """
         result = self._collection.delete_one({"id": couponId})
         return result.deleted_count > 0
+
+    def listForUser(self, userId: str, activeOnly: bool = True, cursor: str = None, limit: int = 20) -> CouponPage:
+        """
+        Get a page of the coupons of a user, newest first
+
+        Args:
+            userId (str): Owner id
+            activeOnly (bool): Skip expired coupons
+            cursor (str): nextCursor of the previous page, None for the first page
+            limit (int): Maximum number of coupons
+
+        Returns:
+            CouponPage: Coupons and the cursor of the next page, None if there is none
+        """
+        query = {"ownerId": userId}
+        if cursor:
+            query["id"] = {"$lt": cursor}
+        if activeOnly:
+            # Coupons past their expiry count as expired before the sweeper gets to them
+            query["state"] = int(ItemState.ACTIVE)
+            query["expiresAt"] = {"$gt": int(time.time())}
+
+        coupons = [CouponItem(**coupon) for coupon in
+                   self._collection.find(query).sort("id", DESCENDING).limit(limit + 1)]
+        if len(coupons) > limit:
+            return CouponPage(items=coupons[:limit], nextCursor=coupons[limit - 1].id)
+        return CouponPage(items=coupons)
+
+    def expireCoupons(self, now: int) -> int:
+        """
+        Mark active coupons past their expiry as expired
+
+        Args:
+            now (int): Current unix timestamp in seconds
+
+        Returns:
+            int: Number of expired coupons
+        """
+        result = self._collection.update_many(
+            {"state": int(ItemState.ACTIVE), "expiresAt": {"$lte": now}},
+            {"$set": {"state": int(ItemState.INACTIVE)}})
+        return result.modified_count
@@ -1,24 +1,84 @@
+import random
+
 from bson import ObjectId
 
 from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 
-from core.model import DonationItem, DonationItemMeta
+from core.model import (DonationItem, DonationItemMeta,
+                        DonationParticipationItem, DonorTotalItem)
 from core.repo import DonationRepository
 
 
 class DonationMongoRepo(DonationRepository):
     """
     Implementation of DonationRepository using MongoDB
+
+    The total point of a donation is the sum of its counter shards. Each
+    participation increments one random shard, so concurrent participations
+    do not contend on the donation document. The total stored on the donation
+    itself is materialized periodically and only used for listings.
+
+    Participations are appended to their own collection, and the total of
+    every donor per donation is kept up to date with $inc on each append.
     """
 
-    def __init__(self, db):
+    # Fields maintained through the counter shards, never overwritten by updateDonation
+    MAINTAINED_FIELDS = {"totalPoint"}
+
+    def __init__(self, db, counterShards: int = 16):
         super().__init__()
         self._db = db
+        self._counterShards = counterShards
 
         if self._db.get_collection("donations") is None:
             self._db.create_collection("donations")
         self._collection = db["donations"]
 
+        if self._db.get_collection("donationCounters") is None:
+            self._db.create_collection("donationCounters")
+        self._counterCollection = db["donationCounters"]
+        self._counterCollection.create_index(
+            [("donationId", ASCENDING), ("shard", ASCENDING)], unique=True)
+        self._migrateCounters()
+
+        if self._db.get_collection("donationParticipations") is None:
+            self._db.create_collection("donationParticipations")
+        self._participationCollection = db["donationParticipations"]
+        self._participationCollection.create_index(
+            [("donationId", ASCENDING), ("timestamp", DESCENDING)])
+        self._participationCollection.create_index(
+            [("userId", ASCENDING), ("timestamp", DESCENDING)])
+
+        if self._db.get_collection("donorTotals") is None:
+            self._db.create_collection("donorTotals")
+        self._donorCollection = db["donorTotals"]
+        self._donorCollection.create_index(
+            [("donationId", ASCENDING), ("userId", ASCENDING)], unique=True)
+        self._donorCollection.create_index(
+            [("donationId", ASCENDING), ("points", DESCENDING)])
+        self._donorCollection.create_index(
+            [("userId", ASCENDING), ("lastDonatedAt", DESCENDING)])
+
+    def _migrateCounters(self):
+        """
+        Seed the counters of donations created before counter shards
+        """
+        counted = set(self._counterCollection.distinct("donationId"))
+        for donation in self._collection.find({}, {"id": 1, "totalPoint": 1}):
+            if donation["id"] not in counted:
+                self._seedCounter(donation["id"], donation.get("totalPoint", 0))
+
+    def _seedCounter(self, donationId: str, points: int):
+        self._counterCollection.update_one(
+            {"donationId": donationId, "shard": 0},
+            {"$setOnInsert": {"points": points}}, upsert=True)
+
+    def _sumCounters(self, donationId: str) -> int:
+        shards = self._counterCollection.find(
+            {"donationId": donationId}, {"points": 1})
+        return sum(shard["points"] for shard in shards)
+
     def createDonation(self, donationItem: DonationItem) -> DonationItem:
         """
         Create a new donation item
@@ -34,6 +94,7 @@ class DonationMongoRepo(DonationRepository):
         """
         donationItem.id = str(ObjectId())
         self._collection.insert_one(donationItem.model_dump())
+        self._seedCounter(donationItem.id, donationItem.totalPoint)
 
         donation = self._collection.find_one({"id": donationItem.id})
         if donation:
@@ -44,7 +105,7 @@ class DonationMongoRepo(DonationRepository):
 
     def getAllDonations(self) -> list[DonationItemMeta]:
         """
-        Get all donation items
+        Get all donation items, with the last materialized totals
 
         Returns:
             list[DonationItemMeta]: A list of donation items
@@ -54,7 +115,7 @@ class DonationMongoRepo(DonationRepository):
 
     def getDonation(self, donationId: str) -> DonationItem:
         """
-        Get a donation item by ID
+        Get a donation item by ID, with its current total
 
         Args:
             donationId (str): The ID of the donation item to get
@@ -64,13 +125,14 @@ class DonationMongoRepo(DonationRepository):
         """
         donation = self._collection.find_one({"id": donationId})
         if donation:
+            donation["totalPoint"] = self._sumCounters(donationId)
             return DonationItem(**donation)
         else:
             return None
 
     def updateDonation(self, donationItem: DonationItem) -> DonationItem:
         """
-        Update a donation item
+        Update a donation item. A changed totalPoint is applied to the counters as a difference.
 
         Args:
             donationItem (DonationItem): The donation item to update
@@ -82,11 +144,14 @@ class DonationMongoRepo(DonationRepository):
             DonationItem: The updated donation item
         """
         self._collection.update_one({"id": donationItem.id}, {
-                                    "$set": donationItem.model_dump()})
+                                    "$set": donationItem.model_dump(exclude=self.MAINTAINED_FIELDS)})
+        difference = donationItem.totalPoint - self._sumCounters(donationItem.id)
+        if difference:
+            self.addDonationPoints(donationItem.id, difference)
 
-        donation = self._collection.find_one({"id": donationItem.id})
+        donation = self.getDonation(donationItem.id)
         if donationItem == donation:
-            return DonationItem(**donation)
+            return donation
         else:
             raise HTTPException(
                 status_code=500, detail="Failed to update donation")
@@ -102,4 +167,86 @@ class DonationMongoRepo(DonationRepository):
             bool: True if the donation item was deleted, False otherwise
         """
         result = self._collection.delete_one({"id": donationId})
+        self._counterCollection.delete_many({"donationId": donationId})
+        self._participationCollection.delete_many({"donationId": donationId})
+        self._donorCollection.delete_many({"donationId": donationId})
         return result.deleted_count > 0
+
+    def addDonationPoints(self, donationId: str, points: int):
+        """
+        Add points to a random counter shard of a donation
+
+        Args:
+            donationId (str): The ID of the donation item
+            points (int): Points to add
+        """
+        self._counterCollection.update_one(
+            {"donationId": donationId, "shard": random.randrange(self._counterShards)},
+            {"$inc": {"points": points}}, upsert=True)
+
+    def materializeDonationTotals(self) -> int:
+        """
+        Write the sum of the counter shards onto every donation item
+
+        Returns:
+            int: Number of donation items whose total changed
+        """
+        totals = self._counterCollection.aggregate([
+            {"$group": {"_id": "$donationId", "total": {"$sum": "$points"}}}])
+        requests = [UpdateOne({"id": total["_id"], "totalPoint": {"$ne": total["total"]}},
+                              {"$set": {"totalPoint": total["total"]}})
+                    for total in totals]
+        if not requests:
+            return 0
+        return self._collection.bulk_write(requests, ordered=False).modified_count
+
+    def addParticipation(self, participationItem: DonationParticipationItem) -> DonationParticipationItem:
+        """
+        Append a participation to the ledger and add it to the totals of the donor
+
+        Args:
+            participationItem (DonationParticipationItem): The participation to record
+
+        Returns:
+            DonationParticipationItem: The recorded participation
+        """
+        participationItem.id = str(ObjectId())
+        self._participationCollection.insert_one(participationItem.model_dump())
+        self._donorCollection.update_one(
+            {"donationId": participationItem.donationId,
+                "userId": participationItem.userId},
+            {"$inc": {"points": participationItem.points, "count": 1},
+             "$max": {"lastDonatedAt": participationItem.timestamp}},
+            upsert=True)
+        return participationItem
+
+    def getTopDonors(self, donationId: str, limit: int) -> list[DonorTotalItem]:
+        """
+        Get the donors who gave the most points to a donation
+
+        Args:
+            donationId (str): The ID of the donation item
+            limit (int): Maximum number of donors
+
+        Returns:
+            list[DonorTotalItem]: Totals of the donors, most points first
+        """
+        donors = self._donorCollection.find({"donationId": donationId}).sort(
+            "points", DESCENDING).limit(limit)
+        return [DonorTotalItem(**donor) for donor in donors]
+
+    def getDonorTotals(self, userId: str, offset: int = 0, limit: int = 20) -> list[DonorTotalItem]:
+        """
+        Get a page of the totals of a user per donation
+
+        Args:
+            userId (str): User id
+            offset (int): Number of totals to skip
+            limit (int): Maximum number of totals
+
+        Returns:
+            list[DonorTotalItem]: Totals of the user, most recently donated first
+        """
+        totals = self._donorCollection.find({"userId": userId}).sort(
+            "lastDonatedAt", DESCENDING).skip(offset).limit(limit)
+        return [DonorTotalItem(**total) for total in totals]
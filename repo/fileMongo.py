@@ -2,9 +2,10 @@ import base64
 
 from bson import ObjectId
 from fastapi import HTTPException, UploadFile
+from pymongo import ASCENDING
 from pymongo.database import Database
 
-from core.model import FileData
+from core.model import FileBatchItem, FileData, FileDataMeta
 from core.repo import FileRepository
 
 
@@ -20,6 +21,7 @@ class FileMongoRepo(FileRepository):
         if self._db.get_collection("files") is None:
             self._db.create_collection("files")
         self._collection = db["files"]
+        self._collection.create_index([("id", ASCENDING)])
 
     def createFile(self, file: UploadFile, userId: str, isPrivate: bool = False) -> FileData:
         """
@@ -82,11 +84,32 @@ class FileMongoRepo(FileRepository):
                 name=file["name"],
                 contentType=file["contentType"],
                 size=file["size"],
-                file=base64.b64decode(file["file"])
+                file=base64.b64decode(file["file"]),
+                isPrivate=file.get("isPrivate", False)
             )
         else:
             return None
 
+    def getFiles(self, fileIds: list[str], inlineSize: int = 0) -> list[FileBatchItem]:
+        """
+        Get many files by ID in one query
+
+        Args:
+            fileIds (list[str]): IDs of the files
+            inlineSize (int): Include the content of files up to this many bytes
+
+        Returns:
+            list[FileBatchItem]: Found files, in no particular order
+        """
+        projection = {"_id": 0, **{field: 1 for field in FileDataMeta.model_fields}}
+        if inlineSize > 0:
+            # Content is stored base64 encoded; only small files leave the database with it
+            projection["data"] = {"$cond": [
+                {"$lte": ["$size", inlineSize]}, "$file", "$$REMOVE"]}
+
+        files = self._collection.find({"id": {"$in": fileIds}}, projection)
+        return [FileBatchItem(**file) for file in files]
+
     def updateFile(self, file: UploadFile, fileData: FileData) -> FileData:
         """
         Update file data with new file
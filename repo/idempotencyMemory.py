@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+from core.model import IdempotencyRecord
+from core.repo import IdempotencyRepository
+
+
+class IdempotencyMemoryRepo(IdempotencyRepository):
+    """
+    Implementation of IdempotencyRepository in process memory
+
+    Keys are only known to the worker that received the request, so this is
+    suitable for single worker deployments only.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # key -> (expireAt, IdempotencyRecord), roughly oldest expiry first
+        self._records: OrderedDict[str, tuple[float, IdempotencyRecord]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _removeExpired(self, now: float):
+        while self._records:
+            key, (expireAt, _) = next(iter(self._records.items()))
+            if expireAt > now:
+                return
+            del self._records[key]
+
+    def reserveKey(self, key: str, fingerprint: str, ttl: int) -> IdempotencyRecord:
+        """
+        Reserve a key for the request about to run
+
+        Args:
+            key (str): Scoped idempotency key
+            fingerprint (str): Hash of the request, to detect a key reused for another request
+            ttl (int): Seconds until an unfinished reservation lapses
+
+        Returns:
+            IdempotencyRecord: None if the key was reserved, the existing record otherwise
+        """
+        now = time.time()
+        with self._lock:
+            self._removeExpired(now)
+            entry = self._records.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+            self._records[key] = (now + ttl, IdempotencyRecord(key=key, fingerprint=fingerprint))
+            self._records.move_to_end(key)
+        return None
+
+    def extendKey(self, key: str, ttl: int) -> bool:
+        """
+        Keep an unfinished reservation from lapsing while its request runs
+
+        Args:
+            key (str): Scoped idempotency key
+            ttl (int): Seconds from now until the reservation lapses
+
+        Returns:
+            bool: True if extended, False if the reservation is gone or finished
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._records.get(key)
+            if entry is None or entry[0] <= now or entry[1].done:
+                return False
+            self._records[key] = (now + ttl, entry[1])
+            self._records.move_to_end(key)
+        return True
+
+    def completeKey(self, key: str, statusCode: int, body: str, ttl: int):
+        """
+        Store the response of a reserved key
+
+        Args:
+            key (str): Scoped idempotency key
+            statusCode (int): Response status code
+            body (str): JSON encoded response body
+            ttl (int): Seconds the response is replayed for
+        """
+        with self._lock:
+            entry = self._records.get(key)
+            fingerprint = entry[1].fingerprint if entry is not None else ''
+            self._records[key] = (time.time() + ttl, IdempotencyRecord(
+                key=key, fingerprint=fingerprint, done=True, statusCode=statusCode, body=body))
+            self._records.move_to_end(key)
+
+    def releaseKey(self, key: str):
+        """
+        Drop a reservation so the request can be retried
+
+        Args:
+            key (str): Scoped idempotency key
+        """
+        with self._lock:
+            self._records.pop(key, None)
+
+    def getKey(self, key: str) -> IdempotencyRecord:
+        """
+        Get the record of a key
+
+        Args:
+            key (str): Scoped idempotency key
+
+        Returns:
+            IdempotencyRecord: The record if found and not expired, None otherwise
+        """
+        with self._lock:
+            entry = self._records.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from core.model import IdempotencyRecord
+from core.repo import IdempotencyRepository
+
+
+class IdempotencyMongoRepo(IdempotencyRepository):
+    """
+    Implementation of IdempotencyRepository using MongoDB
+
+    Keys are shared by every worker and expired by a TTL index. A unique index
+    on the key makes the reservation atomic.
+    """
+
+    RECORD_PROJECTION = {"_id": 0, "key": 1, "fingerprint": 1, "done": 1, "statusCode": 1, "body": 1}
+
+    def __init__(self, db: Database):
+        super().__init__()
+        self._db = db
+
+        if self._db.get_collection("idempotencyKeys") is None:
+            self._db.create_collection("idempotencyKeys")
+        self._collection = self._db["idempotencyKeys"]
+        self._collection.create_index([("key", ASCENDING)], unique=True)
+        self._collection.create_index(
+            [("expiresAt", ASCENDING)], expireAfterSeconds=0)
+
+    def reserveKey(self, key: str, fingerprint: str, ttl: int) -> IdempotencyRecord:
+        """
+        Reserve a key for the request about to run
+
+        Args:
+            key (str): Scoped idempotency key
+            fingerprint (str): Hash of the request, to detect a key reused for another request
+            ttl (int): Seconds until an unfinished reservation lapses
+
+        Returns:
+            IdempotencyRecord: None if the key was reserved, the existing record otherwise
+        """
+        now = datetime.now(timezone.utc)
+        reservation = {"key": key, "fingerprint": fingerprint, "done": False,
+                       "expiresAt": now + timedelta(seconds=ttl)}
+        try:
+            self._collection.insert_one(reservation)
+            return None
+        except DuplicateKeyError:
+            pass
+
+        # The TTL monitor runs about once a minute, so take over expired keys here
+        record = self._collection.find_one_and_update(
+            {"key": key, "expiresAt": {"$lte": now}},
+            {"$set": reservation, "$unset": {"statusCode": "", "body": ""}})
+        if record is not None:
+            return None
+
+        record = self._collection.find_one({"key": key}, self.RECORD_PROJECTION)
+        if record is None:
+            # Released in the meantime
+            return self.reserveKey(key, fingerprint, ttl)
+        return IdempotencyRecord(**record)
+
+    def extendKey(self, key: str, ttl: int) -> bool:
+        """
+        Keep an unfinished reservation from lapsing while its request runs
+
+        Args:
+            key (str): Scoped idempotency key
+            ttl (int): Seconds from now until the reservation lapses
+
+        Returns:
+            bool: True if extended, False if the reservation is gone or finished
+        """
+        now = datetime.now(timezone.utc)
+        result = self._collection.update_one(
+            {"key": key, "done": False, "expiresAt": {"$gt": now}},
+            {"$set": {"expiresAt": now + timedelta(seconds=ttl)}})
+        return result.modified_count > 0
+
+    def completeKey(self, key: str, statusCode: int, body: str, ttl: int):
+        """
+        Store the response of a reserved key
+
+        Args:
+            key (str): Scoped idempotency key
+            statusCode (int): Response status code
+            body (str): JSON encoded response body
+            ttl (int): Seconds the response is replayed for
+        """
+        self._collection.update_one({"key": key}, {"$set": {
+            "done": True,
+            "statusCode": statusCode,
+            "body": body,
+            "expiresAt": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        }}, upsert=True)
+
+    def releaseKey(self, key: str):
+        """
+        Drop a reservation so the request can be retried
+
+        Args:
+            key (str): Scoped idempotency key
+        """
+        self._collection.delete_one({"key": key, "done": False})
+
+    def getKey(self, key: str) -> IdempotencyRecord:
+        """
+        Get the record of a key
+
+        Args:
+            key (str): Scoped idempotency key
+
+        Returns:
+            IdempotencyRecord: The record if found and not expired, None otherwise
+        """
+        record = self._collection.find_one(
+            {"key": key, "expiresAt": {"$gt": datetime.now(timezone.utc)}}, self.RECORD_PROJECTION)
+        if record is None:
+            return None
+        return IdempotencyRecord(**record)
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from core.repo import LeaseRepository
+
+
+class LeaseMongoRepo(LeaseRepository):
+    """
+    Implementation of LeaseRepository using MongoDB
+    """
+
+    def __init__(self, db: Database):
+        super().__init__()
+        self._db = db
+
+        if self._db.get_collection("leases") is None:
+            self._db.create_collection("leases")
+        self._collection = self._db["leases"]
+        self._collection.create_index([("name", ASCENDING)], unique=True)
+
+    def acquireLease(self, name: str, owner: str, ttl: int) -> bool:
+        """
+        Acquire a lease, or extend it if already held by owner
+
+        Args:
+            name (str): Lease name
+            owner (str): Unique id of the requesting process
+            ttl (int): Seconds until the lease expires unless renewed
+
+        Returns:
+            bool: True if owner holds the lease, False otherwise
+        """
+        now = datetime.now(timezone.utc)
+        try:
+            # Matches if we hold the lease or it expired; otherwise the upsert
+            # collides with the holder's document on the unique name index
+            self._collection.update_one(
+                {"name": name, "$or": [
+                    {"owner": owner}, {"expiresAt": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expiresAt": now + timedelta(seconds=ttl)}},
+                upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def releaseLease(self, name: str, owner: str) -> bool:
+        """
+        Release a lease held by owner
+
+        Args:
+            name (str): Lease name
+            owner (str): Unique id of the releasing process
+
+        Returns:
+            bool: True if the lease was released, False otherwise
+        """
+        result = self._collection.delete_one({"name": name, "owner": owner})
+        return result.deleted_count > 0
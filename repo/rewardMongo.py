@@ -1,16 +1,28 @@
+import time
+
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import ASCENDING, ReturnDocument
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError
 
-from core.model import RewardItem, RewardItemMeta
+from core.model import CouponUnitItem, RewardItem, RewardItemMeta
 from core.repo import RewardRepository
 
 
 class RewardMongoRepo(RewardRepository):
     """
     Implementation of RewardRepository using MongoDB
+
+    Coupon units of every reward are kept in the couponInventory collection
+    and handed out with find-and-modify, so a unit is claimed exactly once.
+    The stock of a reward counts its units not claimed yet.
     """
 
+    # Fields maintained by the inventory, never overwritten by updateReward
+    MAINTAINED_FIELDS = {"stock"}
+    UNIT_PROJECTION = {"_id": 0, "id": 1, "rewardId": 1, "couponId": 1}
+
     def __init__(self, db: Database):
         super().__init__()
         self._db = db
@@ -19,6 +31,27 @@ class RewardMongoRepo(RewardRepository):
 
         self._collection = self._db["rewards"]
 
+        if self._db.get_collection("couponInventory") is None:
+            self._db.create_collection("couponInventory")
+        self._inventoryCollection = self._db["couponInventory"]
+        self._inventoryCollection.create_index(
+            [("rewardId", ASCENDING), ("couponId", ASCENDING)], unique=True)
+        self._inventoryCollection.create_index([("id", ASCENDING)], unique=True)
+        self._inventoryCollection.create_index(
+            [("rewardId", ASCENDING), ("state", ASCENDING), ("reservedUntil", ASCENDING)])
+        self._inventoryCollection.create_index(
+            [("reservedBy", ASCENDING)], sparse=True)
+
+    @staticmethod
+    def _claimable(rewardId: str, now: float) -> dict:
+        """
+        Filter of the units of a reward that can be reserved or claimed
+        """
+        return {"rewardId": rewardId, "$or": [
+            {"state": "available"},
+            {"state": "reserved", "reservedUntil": {"$lt": now}},
+        ]}
+
     def createReward(self, rewardItem: RewardItem) -> RewardItem:
         """
         Create a new reward item
@@ -33,6 +66,7 @@ class RewardMongoRepo(RewardRepository):
             RewardItem: Created reward item
         """
         rewardItem.id = str(ObjectId())
+        rewardItem.stock = 0
 
         self._collection.insert_one(rewardItem.model_dump())
 
@@ -71,7 +105,7 @@ class RewardMongoRepo(RewardRepository):
 
     def updateReward(self, rewardItem: RewardItem) -> RewardItem:
         """
-        Update a reward item
+        Update a reward item. The stock is left to the inventory.
 
         Args:
             rewardItem (RewardItem): Reward item to update
@@ -83,11 +117,11 @@ class RewardMongoRepo(RewardRepository):
             RewardItem: Updated reward item
         """
         self._collection.update_one({"id": rewardItem.id}, {
-                                    "$set": rewardItem.model_dump()})
+                                    "$set": rewardItem.model_dump(exclude=self.MAINTAINED_FIELDS)})
 
-        reward = self._collection.find_one({"id": rewardItem.id})
-        if rewardItem == reward:
-            return RewardItem(**reward)
+        reward = self.getReward(rewardItem.id)
+        if reward and rewardItem.model_dump(exclude=self.MAINTAINED_FIELDS) == reward.model_dump(exclude=self.MAINTAINED_FIELDS):
+            return reward
         else:
             raise HTTPException(
                 status_code=500, detail="Failed to update reward")
@@ -103,4 +137,134 @@ class RewardMongoRepo(RewardRepository):
             bool: True if deleted, False if not found
         """
         result = self._collection.delete_one({"id": rewardId})
+        self._inventoryCollection.delete_many(
+            {"rewardId": rewardId, "state": {"$ne": "claimed"}})
         return result.deleted_count > 0
+
+    def addInventory(self, rewardId: str, couponIds: list[str]) -> int:
+        """
+        Add coupon units to the inventory of a reward
+
+        Args:
+            rewardId (str): Reward ID
+            couponIds (list[str]): Coupon IDs, each handed out at most once
+
+        Returns:
+            int: Number of units added, coupons already in the inventory are skipped
+        """
+        units = [dict(id=str(ObjectId()), rewardId=rewardId, couponId=couponId, state="available")
+                 for couponId in dict.fromkeys(couponIds)]
+        if not units:
+            return 0
+
+        try:
+            added = len(self._inventoryCollection.insert_many(
+                units, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            added = e.details["nInserted"]
+        self._collection.update_one({"id": rewardId}, {"$inc": {"stock": added}})
+        return added
+
+    def claimUnit(self, rewardId: str, userId: str) -> CouponUnitItem:
+        """
+        Atomically claim an available coupon unit of a reward. When every unit
+        left is reserved by a process, one of those is taken instead; its
+        owner then fails to claim it and moves on.
+
+        Args:
+            rewardId (str): Reward ID
+            userId (str): User claiming the unit
+
+        Returns:
+            CouponUnitItem: Claimed unit, or None if out of stock
+        """
+        now = time.time()
+        update = {"$set": {"state": "claimed", "claimedBy": userId, "claimedAt": now},
+                  "$unset": {"reservedBy": "", "reservedUntil": ""}}
+        unit = self._inventoryCollection.find_one_and_update(
+            self._claimable(rewardId, now), update, projection=self.UNIT_PROJECTION)
+        if unit is None:
+            unit = self._inventoryCollection.find_one_and_update(
+                {"rewardId": rewardId, "state": "reserved"}, update, projection=self.UNIT_PROJECTION)
+        if unit is None:
+            return None
+        self._collection.update_one({"id": rewardId}, {"$inc": {"stock": -1}})
+        return CouponUnitItem(**unit)
+
+    def reserveUnit(self, rewardId: str, owner: str, ttl: int) -> CouponUnitItem:
+        """
+        Reserve an available coupon unit for a process, to be claimed later
+
+        Args:
+            rewardId (str): Reward ID
+            owner (str): Unique id of the reserving process
+            ttl (int): Seconds until the reservation lapses and the unit is available again
+
+        Returns:
+            CouponUnitItem: Reserved unit, or None if out of stock
+        """
+        now = time.time()
+        unit = self._inventoryCollection.find_one_and_update(
+            self._claimable(rewardId, now),
+            {"$set": {"state": "reserved", "reservedBy": owner, "reservedUntil": now + ttl}},
+            projection=self.UNIT_PROJECTION, return_document=ReturnDocument.AFTER)
+        if unit is None:
+            return None
+        return CouponUnitItem(**unit)
+
+    def claimReservedUnit(self, unit: CouponUnitItem, owner: str, userId: str) -> bool:
+        """
+        Claim a unit reserved by owner
+
+        Args:
+            unit (CouponUnitItem): Reserved unit
+            owner (str): Unique id of the reserving process
+            userId (str): User claiming the unit
+
+        Returns:
+            bool: True if claimed, False if the reservation lapsed or the unit is gone
+        """
+        now = time.time()
+        result = self._inventoryCollection.update_one(
+            {"id": unit.id, "state": "reserved", "reservedBy": owner,
+                "reservedUntil": {"$gt": now}},
+            {"$set": {"state": "claimed", "claimedBy": userId, "claimedAt": now},
+             "$unset": {"reservedBy": "", "reservedUntil": ""}})
+        if result.modified_count == 0:
+            return False
+        self._collection.update_one({"id": unit.rewardId}, {"$inc": {"stock": -1}})
+        return True
+
+    def releaseUnit(self, unit: CouponUnitItem, userId: str) -> bool:
+        """
+        Return a unit claimed by a user to the inventory, e.g. when the purchase failed
+
+        Args:
+            unit (CouponUnitItem): Claimed unit
+            userId (str): User who claimed the unit
+
+        Returns:
+            bool: True if released, False if the unit is not claimed by the user
+        """
+        result = self._inventoryCollection.update_one(
+            {"id": unit.id, "state": "claimed", "claimedBy": userId},
+            {"$set": {"state": "available"}, "$unset": {"claimedBy": "", "claimedAt": ""}})
+        if result.modified_count == 0:
+            return False
+        self._collection.update_one({"id": unit.rewardId}, {"$inc": {"stock": 1}})
+        return True
+
+    def releaseReservations(self, owner: str) -> int:
+        """
+        Make every unit reserved by owner available again
+
+        Args:
+            owner (str): Unique id of the reserving process
+
+        Returns:
+            int: Number of released units
+        """
+        result = self._inventoryCollection.update_many(
+            {"state": "reserved", "reservedBy": owner},
+            {"$set": {"state": "available"}, "$unset": {"reservedBy": "", "reservedUntil": ""}})
+        return result.modified_count
@@ -1,22 +1,131 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
 from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
 from pymongo.database import Database
+from pymongo.errors import BulkWriteError
 
-from core.model import UserItem
+from core.model import LeaderboardEntry, PointLedgerItem, UserItem
 from core.repo import UserRepository
+from util.fields import partialModel, projection
+from util.leaderboard import Leaderboard
+from util.optimistic import VersionConflictError
 
 
 class UserMongoRepo(UserRepository):
     """
     Implementation of UserRepository interface for MongoDB
+
+    Points are never written to the user document directly. Every credit and
+    debit is appended to the pointLedger collection, and the point stored on
+    the user is a snapshot up to the ledger entry pointSnapshotAt. Balances are
+    the snapshot plus the entries after it; compactPointLedger moves the
+    snapshots forward.
     """
 
-    def __init__(self, db: Database):
+    # Order of the leaderboard, served by the point index
+    RANK_SORT = [("point", DESCENDING), ("id", ASCENDING)]
+    RANK_PROJECTION = {"_id": 0, "id": 1, "username": 1, "thumbnailId": 1,
+                       "point": 1, "pointSnapshotAt": 1}
+    # Ledger entries younger than this are left to the next compaction, so
+    # entries still being inserted by other workers are never skipped
+    LEDGER_SETTLE_SECONDS = 60
+    # Fields kept elsewhere, never written by updateUser: the point ledger and the coupons' owner index
+    EXTERNAL_FIELDS = {"point", "couponList"}
+    # Width of the point ranges users are counted in, for ranks outside the board
+    RANK_BUCKET_POINTS = 100
+    # Most users counted one by one within a bucket; ranks deeper into a crowded bucket are capped
+    RANK_BUCKET_SCAN_LIMIT = 10_000
+
+    def __init__(self, db: Database, leaderboardSize: int = 100):
         super().__init__()
         self._db = db
 
         if self._db.get_collection("users") is None:
             self._db.create_collection("users")
         self._collection = db["users"]
+        self._collection.create_index(self.RANK_SORT)
+        self._collection.update_many(
+            {"version": {"$exists": False}}, {"$set": {"version": 0}})
+        self._leaderboard = Leaderboard(leaderboardSize)
+
+        if self._db.get_collection("pointLedger") is None:
+            self._db.create_collection("pointLedger")
+        self._ledgerCollection = db["pointLedger"]
+        self._ledgerCollection.create_index(
+            [("userId", ASCENDING), ("_id", ASCENDING)])
+        self._ledgerCollection.create_index(
+            [("key", ASCENDING)], unique=True, partialFilterExpression={"key": {"$type": "string"}})
+        # Where the next compaction starts, shared by whichever worker runs it
+        self._ledgerStateCollection = db["pointLedgerState"]
+
+        # Number of users per point bucket of their snapshot, moved with $inc as snapshots change
+        self._rankBucketCollection = db["pointRankBuckets"]
+        self._migrateRankBuckets()
+
+    def _migrateRankBuckets(self):
+        """
+        Count the users per point bucket once, when the counters do not exist yet
+        """
+        if self._rankBucketCollection.count_documents({}, limit=1) > 0:
+            return
+        self._collection.aggregate([
+            {"$group": {
+                "_id": {"$toLong": {"$floor": {"$divide": [
+                    {"$ifNull": ["$point", 0]}, self.RANK_BUCKET_POINTS]}}},
+                "users": {"$sum": 1},
+            }},
+            {"$merge": {"into": "pointRankBuckets",
+                        "whenMatched": "keepExisting", "whenNotMatched": "insert"}},
+        ])
+
+    def _moveRankBucket(self, oldPoint: int = None, newPoint: int = None):
+        """
+        Move a user between point buckets when its snapshot point is created, changed or removed
+        """
+        oldBucket = None if oldPoint is None else oldPoint // self.RANK_BUCKET_POINTS
+        newBucket = None if newPoint is None else newPoint // self.RANK_BUCKET_POINTS
+        if oldBucket == newBucket:
+            return
+        updates = []
+        if oldBucket is not None:
+            updates.append(UpdateOne({"_id": oldBucket}, {"$inc": {"users": -1}}))
+        if newBucket is not None:
+            updates.append(UpdateOne({"_id": newBucket}, {"$inc": {"users": 1}}, upsert=True))
+        self._rankBucketCollection.bulk_write(updates, ordered=False)
+
+    @staticmethod
+    def _pendingFilter(user: dict) -> dict:
+        """
+        Filter of the ledger entries of a user not folded into the snapshot
+        """
+        pending = {"userId": user["id"]}
+        if user.get("pointSnapshotAt") is not None:
+            pending["_id"] = {"$gt": user["pointSnapshotAt"]}
+        return pending
+
+    def _applyPending(self, users: list[dict]):
+        """
+        Turn the point snapshot of user documents into their balance
+        """
+        if not users:
+            return
+        pending = self._ledgerCollection.aggregate([
+            {"$match": {"$or": [self._pendingFilter(user) for user in users]}},
+            {"$group": {"_id": "$userId", "amount": {"$sum": "$amount"}}},
+        ])
+        amounts = {entry["_id"]: entry["amount"] for entry in pending}
+        for user in users:
+            # An overdrawn debit is visible until its reversal is appended
+            user["point"] = max(0, user.get("point", 0) + amounts.get(user["id"], 0))
+
+    def _append(self, userId: str, amount: int, reason: str, refId: str = None) -> ObjectId:
+        entry = PointLedgerItem(userId=userId, amount=amount, reason=reason,
+                                refId=refId, timestamp=int(time.time()))
+        result = self._ledgerCollection.insert_one(entry.model_dump(exclude={"id"}))
+        return result.inserted_id
 
     def createUser(self, userItem: UserItem) -> UserItem:
         """
@@ -31,58 +140,86 @@ class UserMongoRepo(UserRepository):
         Returns:
             UserItem: UserItem object
         """
-        self._collection.insert_one(userItem.model_dump())
+        userItem.version = 0
+        self._collection.insert_one(userItem.model_dump(exclude={"couponList"}))
+        self._moveRankBucket(newPoint=userItem.point)
 
-        user = self._collection.find_one({"id": userItem.id})
+        user = self.getUser(userItem.id)
         if user:
-            return UserItem(**user)
+            self._leaderboard.update(user)
+            return user
         else:
             raise HTTPException(
                 status_code=500, detail="Failed to create user")
 
-    def getUser(self, userId: str) -> UserItem:
+    def getUser(self, userId: str, fields: frozenset[str] = None) -> UserItem:
         """
         Get a user by id
 
         Args:
             userId (str): User id
+            fields (frozenset[str]): Only load these fields if given
 
         Returns:
-            UserItem: UserItem object
+            UserItem: UserItem object, trimmed to fields if given
         """
-        user = self._collection.find_one({"id": userId})
-        if user:
-            return UserItem(**user)
-        else:
+        if fields is not None and "point" in fields:
+            fields = fields | {"pointSnapshotAt"}
+        user = self._collection.find_one({"id": userId}, projection(fields))
+        if not user:
             return None
+        if fields is None or "point" in fields:
+            self._applyPending([user])
+        if fields is not None:
+            return partialModel(UserItem, fields - {"pointSnapshotAt"})(**user)
+        return UserItem(**user)
+
+    def getUsers(self, userIds: list[str]) -> list[UserItem]:
+        """
+        Get many users by id in one query
+
+        Args:
+            userIds (list[str]): User ids
+
+        Returns:
+            list[UserItem]: Found users, in no particular order
+        """
+        if not userIds:
+            return []
+        users = list(self._collection.find({"id": {"$in": list(userIds)}}))
+        self._applyPending(users)
+        return [UserItem(**user) for user in users]
 
     def updateUser(self, userItem: UserItem) -> UserItem:
         """
-        Update a user
+        Update a user if it is still at userItem.version, and bump the version.
+        The point is left untouched; use addPoints and spendPoints.
+        Coupons belong to their owner through CouponRepository.
 
         Args:
             userItem (UserItem): UserItem object
 
         Raises:
-            HTTPException(status_code=500): If failed to update user
+            HTTPException(status_code=404): If the user is not found
+            VersionConflictError: If the user was modified since it was read
 
         Returns:
             UserItem: UserItem object
         """
-        self._collection.update_one(
-            {"id": userItem.id}, {"$set": userItem.model_dump()})
-
-        user = self._collection.find_one({"id": userItem.id})
-        if not user:
-            raise HTTPException(
-                status_code=500, detail="Failed to update user")
+        user = self._collection.find_one_and_update(
+            {"id": userItem.id, "version": userItem.version},
+            {"$set": userItem.model_dump(exclude=self.EXTERNAL_FIELDS | {"version"}),
+             "$inc": {"version": 1}},
+            return_document=ReturnDocument.AFTER)
+        if user is None:
+            if self._collection.count_documents({"id": userItem.id}, limit=1) == 0:
+                raise HTTPException(status_code=404, detail="User not found")
+            raise VersionConflictError("User was modified concurrently, please retry")
 
+        self._applyPending([user])
         newUser = UserItem(**user)
-        if newUser == userItem:
-            return newUser
-        else:
-            raise HTTPException(
-                status_code=500, detail="Failed to update user")
+        self._leaderboard.update(newUser)
+        return newUser
 
     def deleteUser(self, userId: str) -> bool:
         """
@@ -94,5 +231,235 @@ class UserMongoRepo(UserRepository):
         Returns:
             bool: True if user is deleted, False otherwise
         """
-        result = self._collection.delete_one({"id": userId})
-        return result.deleted_count > 0
+        user = self._collection.find_one_and_delete({"id": userId}, {"point": 1})
+        self._leaderboard.remove(userId)
+        if user is None:
+            return False
+        self._moveRankBucket(oldPoint=user.get("point", 0))
+        return True
+
+    def addSettlementPoints(self, settlementId: str, points: dict[str, int]) -> int:
+        """
+        Add points to many users at once, at most once per settlement
+
+        Args:
+            settlementId (str): Id of the settlement, users already paid by it are skipped
+            points (dict[str, int]): Points to add by user id
+
+        Returns:
+            int: Number of users paid
+        """
+        if not points:
+            return 0
+
+        # Users paid before settlements went through the ledger
+        paid = {user["id"] for user in self._collection.find(
+            {"id": {"$in": list(points)}, "settlements": settlementId}, {"id": 1})}
+        now = int(time.time())
+        entries = [dict(PointLedgerItem(userId=userId, amount=point, reason="settlement",
+                                        refId=settlementId, timestamp=now).model_dump(exclude={"id"}),
+                        key=f"{settlementId}:{userId}")
+                   for userId, point in points.items() if userId not in paid]
+        if not entries:
+            return 0
+
+        try:
+            inserted = len(self._ledgerCollection.insert_many(
+                entries, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            # Duplicate keys are users already paid by this settlement, anything else is a failure
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])) \
+                    or e.details.get("writeConcernErrors"):
+                raise
+            inserted = e.details["nInserted"]
+
+        for user in self.getUsers(list(points)):
+            self._leaderboard.update(user)
+        return inserted
+
+    def addPoints(self, userId: str, amount: int, reason: str, refId: str = None) -> int:
+        """
+        Credit points to a user with a ledger append
+
+        Args:
+            userId (str): User id
+            amount (int): Points to add
+            reason (str): Why the points are added, e.g. "adReward"
+            refId (str): Id of the related item if any
+
+        Returns:
+            int: Balance of the user after the credit
+        """
+        self._append(userId, amount, reason, refId)
+        user = self.getUser(userId)
+        self._leaderboard.update(user)
+        return user.point
+
+    def spendPoints(self, userId: str, amount: int, reason: str, refId: str = None) -> bool:
+        """
+        Debit points from a user with a ledger append. The debit is appended
+        first and reversed if it overdraws the balance, so concurrent debits
+        never spend the same points twice.
+
+        Args:
+            userId (str): User id
+            amount (int): Points to spend
+            reason (str): Why the points are spent, e.g. "rewardPurchase"
+            refId (str): Id of the related item if any
+
+        Returns:
+            bool: True if the points were spent, False if the balance is too low
+        """
+        user = self._collection.find_one(
+            {"id": userId}, {"id": 1, "point": 1, "pointSnapshotAt": 1})
+        if not user:
+            return False
+
+        debitId = self._append(userId, -amount, reason, refId)
+        pending = self._ledgerCollection.aggregate([
+            {"$match": self._pendingFilter(user)},
+            {"$group": {"_id": None, "amount": {"$sum": "$amount"}}},
+        ])
+        balance = user.get("point", 0) + sum(entry["amount"] for entry in pending)
+        if balance < 0:
+            self._append(userId, amount, "reversal", str(debitId))
+            return False
+
+        self._leaderboard.update(self.getUser(userId))
+        return True
+
+    def getPointHistory(self, userId: str, offset: int = 0, limit: int = 20) -> list[PointLedgerItem]:
+        """
+        Get a page of the point credits and debits of a user, newest first
+
+        Args:
+            userId (str): User id
+            offset (int): Number of entries to skip
+            limit (int): Maximum number of entries
+
+        Returns:
+            list[PointLedgerItem]: Ledger entries
+        """
+        entries = self._ledgerCollection.find({"userId": userId}).sort(
+            "_id", DESCENDING).skip(offset).limit(limit)
+        return [PointLedgerItem(id=str(entry.pop("_id")), **entry) for entry in entries]
+
+    def compactPointLedger(self) -> int:
+        """
+        Fold ledger entries older than LEDGER_SETTLE_SECONDS into the snapshots.
+        Each snapshot moves with a conditional update on its previous marker,
+        so concurrent or repeated compactions never fold an entry twice.
+
+        Returns:
+            int: Number of users whose snapshot was updated
+        """
+        until = ObjectId.from_datetime(
+            datetime.now(timezone.utc) - timedelta(seconds=self.LEDGER_SETTLE_SECONDS))
+        window = {"$lt": until}
+        state = self._ledgerStateCollection.find_one({"_id": "compaction"})
+        if state is not None:
+            window["$gte"] = state["resumeFrom"]
+
+        # Never move past entries of users that were skipped, so they are folded next time
+        resumeFrom = until
+        compacted = 0
+        for userId in self._ledgerCollection.distinct("userId", {"_id": window}):
+            user = self._collection.find_one(
+                {"id": userId}, {"id": 1, "point": 1, "pointSnapshotAt": 1})
+            if not user:
+                continue
+            marker = user.get("pointSnapshotAt")
+            if marker is not None and marker >= until:
+                continue
+
+            entries = self._pendingFilter(user)
+            entries["_id"] = dict(entries.get("_id", {}), **{"$lt": until})
+            folded = list(self._ledgerCollection.find(entries, {"amount": 1}).sort("_id", ASCENDING))
+            if not folded:
+                continue
+            amount = sum(entry["amount"] for entry in folded)
+            if user.get("point", 0) + amount >= 0:
+                result = self._collection.update_one(
+                    {"id": userId, "pointSnapshotAt": marker},
+                    {"$inc": {"point": amount}, "$set": {"pointSnapshotAt": until}})
+                if result.modified_count > 0:
+                    self._moveRankBucket(user.get("point", 0), user.get("point", 0) + amount)
+                    compacted += 1
+                    continue
+            # Overdrawn without its reversal yet, or the snapshot moved meanwhile
+            resumeFrom = min(resumeFrom, folded[0]["_id"])
+
+        self._ledgerStateCollection.update_one(
+            {"_id": "compaction"}, {"$set": {"resumeFrom": resumeFrom}}, upsert=True)
+        return compacted
+
+    def getLeaderboard(self, limit: int) -> list[LeaderboardEntry]:
+        """
+        Get the users with the most points from the in-memory board
+
+        Args:
+            limit (int): Maximum number of entries, at most the board size
+
+        Returns:
+            list[LeaderboardEntry]: Entries ordered by rank
+        """
+        if self._leaderboard.stale:
+            self.reloadLeaderboard()
+        return self._leaderboard.top(limit)
+
+    def getUserRank(self, userId: str) -> LeaderboardEntry:
+        """
+        Get the rank of a user. Users on the board are answered from memory,
+        others from the per-bucket user counters: every bucket above the user's
+        is summed, and only the users ahead within its own bucket are counted on
+        the point index. That count stops at RANK_BUCKET_SCAN_LIMIT, so a user
+        deeper than that into a crowded bucket gets a capped rank, placed
+        above its actual one.
+
+        Args:
+            userId (str): User id
+
+        Returns:
+            LeaderboardEntry: Entry of the user, None if the user is not found
+        """
+        if self._leaderboard.stale:
+            self.reloadLeaderboard()
+        entry = self._leaderboard.rank(userId)
+        if entry is not None:
+            return entry
+
+        user = self._collection.find_one({"id": userId}, self.RANK_PROJECTION)
+        if not user:
+            return None
+        # The user is ranked by the balance shown; the others by their snapshots on the
+        # index, which trail their balances by at most one compaction
+        snapshotBucket = user.get("point", 0) // self.RANK_BUCKET_POINTS
+        self._applyPending([user])
+        bucket = user["point"] // self.RANK_BUCKET_POINTS
+
+        above = self._rankBucketCollection.aggregate([
+            {"$match": {"_id": {"$gt": bucket}}},
+            {"$group": {"_id": None, "users": {"$sum": "$users"}}},
+        ])
+        ahead = sum(counter["users"] for counter in above)
+        if snapshotBucket > bucket:
+            # The user's own snapshot is counted in a bucket above its balance
+            ahead -= 1
+        ahead += self._collection.count_documents({
+            "id": {"$ne": userId},
+            "point": {"$gte": bucket * self.RANK_BUCKET_POINTS,
+                      "$lt": (bucket + 1) * self.RANK_BUCKET_POINTS},
+            "$or": [
+                {"point": {"$gt": user["point"]}},
+                {"point": user["point"], "id": {"$lt": userId}},
+            ]}, limit=self.RANK_BUCKET_SCAN_LIMIT)
+        return LeaderboardEntry(rank=max(0, ahead) + 1, **user)
+
+    def reloadLeaderboard(self):
+        """
+        Rebuild the leaderboard from the top of the point index
+        """
+        users = list(self._collection.find({}, self.RANK_PROJECTION).sort(
+            self.RANK_SORT).limit(self._leaderboard.size))
+        self._applyPending(users)
+        self._leaderboard.load([UserItem(**user) for user in users])
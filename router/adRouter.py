@@ -2,13 +2,15 @@ from fastapi import APIRouter, HTTPException, Request
 
 from core.repo import UserRepository
 from util import adVerifier
+from util.ssvQueue import SSVQueue
 
 
 class AdRouter(APIRouter):
-    def __init__(self, userRepo: UserRepository, adVerifier: adVerifier):
+    def __init__(self, userRepo: UserRepository, adVerifier: adVerifier, ssvQueue: SSVQueue = None):
         super().__init__(prefix="/ssv")
         self._userRepo = userRepo
         self._adVerifier = adVerifier
+        self._ssvQueue = ssvQueue
 
         self.add_api_route(
             path="/verify", endpoint=self._verifySSV, methods=["POST", "GET"])
@@ -17,9 +19,20 @@ class AdRouter(APIRouter):
         """
         Verify the AdMob SSV
         This is a route for Google Admob Server-Side Verification (SSV) callback.
+        With an SSVQueue the callback is acknowledged once queued and verified in the background.
         """
         # TODO: Add reverse DNS from Google
         query_params = request.query_params
+
+        if self._ssvQueue is not None:
+            if not SSVQueue.validate(query_params):
+                raise HTTPException(status_code=400, detail="Bad Request")
+            if not self._ssvQueue.enqueue(dict(query_params)):
+                # AdMob retries callbacks that do not return 200
+                raise HTTPException(
+                    status_code=503, detail="Service Unavailable")
+            return {"status": "accepted"}
+
         key_id = query_params.get("key_id")
         signature = query_params.get("signature")
 
@@ -32,10 +45,9 @@ class AdRouter(APIRouter):
         if not self._userRepo.getUser(userId):
             raise HTTPException(status_code=404, detail="User not found")
 
-        message = "&".join([f"{k}={v}" for k, v in sorted(
-            query_params.items(), key=lambda x: x[0]) if k not in ["key_id", "signature"]])
+        message = self._adVerifier.build_ssv_message(query_params)
 
-        if not self._adVerifier.verify_admob_ssv(message, key_id, signature):
+        if not await self._adVerifier.verify_admob_ssv_async(message, key_id, signature):
             raise HTTPException(status_code=401, detail="Unauthorized")
 
         log = dict(
@@ -0,0 +1,121 @@
+import asyncio
+import base64
+import json
+import logging
+from urllib.parse import unquote, urlsplit
+
+from fastapi import APIRouter, HTTPException, Request
+
+from core.model import BatchRequest, BatchRequestItem, BatchResponseItem
+from util.authParser import AuthParser
+
+logger = logging.getLogger(__name__)
+
+
+class BatchRouter(APIRouter):
+    """
+    BatchRouter class
+
+    This class is a router class for running several GET requests in one round trip.
+    Sub-requests are dispatched to the app in process and run concurrently.
+    They reuse the authentication of the batch request instead of verifying
+    the token again.
+    """
+
+    # Class Constants
+    BATCH_REQUEST_LIMIT = 20
+    API_PREFIX = "/api/"
+    # Headers describing the batch request body, not the sub-requests
+    BODY_HEADERS = {b"content-length", b"content-type", b"transfer-encoding"}
+
+    def __init__(self):
+        super().__init__(prefix="/batch")
+
+        self.add_api_route(path="", endpoint=self._batch, methods=["POST"])
+
+    async def _batch(self, batchRequest: BatchRequest, request: Request) -> list[BatchResponseItem]:
+        """
+        Run GET requests to the API and return their responses in order
+
+        Args:
+            batchRequest (BatchRequest): The sub-requests, each a path under /api with an optional query
+            request (Request): The request object
+
+        Raises:
+            HTTPException(status_code=400): If there are too many sub-requests
+            HTTPException(status_code=401): If the user is not authenticated
+
+        Returns:
+            list[BatchResponseItem]: Status and body of each sub-request, in request order
+        """
+        if not request.state.auth:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not 0 < len(batchRequest.requests) <= self.BATCH_REQUEST_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return await asyncio.gather(*[self._dispatch(item, request) for item in batchRequest.requests])
+
+    async def _dispatch(self, item: BatchRequestItem, request: Request) -> BatchResponseItem:
+        """
+        Run one sub-request through the app
+        """
+        url = urlsplit(item.path)
+        # Validate the decoded path the app routes on, so encoding cannot slip past the checks
+        path = unquote(url.path)
+        if url.scheme or url.netloc or not path.startswith(self.API_PREFIX) \
+                or path.rstrip("/") == self.API_PREFIX + "batch":
+            return BatchResponseItem(id=item.id, status=400, contentType="application/json",
+                                     body={"message": "Invalid path"})
+
+        scope = {
+            "type": "http",
+            "asgi": request.scope.get("asgi", {"version": "3.0"}),
+            "http_version": request.scope.get("http_version", "1.1"),
+            "method": "GET",
+            "scheme": request.scope.get("scheme", "http"),
+            "server": request.scope.get("server"),
+            "client": request.scope.get("client"),
+            "root_path": request.scope.get("root_path", ""),
+            "path": path,
+            "raw_path": url.path.encode(),
+            "query_string": url.query.encode(),
+            "headers": [(name, value) for name, value in request.scope["headers"]
+                        if name not in self.BODY_HEADERS],
+            "state": dict(),
+            AuthParser.PRESET_AUTH_KEY: request.state.auth,
+        }
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        status = 500
+        headers: dict[bytes, bytes] = dict()
+        chunks: list[bytes] = []
+
+        async def send(message: dict):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers.update(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        try:
+            await request.app(scope, receive, send)
+        except Exception:
+            # A failing sub-request must not fail the rest of the batch
+            logger.exception("Batch sub-request %s failed", path)
+            return BatchResponseItem(id=item.id, status=500, contentType="application/json",
+                                     body={"message": "Internal Server Error"})
+
+        body = b"".join(chunks)
+        contentType = headers.get(b"content-type", b"").decode() or None
+        if not body:
+            return BatchResponseItem(id=item.id, status=status, contentType=contentType)
+        if contentType and contentType.startswith("application/json"):
+            return BatchResponseItem(id=item.id, status=status, contentType=contentType,
+                                     body=json.loads(body))
+        return BatchResponseItem(id=item.id, status=status, contentType=contentType,
+                                 body=base64.b64encode(body).decode(), encoding="base64")
@@ -1,10 +1,16 @@
-import math
 from datetime import datetime
 
 from fastapi import APIRouter, HTTPException, Request
 
-from core.model import ChallengeItem, ChallengeRecordItem, UserItemMeta, ItemState
+from core.model import ChallengeItem, ChallengeItemMeta, ChallengeRecordItem, ItemState
 from core.repo import ChallengeRepository, FileRepository, UserRepository
+from util.dataLoader import UserLoader
+from util.deadlineScheduler import ChallengeDeadlineScheduler
+from util.fields import parseFields
+from util.idempotency import IdempotencyGuard, idempotent
+from util.optimistic import OptimisticRetry
+from util.singleFlight import SingleFlight, coalesced
+from util.settlement import ChallengeSettlement
 
 
 class ChallengeRouter(APIRouter):
@@ -16,29 +22,62 @@ class ChallengeRouter(APIRouter):
 
     # Class constarnts
     CHALLENGE_PARTICIPATE_POINT = 500
-    CHALLENGE_REWARD_BASE_POINT = CHALLENGE_PARTICIPATE_POINT + 100
-    CHALLENGE_REWARD_ADDITIONAL_POINT = 2000
-
-    def __init__(self, userRepo: UserRepository, challengeRepo: ChallengeRepository, fileRepo: FileRepository):
+    CHALLENGE_REWARD_BASE_POINT = ChallengeSettlement.REWARD_BASE_POINT
+    CHALLENGE_REWARD_ADDITIONAL_POINT = ChallengeSettlement.REWARD_ADDITIONAL_POINT
+    RECORD_PAGE_LIMIT = 100
+
+    def __init__(self, userRepo: UserRepository, challengeRepo: ChallengeRepository, fileRepo: FileRepository,
+                 settlement: ChallengeSettlement, deadlineScheduler: ChallengeDeadlineScheduler = None,
+                 idempotency: IdempotencyGuard = None, optimisticRetry: OptimisticRetry = None,
+                 singleFlight: SingleFlight = None):
         super().__init__(prefix="/challenge")
         self._userRepo = userRepo
         self._challengeRepo = challengeRepo
         self._fileRepo = fileRepo
+        self._settlement = settlement
+        self._deadlineScheduler = deadlineScheduler
+        self._optimisticRetry = optimisticRetry or OptimisticRetry()
 
         self.add_api_route(
             path="/create", endpoint=self._createChallenge, methods=["POST"])
         self.add_api_route(
             path="/all", endpoint=self._getAllChallenges, methods=["GET"])
+        self.add_api_route(
+            path="/my", endpoint=self._getMyChallenges, methods=["GET"])
+        # Concurrent requests for a hot challenge share one response
         self.add_api_route(path="/{challengeId}",
-                           endpoint=self._getChallenge, methods=["GET"])
+                           endpoint=coalesced(singleFlight, self._getChallenge,
+                                              lambda challengeId, fields=None, **_: ("challenge", challengeId, "response", fields)),
+                           methods=["GET"])
         self.add_api_route(path="/{challengeId}/participate",
-                           endpoint=self._participateChallenge, methods=["POST"])
+                           endpoint=idempotent(idempotency, self._participateChallenge), methods=["POST"])
         self.add_api_route(path="/{challengeId}/add/{imageId}",
                            endpoint=self._addChallengeRecord, methods=["POST"])
+        self.add_api_route(path="/{challengeId}/records",
+                           endpoint=self._getChallengeRecords, methods=["GET"])
         self.add_api_route(path="/{challengeId}/record/{recordId}/approve",
                            endpoint=self._changeRecordState, methods=["PUT"])
         self.add_api_route(path="/{challengeId}/clear", endpoint=self._getChallengePoint, methods=["GET"])
 
+    def _scheduleDeadline(self, challenge: ChallengeItem):
+        """
+        Keep the deadline scheduler in sync with a created or updated challenge
+        """
+        if self._deadlineScheduler is None:
+            return
+        if challenge.state in (ItemState.PENDING, ItemState.ACTIVE):
+            self._deadlineScheduler.schedule(challenge.id, challenge.dateEndAt)
+        else:
+            self._deadlineScheduler.cancel(challenge.id)
+
+    def _resolveParticipants(self, challenge: ChallengeItem, request: Request) -> ChallengeItem:
+        """
+        Fill the participant profiles of a challenge from its participant ids
+        """
+        challenge.participants = UserLoader.fromRequest(
+            request, self._userRepo).loadMany(challenge.participantIds)
+        return challenge
+
     def _createChallenge(self, challengeItem: ChallengeItem, request: Request) -> ChallengeItem:
         """
         Create a new challenge
@@ -64,18 +103,17 @@ class ChallengeRouter(APIRouter):
         if user is None:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if user.point < self.CHALLENGE_PARTICIPATE_POINT:
+        if not self._userRepo.spendPoints(userId, self.CHALLENGE_PARTICIPATE_POINT, "challengeCreate"):
             raise HTTPException(
                 status_code=400, detail="Not enough point to create the challenge")
-        user.point -= self.CHALLENGE_PARTICIPATE_POINT
-        self._userRepo.updateUser(user)
 
-        challengeItem.participants = [UserItemMeta(
-            id=userId, username=user.username, thumbnailId=user.thumbnailId)]
         challengeItem.currentParticipants = 1
         challengeItem = self._challengeRepo.createChallenge(challengeItem)
+        self._challengeRepo.addParticipant(challengeItem.id, userId)
+        challengeItem.participantIds = [userId]
+        self._scheduleDeadline(challengeItem)
 
-        return challengeItem
+        return self._resolveParticipants(challengeItem, request)
 
     def _getAllChallenges(self):
         """
@@ -86,25 +124,72 @@ class ChallengeRouter(APIRouter):
         """
         return self._challengeRepo.getAllChallenges()
 
-    def _getChallenge(self, challengeId: str):
+    def _getMyChallenges(self, request: Request) -> list[ChallengeItemMeta]:
+        """
+        Get the challenges the user participates in
+
+        Args:
+            request (Request): The request object
+
+        Raises:
+            HTTPException(status_code=401): If the user is not authenticated
+
+        Returns:
+            list[ChallengeItemMeta]: The challenges, most recently joined first
+        """
+        if request.state.auth is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        return self._challengeRepo.getChallengesForUser(request.state.auth["sub"])
+
+    def _getChallenge(self, challengeId: str, request: Request, fields: str = None):
         """
         Get the challenge with challengeId
 
         Args:
             challengeId (str): The challengeId to get the challenge
+            request (Request): The request object
+            fields (str): Comma separated fields to return, all fields if not given
 
         Raises:
+            HTTPException(status_code=400): If a field does not exist
             HTTPException(status_code=404): If the challenge is not found
 
         Returns:
-            ChallengeItem: The challenge
+            ChallengeItem: The challenge, trimmed to fields if given
         """
-        challenge = self._challengeRepo.getChallenge(challengeId)
+        fieldSet = parseFields(ChallengeItem, fields)
+        challenge = self._challengeRepo.getChallenge(challengeId, fieldSet)
         if challenge is None:
             raise HTTPException(status_code=404, detail="Challenge not found")
 
+        if fieldSet is None or "participants" in fieldSet:
+            challenge = self._resolveParticipants(challenge, request)
         return challenge
 
+    def _getChallengeRecords(self, challengeId: str, userId: str = None, offset: int = 0, limit: int = 20) -> list[ChallengeRecordItem]:
+        """
+        Get a page of the records of the challenge with challengeId, oldest first
+
+        Args:
+            challengeId (str): The challengeId to get the records
+            userId (str): Only records of this user if given
+            offset (int): The number of records to skip
+            limit (int): The maximum number of records, up to RECORD_PAGE_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If offset or limit is out of range
+
+        Returns:
+            list[ChallengeRecordItem]: The page of records
+        """
+        if offset < 0 or not 0 < limit <= self.RECORD_PAGE_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return self._challengeRepo.getRecords(challengeId, userId, offset, limit)
+
     def _participateChallenge(self, challengeId: str, request: Request) -> ChallengeItem:
         """
         Participate the challenge with challengeId
@@ -119,6 +204,7 @@ class ChallengeRouter(APIRouter):
             HTTPException(status_code=401): If the user is not authenticated
             HTTPException(status_code=404): If the user is not found
             HTTPException(status_code=404): If the challenge is not found
+            HTTPException(status_code=409): If the challenge kept being modified concurrently
 
         Returns:
             ChallengeItem: The participated challenge
@@ -143,24 +229,48 @@ class ChallengeRouter(APIRouter):
             raise HTTPException(
                 status_code=400, detail="Challenge is not active")
 
-        if userId in challenge.participants:
-            raise HTTPException(
-                status_code=400, detail="Already participated in the challenge")
-
         if user.point < self.CHALLENGE_PARTICIPATE_POINT:
             raise HTTPException(
                 status_code=400, detail="Not enough point to participate in the challenge")
-        user.point -= self.CHALLENGE_PARTICIPATE_POINT
 
-        challenge.currentParticipants += 1
-        challenge.participants.append(UserItemMeta(
-            id=userId, username=user.username, thumbnailId=user.thumbnailId))
-        self._userRepo.updateUser(user)
-        self._challengeRepo.updateChallenge(challenge)
-
-        return challenge
+        # The unique participant index rejects concurrent duplicate joins
+        if not self._challengeRepo.addParticipant(challengeId, userId):
+            raise HTTPException(
+                status_code=400, detail="Already participated in the challenge")
+        if not self._userRepo.spendPoints(userId, self.CHALLENGE_PARTICIPATE_POINT, "challengeParticipate", challengeId):
+            self._challengeRepo.removeParticipant(challengeId, userId)
+            raise HTTPException(
+                status_code=400, detail="Not enough point to participate in the challenge")
 
-    def _addChallengeRecord(self, challengeId: str, imageId: str, request: Request) -> ChallengeItem:
+        def countParticipant(current: ChallengeItem) -> ChallengeItem:
+            # A reloaded challenge may have been filled, closed or deleted meanwhile
+            if current is None:
+                raise HTTPException(status_code=404, detail="Challenge not found")
+            if current.currentParticipants >= current.totalParticipants:
+                raise HTTPException(
+                    status_code=400, detail="Challenge is already full")
+            if not current.state == ItemState.ACTIVE:
+                raise HTTPException(
+                    status_code=400, detail="Challenge is not active")
+            current.currentParticipants += 1
+            if userId not in current.participantIds:
+                current.participantIds.append(userId)
+            return self._challengeRepo.updateChallenge(current)
+
+        try:
+            challenge = self._optimisticRetry.run(
+                "participateChallenge", lambda: self._challengeRepo.getChallenge(challengeId),
+                countParticipant, challenge)
+        except Exception:
+            self._challengeRepo.removeParticipant(challengeId, userId)
+            self._userRepo.addPoints(
+                userId, self.CHALLENGE_PARTICIPATE_POINT, "refund", challengeId)
+            raise
+        self._scheduleDeadline(challenge)
+
+        return self._resolveParticipants(challenge, request)
+
+    def _addChallengeRecord(self, challengeId: str, imageId: str, request: Request) -> ChallengeRecordItem:
         """
         Approve the challenge record with challengeId and imageId
 
@@ -175,7 +285,7 @@ class ChallengeRouter(APIRouter):
             HTTPException(status_code=404): If the image is not found
 
         Returns:
-            ChallengeItem: The approved challenge
+            ChallengeRecordItem: The added record
         """
         if request.state.auth is None:
             raise HTTPException(status_code=401, detail="Unauthorized")
@@ -191,27 +301,18 @@ class ChallengeRouter(APIRouter):
         if challenge is None:
             raise HTTPException(status_code=404, detail="Challenge not found")
 
-        isParticipant = False
-        for participant in challenge.participants:
-            if participant.id == userId:
-                isParticipant = True
-                break
-        if not isParticipant:
+        if not self._challengeRepo.isParticipant(challengeId, userId):
             raise HTTPException(status_code=401, detail="Unauthorized")
 
         file = self._fileRepo.getFile(imageId)
         if file is None:
             raise HTTPException(status_code=404, detail="Image not found")
 
-        recordId = str(0 if not challenge.participantRecords else int(challenge.participantRecords[-1].id) + 1)
         challengeRecord = ChallengeRecordItem(
-            id=str(recordId), userId=userId, imageId=imageId, date=str(datetime.now()))
-        challenge.participantRecords.append(challengeRecord)
-        challenge = self._challengeRepo.updateChallenge(challenge)
+            id='', challengeId=challengeId, userId=userId, imageId=imageId, date=str(datetime.now()))
+        return self._challengeRepo.addRecord(challengeRecord)
 
-        return challenge
-
-    def _changeRecordState(self, challengeId: str, recordId: str, request: Request, approve: bool = True) -> ChallengeItem:
+    def _changeRecordState(self, challengeId: str, recordId: str, request: Request, approve: bool = True) -> ChallengeRecordItem:
         """
         Change the record state with challengeId and recordId
 
@@ -227,7 +328,7 @@ class ChallengeRouter(APIRouter):
             HTTPException(status_code=404): If the record is not found
 
         Returns:
-            ChallengeItem: The updated challenge
+            ChallengeRecordItem: The updated record
         """
         if request.state.auth is None:
             raise HTTPException(status_code=401, detail="Unauthorized")
@@ -242,27 +343,20 @@ class ChallengeRouter(APIRouter):
         challenge = self._challengeRepo.getChallenge(challengeId)
         if challenge is None:
             raise HTTPException(status_code=404, detail="Challenge not found")
-        isParticipant = False
-        for participant in challenge.participants:
-            if participant.id == userId:
-                isParticipant = True
-                break
-        if not isParticipant:
+        if not self._challengeRepo.isParticipant(challengeId, userId):
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-        record = next(
-            (record for record in challenge.participantRecords if record.id == recordId), None)
+        record = self._challengeRepo.setRecordApproval(
+            challengeId, recordId, approve)
         if record is None:
             raise HTTPException(status_code=404, detail="Record not found")
 
-        record.approved = approve
-        challenge = self._challengeRepo.updateChallenge(challenge)
-
-        return challenge
+        return record
 
     def _getChallengePoint(self, challengeId: str, userId: str, request: Request) -> ChallengeItem:
         """
-        Get the challenge point with challengeId and userId
+        Settle the rewards of the finished challenge with challengeId.
+        Rewards of all participants are paid at once; settling again has no effect.
 
         Args:
             challengeId (str): The challengeId to get the point
@@ -275,7 +369,7 @@ class ChallengeRouter(APIRouter):
             HTTPException(status_code=404): If the challenge is not found
 
         Returns:
-            ChallengeItem: The challenge with the point
+            ChallengeItem: The settled challenge
         """
         if request.state.auth is None:
             raise HTTPException(status_code=401, detail="Unauthorized")
@@ -293,23 +387,11 @@ class ChallengeRouter(APIRouter):
             raise HTTPException(
                 status_code=400, detail="Challenge is not finished yet")
 
-        isParticipant = False
-        for participant in challenge.participants:
-            if participant.id == userId:
-                isParticipant = True
-                break
-        if not isParticipant:
+        if not self._challengeRepo.isParticipant(challengeId, userId):
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-        totalPoint = self.CHALLENGE_REWARD_BASE_POINT
-        userRecordCount = len(list(filter(lambda record: record.userId == userId, challenge.participantRecords)))
-        totalPoint += math.floor(self.CHALLENGE_REWARD_ADDITIONAL_POINT * (userRecordCount / len(challenge.participantRecords)))
+        if not challenge.settled:
+            self._settlement.settleChallenge(challengeId)
+            challenge = self._challengeRepo.getChallenge(challengeId)
 
-        user.point += totalPoint
-        self._userRepo.updateUser(user)
-
-        challenge.currentParticipants -= 1
-        if challenge.currentParticipants == 0:
-            challenge.state = ItemState.INACTIVE
-
-        return challenge
+        return self._resolveParticipants(challenge, request)
@@ -1,8 +1,12 @@
+import time
+
 from fastapi import APIRouter, HTTPException, Request
 
-from core.model import DonationItem, ItemState
+from core.model import DonationItem, DonationParticipationItem, DonorTotalItem, ItemState
 from core.repo import DonationRepository, UserRepository
 from util.adVerifier import AdVerifier
+from util.dataLoader import UserLoader
+from util.idempotency import IdempotencyGuard, idempotent
 
 
 class DonationRouter(APIRouter):
@@ -14,8 +18,10 @@ class DonationRouter(APIRouter):
 
     # Class Constants
     DONATION_TOTAL_POINT = 100
+    DONOR_PAGE_LIMIT = 100
 
-    def __init__(self, userRepo: UserRepository, donationRepo: DonationRepository, adVerifier: AdVerifier, adminId: list[str]):
+    def __init__(self, userRepo: UserRepository, donationRepo: DonationRepository, adVerifier: AdVerifier, adminId: list[str],
+                 idempotency: IdempotencyGuard = None):
         super().__init__(prefix="/donation")
         self._userRepo = userRepo
         self._donationRepo = donationRepo
@@ -26,12 +32,16 @@ class DonationRouter(APIRouter):
             path="/create", endpoint=self._createDonation, methods=["POST"])
         self.add_api_route(
             path="/all", endpoint=self._getAllDonations, methods=["GET"])
+        self.add_api_route(
+            path="/my", endpoint=self._getMyDonations, methods=["GET"])
         self.add_api_route(path="/{donationId}",
                            endpoint=self._getDonation, methods=["GET"])
+        self.add_api_route(path="/{donationId}/top",
+                           endpoint=self._getTopDonors, methods=["GET"])
         self.add_api_route(path="/{donationId}/update",
                            endpoint=self._updateDonation, methods=["PUT"])
         self.add_api_route(path="/{donationId}/participate/{userId}",
-                           endpoint=self._participateDonation, methods=["POST"])
+                           endpoint=idempotent(idempotency, self._participateDonation), methods=["POST"])
         self.add_api_route(
             path="/{donationId}/delete", endpoint=self._deleteDonation, methods=["DELETE"])
 
@@ -70,6 +80,57 @@ class DonationRouter(APIRouter):
         """
         return self._donationRepo.getAllDonations()
 
+    def _getMyDonations(self, request: Request, offset: int = 0, limit: int = 20) -> list[DonorTotalItem]:
+        """
+        Get a page of the donations the user participated in, with the points given to each
+
+        Args:
+            request (Request): The request object
+            offset (int): The number of donations to skip
+            limit (int): The maximum number of donations, up to DONOR_PAGE_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If offset or limit is out of range
+            HTTPException(status_code=401): If the user is not authenticated
+
+        Returns:
+            list[DonorTotalItem]: The totals of the user, most recently donated first
+        """
+        if request.state.auth is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if offset < 0 or not 0 < limit <= self.DONOR_PAGE_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return self._donationRepo.getDonorTotals(request.state.auth["sub"], offset, limit)
+
+    def _getTopDonors(self, donationId: str, request: Request, limit: int = 10) -> list[DonorTotalItem]:
+        """
+        Get the donors who gave the most points to the donation with donationId
+
+        Args:
+            donationId (str): The donationId to get the donors
+            request (Request): The request object
+            limit (int): The maximum number of donors, up to DONOR_PAGE_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If limit is out of range
+
+        Returns:
+            list[DonorTotalItem]: The totals of the donors with their profiles, most points first
+        """
+        if not 0 < limit <= self.DONOR_PAGE_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        donors = self._donationRepo.getTopDonors(donationId, limit)
+        users = UserLoader.fromRequest(request, self._userRepo).loadMany(
+            [donor.userId for donor in donors])
+        users = {user.id: user for user in users}
+        for donor in donors:
+            donor.user = users.get(donor.userId)
+        return donors
+
     def _getDonation(self, donationId: str):
         """
         Get the donation with donationId
@@ -153,13 +214,13 @@ class DonationRouter(APIRouter):
 
         restPoint = max(0, point - rewardPoint)
 
-        user.point += rewardPoint
-        donation.totalPoint += restPoint
-        donation.participants.append(userId)
+        self._userRepo.addPoints(userId, rewardPoint, "donationReward", donationId)
+        if restPoint:
+            self._donationRepo.addDonationPoints(donationId, restPoint)
+            self._donationRepo.addParticipation(DonationParticipationItem(
+                donationId=donationId, userId=userId, points=restPoint, timestamp=int(time.time())))
 
-        self._userRepo.updateUser(user)
-        donation = self._donationRepo.updateDonation(donation)
-        return donation
+        return self._donationRepo.getDonation(donationId)
 
     def _deleteDonation(self, donationId: str, request: Request):
         """
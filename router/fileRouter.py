@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException, Request, Response, UploadFile
 
-from core.model import FileData
+from core.model import FileBatchItem, FileData
 from core.repo import FileRepository, UserRepository
 
 
@@ -11,12 +11,18 @@ class FileRouter(APIRouter):
     This class is a router class for file-related API endpoints.
     """
 
+    # Class Constants
+    FILE_BATCH_LIMIT = 50
+    INLINE_SIZE_LIMIT = 64 * 1024
+
     def __init__(self, userRepo: UserRepository, fileRepo: FileRepository):
         super().__init__(prefix="/file")
         self._userRepo = userRepo
         self._fileRepo = fileRepo
 
         self.add_api_route('/create', self._createFile, methods=['POST'])
+        # Registered before /{fileId}, which would otherwise match it
+        self.add_api_route('/batch', self._getFiles, methods=['GET'])
         self.add_api_route('/{fileId}', self._getFile, methods=['GET'])
         self.add_api_route('/update/{fileId}',
                            self._updateFile, methods=['PUT'])
@@ -83,6 +89,46 @@ class FileRouter(APIRouter):
 
         return Response(content=file.file, media_type=file.contentType)
 
+    def _getFiles(self, ids: str, request: Request, inline: bool = False,
+                  inlineSize: int = INLINE_SIZE_LIMIT) -> list[FileBatchItem]:
+        """
+        Get the metadata of many files, and the content of small ones if inline is set
+
+        Args:
+            ids (str): Comma separated IDs of the files, up to FILE_BATCH_LIMIT
+            request (Request): The request object
+            inline (bool): Include the base64 encoded content of small files
+            inlineSize (int): Largest file size in bytes to inline, up to INLINE_SIZE_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If there are too many IDs or inlineSize is out of range
+            HTTPException(status_code=403): If the user is not authenticated
+
+        Returns:
+            list[FileBatchItem]: The files in the order of ids, skipping missing files
+                and private files of other users
+        """
+        if not request.state.auth:
+            raise HTTPException(status_code=403, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        fileIds = list(dict.fromkeys(
+            fileId.strip() for fileId in ids.split(",") if fileId.strip()))
+        if not 0 < len(fileIds) <= self.FILE_BATCH_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+        if not 0 < inlineSize <= self.INLINE_SIZE_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        user = self._userRepo.getUser(request.state.auth.get("sub"), frozenset({"id"}))
+        if not user:
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        files = {file.id: file for file in self._fileRepo.getFiles(
+            fileIds, inlineSize if inline else 0)}
+        return [files[fileId] for fileId in fileIds
+                if fileId in files and (not files[fileId].isPrivate or files[fileId].owner == user.id)]
+
     def _updateFile(self, fileId: str, file: UploadFile, request: Request) -> FileData:
         """
         Update a file
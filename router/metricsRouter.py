@@ -0,0 +1,53 @@
+from typing import Callable
+
+from fastapi import APIRouter, HTTPException, Request
+
+
+class MetricsRouter(APIRouter):
+    """
+    MetricsRouter class
+
+    This class is a router class for exposing internal metrics to admins.
+    """
+
+    def __init__(self, adminId: list[str]):
+        super().__init__(prefix="/metrics")
+        self._adminId = adminId
+        self._providers: dict[str, Callable[[], dict]] = dict()
+
+        self.add_api_route(path="", endpoint=self._getMetrics, methods=["GET"])
+
+    def register(self, name: str, provider: Callable[[], dict]):
+        """
+        Register a metrics provider
+
+        Args:
+            name (str): Name of the metrics group
+            provider (Callable[[], dict]): Function returning the current metrics
+        """
+        self._providers[name] = provider
+
+    def _getMetrics(self, request: Request) -> dict:
+        """
+        Get all registered metrics
+
+        Args:
+            request (Request): The request object
+
+        Raises:
+            HTTPException(status_code=401): If the user is not authenticated
+            HTTPException(status_code=403): If the user is not an admin
+
+        Returns:
+            dict: Metrics by group name
+        """
+        if not request.state.auth:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        userId = request.state.auth.get("sub")
+        if not userId in self._adminId:
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+        return {name: provider() for name, provider in self._providers.items()}
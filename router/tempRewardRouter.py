@@ -1,17 +1,16 @@
 import datetime
-import random
+import logging
 
+from bson import ObjectId
 from fastapi import APIRouter, HTTPException, Request
 
-from core.model import CouponItem, CouponItemMeta, RewardItem, RewardItemMeta
+from core.model import CouponItem, CouponUnitItem, RewardItem, RewardItemMeta
 from core.repo import (CouponRepository, FileRepository, RewardRepository,
                        UserRepository)
+from util.couponPrefetcher import CouponPrefetcher
+from util.idempotency import IdempotencyGuard, idempotent
 
-coupon_bugger = ['6744a8355885bfc26714aa32', '6744a861d3331dac07b19577', '6744a86cd3331dac07b19579',
-                 '6744a86cd3331dac07b19579', '6744a881d3331dac07b1957d', '6744a889d3331dac07b1957f', '6744a891d3331dac07b19581']
-coupon_chicken = ['6744a89c7f333de2df997e7b', '6744a8a47f333de2df997e7d']
-coupon_coffee = ['6744a8ad7f333de2df997e7f',
-                 '6744a8b57f333de2df997e81', '6744a8bd7f333de2df997e83']
+logger = logging.getLogger(__name__)
 
 
 class RewardRouter(APIRouter):
@@ -22,13 +21,15 @@ class RewardRouter(APIRouter):
     This class will be exchanged when gift coupon API is available.
     """
 
-    def __init__(self, userRepo: UserRepository, rewardRepo: RewardRepository, couponRepo: CouponRepository, fileRepo: FileRepository, adminId: list[str]):
+    def __init__(self, userRepo: UserRepository, rewardRepo: RewardRepository, couponRepo: CouponRepository, fileRepo: FileRepository, adminId: list[str],
+                 couponPrefetcher: CouponPrefetcher = None, idempotency: IdempotencyGuard = None):
         super().__init__(prefix="/reward")
         self._userRepo = userRepo
         self._rewardRepo = rewardRepo
         self._couponRepo = couponRepo
         self._fileRepo = fileRepo
         self._adminId = adminId
+        self._couponPrefetcher = couponPrefetcher
 
         self.add_api_route(
             methods=["POST"], path="/create", endpoint=self._createReward)
@@ -41,7 +42,9 @@ class RewardRouter(APIRouter):
         self.add_api_route(
             methods=["DELETE"], path="/delete/{rewardId}", endpoint=self.deleteReward)
         self.add_api_route(
-            methods=["POST"], path="/purchase/{rewardId}", endpoint=self.purchaseReward)
+            methods=["POST"], path="/{rewardId}/inventory", endpoint=self.addInventory)
+        self.add_api_route(
+            methods=["POST"], path="/purchase/{rewardId}", endpoint=idempotent(idempotency, self.purchaseReward))
         self.add_api_route(
             methods=["POST"], path="/extend/{couponId}", endpoint=self.extendExpiration)
         self.add_api_route(
@@ -150,6 +153,46 @@ class RewardRouter(APIRouter):
 
         return self._rewardRepo.deleteReward(rewardId)
 
+    def addInventory(self, rewardId: str, couponIds: list[str], request: Request) -> RewardItem:
+        """
+        Add coupon units to the inventory of a reward
+
+        Args:
+            rewardId (str): The rewardId to stock
+            couponIds (list[str]): The coupon image ids, each handed out once
+            request (Request): The request object
+
+        Raises:
+            HTTPException(status_code=401): If the user is not authorized
+            HTTPException(status_code=403): If the user is not an admin
+            HTTPException(status_code=404): If the reward is not found
+
+        Returns:
+            RewardItem: The reward with its updated stock
+        """
+        if not request.state.auth:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        userId = request.state.auth.get("sub")
+        if not userId in self._adminId:
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+        if not self._rewardRepo.getReward(rewardId):
+            raise HTTPException(status_code=404, detail="Reward not found")
+
+        self._rewardRepo.addInventory(rewardId, couponIds)
+        return self._rewardRepo.getReward(rewardId)
+
+    def _claimCoupon(self, rewardId: str, userId: str) -> CouponUnitItem:
+        """
+        Claim a coupon unit of the reward, None if out of stock
+        """
+        if self._couponPrefetcher is not None:
+            return self._couponPrefetcher.claim(rewardId, userId)
+        return self._rewardRepo.claimUnit(rewardId, userId)
+
     def purchaseReward(self, rewardId: str, request: Request) -> CouponItem:
         """
         Purchase a reward item and add it to the user's coupon list
@@ -160,7 +203,9 @@ class RewardRouter(APIRouter):
 
         Raises:
             HTTPException(status_code=400): If the user does not have enough points
+            HTTPException(status_code=400): If the reward is out of stock
             HTTPException(status_code=401): If the user is not authorized
+            HTTPException(status_code=404): If the reward is not found
 
         Returns:
             CouponItem: The purchased coupon item
@@ -174,39 +219,41 @@ class RewardRouter(APIRouter):
         if not self._userRepo.getUser(userId):
             raise HTTPException(status_code=404, detail="User not found")
 
-        user = self._userRepo.getUser(userId)
-
         reward = self._rewardRepo.getReward(rewardId)
-        if user.point < reward.price:
+        if not reward:
+            raise HTTPException(status_code=404, detail="Reward not found")
+        if reward.stock <= 0:
+            raise HTTPException(status_code=400, detail="Out of stock")
+
+        # Resolve everything that can fail before debiting the user
+        unit = self._claimCoupon(rewardId, userId)
+        if unit is None:
+            raise HTTPException(status_code=400, detail="Out of stock")
+        if not self._userRepo.spendPoints(userId, reward.price, "rewardPurchase", rewardId):
+            self._rewardRepo.releaseUnit(unit, userId)
             raise HTTPException(status_code=400, detail="Not enough point")
 
-        if reward.itemType == '햄버거':
-            couponId = random.choice(coupon_bugger)
-        elif reward.itemType == '치킨':
-            couponId = random.choice(coupon_chicken)
-        elif reward.itemType == '커피':
-            couponId = random.choice(coupon_coffee)
+        # Known up front so a coupon inserted before a failure can be removed
+        coupon = CouponItem(
+            id=str(ObjectId()),
+            itemName=reward.itemName,
+            brandName=reward.brandName,
+            description=reward.description,
+            thumbnailId=unit.couponId,
+            couponId=unit.couponId,
+            ownerId=userId,
+            expiredAt=str(
+                int((datetime.datetime.now() + datetime.timedelta(days=7)).timestamp()))
+        )
         try:
-            coupon = CouponItem(
-                id='',
-                itemName=reward.itemName,
-                brandName=reward.brandName,
-                description=reward.description,
-                thumbnailId=couponId,
-                couponId=couponId,
-                expiredAt=str(
-                    int((datetime.datetime.now() + datetime.timedelta(days=7)).timestamp()))
-            )
-            coupon = self._couponRepo.createCoupon(coupon)
-
-            user.couponList.append(CouponItemMeta(**coupon.model_dump()))
-            user.point -= reward.price
-            user = self._userRepo.updateUser(user)
-
-            return coupon
-        except Exception as e:
+            return self._couponRepo.createCoupon(coupon)
+        except Exception:
+            logger.exception("Failed to create coupon for reward %s", rewardId)
+            self._couponRepo.deleteCoupon(coupon.id)
+            self._rewardRepo.releaseUnit(unit, userId)
+            self._userRepo.addPoints(userId, reward.price, "refund", rewardId)
             raise HTTPException(
-                status_code=500, detail="Failed to purchase reward, " + str(e))
+                status_code=500, detail="Failed to purchase reward")
 
     def extendExpiration(self, couponId: str, request: Request) -> CouponItem:
         """
@@ -234,10 +281,10 @@ class RewardRouter(APIRouter):
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if not next((coupon for coupon in user.couponList if coupon.id == couponId), None):
+        coupon = self._couponRepo.getCoupon(couponId)
+        if not coupon or coupon.ownerId != userId:
             raise HTTPException(status_code=400, detail="Coupon not found")
 
-        coupon = self._couponRepo.getCoupon(couponId)
         coupon.expiredAt = str(int((datetime.datetime.fromtimestamp(
             int(coupon.expiredAt)) + datetime.timedelta(days=7)).timestamp()))
         coupon = self._couponRepo.updateCoupon(coupon)
@@ -270,7 +317,8 @@ class RewardRouter(APIRouter):
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if not next((coupon for coupon in user.couponList if coupon.id == couponId), None):
+        coupon = self._couponRepo.getCoupon(couponId)
+        if not coupon or coupon.ownerId != userId:
             raise HTTPException(status_code=400, detail="Coupon not found")
 
         return self._couponRepo.deleteCoupon(couponId)
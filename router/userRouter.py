@@ -1,8 +1,10 @@
 from fastapi import APIRouter, HTTPException, Request
 
-from core.model import UserItem
-from core.repo import UserRepository
+from core.model import CouponItemMeta, CouponPage, LeaderboardEntry, PointLedgerItem, UserItem
+from core.repo import CouponRepository, UserRepository
 from util.adVerifier import AdVerifier
+from util.fields import parseFields
+from util.optimistic import OptimisticRetry
 from util.signVerifier import verifySignature
 
 
@@ -14,20 +16,36 @@ class UserRouter(APIRouter):
     """
 
     # Class Constants
+    LEADERBOARD_LIMIT = 100
+    POINT_HISTORY_LIMIT = 100
+    PROFILE_COUPON_LIMIT = 20
+    COUPON_PAGE_LIMIT = 100
 
-    def __init__(self, userRepo: UserRepository, adVerifier: AdVerifier):
+    def __init__(self, userRepo: UserRepository, adVerifier: AdVerifier, couponRepo: CouponRepository,
+                 optimisticRetry: OptimisticRetry = None):
         super().__init__(prefix="/user")
         self._userRepo = userRepo
         self._adVerifier = adVerifier
+        self._couponRepo = couponRepo
+        self._optimisticRetry = optimisticRetry or OptimisticRetry()
 
         self.add_api_route(
             path="/register", endpoint=self._register, methods=["POST"])
         self.add_api_route(
-            path="/profile/{userId}", endpoint=self._getProfile, methods=["GET"])
+            path="/leaderboard", endpoint=self._getLeaderboard, methods=["GET"])
+        self.add_api_route(
+            path="/leaderboard/me", endpoint=self._getMyRank, methods=["GET"])
+        # Sparse profiles do not match UserItem, so the response is not validated against it
+        self.add_api_route(
+            path="/profile/{userId}", endpoint=self._getProfile, methods=["GET"], response_model=None)
         self.add_api_route(
             path="/profile", endpoint=self._updateProfile, methods=["PUT"])
         self.add_api_route(
             path='/point', endpoint=self._addPoint, methods=["POST"])
+        self.add_api_route(
+            path='/point/history', endpoint=self._getPointHistory, methods=["GET"])
+        self.add_api_route(
+            path="/coupons", endpoint=self._getCoupons, methods=["GET"])
         self.add_api_route(
             path="/delete/{userId}", endpoint=self._deleteUser, methods=["DELETE"])
 
@@ -58,20 +76,65 @@ class UserRouter(APIRouter):
 
         return user
 
-    def _getProfile(self, userId: str, request: Request) -> UserItem:
+    def _getLeaderboard(self, limit: int = 10) -> list[LeaderboardEntry]:
+        """
+        Get the users with the most points
+
+        Args:
+            limit (int): The number of entries, up to LEADERBOARD_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If limit is out of range
+
+        Returns:
+            list[LeaderboardEntry]: The entries ordered by rank
+        """
+        if not 0 < limit <= self.LEADERBOARD_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return self._userRepo.getLeaderboard(limit)
+
+    def _getMyRank(self, request: Request) -> LeaderboardEntry:
+        """
+        Get the rank of the user
+
+        Args:
+            request (Request): The request object
+
+        Raises:
+            HTTPException(status_code=401): If the user is not authenticated
+            HTTPException(status_code=404): If the user is not found
+
+        Returns:
+            LeaderboardEntry: The entry of the user
+        """
+        if request.state.auth is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+        entry = self._userRepo.getUserRank(request.state.auth["sub"])
+        if entry is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        return entry
+
+    def _getProfile(self, userId: str, request: Request, fields: str = None) -> UserItem:
         """
         Get the user profile with userId
 
         Args:
             userId (str): The userId to get the profile
             request (Request): The request object
+            fields (str): Comma separated fields to return, all fields if not given
 
         Raises:
+            HTTPException(status_code=400): If a field does not exist
             HTTPException(status_code=401): If the user is not authenticated
             HTTPException(status_code=404): If the user is not found
 
         Returns:
-            UserItem: The user profile
+            UserItem: The user profile, trimmed to fields if given
         """
         if request.state.auth is None:
             raise HTTPException(status_code=401, detail="Unauthorized")
@@ -80,16 +143,56 @@ class UserRouter(APIRouter):
         if request.state.auth["sub"] != userId:
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-        user = self._userRepo.getUser(userId)
+        fieldSet = parseFields(UserItem, fields)
+        user = self._userRepo.getUser(userId, fieldSet)
 
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
+        if fieldSet is None or "couponList" in fieldSet:
+            user = self._fillCoupons(user)
+        return user
+
+    def _fillCoupons(self, user: UserItem) -> UserItem:
+        """
+        Fill the coupon list of a profile with the first page of active coupons
+        """
+        page = self._couponRepo.listForUser(
+            user.id, activeOnly=True, limit=self.PROFILE_COUPON_LIMIT)
+        user.couponList = [CouponItemMeta(**coupon.model_dump())
+                           for coupon in page.items]
         return user
 
+    def _getCoupons(self, request: Request, activeOnly: bool = True, cursor: str = None, limit: int = 20) -> CouponPage:
+        """
+        Get a page of the coupons of the user, newest first
+
+        Args:
+            request (Request): The request object
+            activeOnly (bool): Skip expired coupons
+            cursor (str): The nextCursor of the previous page
+            limit (int): The maximum number of coupons, up to COUPON_PAGE_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If limit is out of range
+            HTTPException(status_code=401): If the user is not authenticated
+
+        Returns:
+            CouponPage: The coupons and the cursor of the next page
+        """
+        if request.state.auth is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not 0 < limit <= self.COUPON_PAGE_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return self._couponRepo.listForUser(request.state.auth["sub"], activeOnly, cursor, limit)
+
     def _updateProfile(self, userItem: UserItem, request: Request) -> UserItem:
         """
-        Update the user profile with userItem
+        Update the user profile with userItem. If userItem carries a version, the update
+        only applies to that version; otherwise it applies to the latest one.
 
         Args:
             userItem (UserItem): The userItem to update
@@ -99,6 +202,7 @@ class UserRouter(APIRouter):
             HTTPException(status_code=400): If the userItem is invalid
             HTTPException(status_code=401): If the user is not authenticated
             HTTPException(status_code=404): If the user is not found
+            HTTPException(status_code=409): If the profile was modified concurrently
 
         Returns:
             UserItem: The updated user profile
@@ -108,16 +212,24 @@ class UserRouter(APIRouter):
         if not request.state.auth.get("sub"):
             raise HTTPException(status_code=401, detail="Unauthorized")
 
-        user = self._getProfile(request.state.auth["sub"], request)
+        userId = request.state.auth["sub"]
+        user = self._userRepo.getUser(userId)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        if not user.couponList == userItem.couponList:
-            raise HTTPException(status_code=400, detail="Bad Request")
-
-        user = self._userRepo.updateUser(userItem)
-
-        return user
+        userItem.id = userId
+        if "version" in userItem.model_fields_set:
+            # The client edited a version it read; never overwrite a newer one
+            user = self._optimisticRetry.run(
+                "updateProfile", None, self._userRepo.updateUser, userItem, attempts=1)
+        else:
+            user = self._optimisticRetry.run(
+                "updateProfile", lambda: self._userRepo.getUser(userId),
+                lambda current: self._userRepo.updateUser(
+                    userItem.model_copy(update={"version": current.version})),
+                user)
+
+        return self._fillCoupons(user)
 
     async def _addPoint(self, request: Request, point: int, itemId: str, signature: str) -> UserItem:
         """
@@ -139,10 +251,34 @@ class UserRouter(APIRouter):
         if not verifySignature(message, "secret", signature):
             raise HTTPException(status_code=400, detail="Bad Request")
 
-        user.point += point
-        user = self._userRepo.updateUser(user)
+        self._userRepo.addPoints(userId, point, "flag", itemId)
 
-        return user
+        return self._userRepo.getUser(userId)
+
+    def _getPointHistory(self, request: Request, offset: int = 0, limit: int = 20) -> list[PointLedgerItem]:
+        """
+        Get a page of the point credits and debits of the user, newest first
+
+        Args:
+            request (Request): The request object
+            offset (int): The number of entries to skip
+            limit (int): The maximum number of entries, up to POINT_HISTORY_LIMIT
+
+        Raises:
+            HTTPException(status_code=400): If offset or limit is out of range
+            HTTPException(status_code=401): If the user is not authenticated
+
+        Returns:
+            list[PointLedgerItem]: The ledger entries
+        """
+        if request.state.auth is None:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if not request.state.auth.get("sub"):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+        if offset < 0 or not 0 < limit <= self.POINT_HISTORY_LIMIT:
+            raise HTTPException(status_code=400, detail="Bad Request")
+
+        return self._userRepo.getPointHistory(request.state.auth["sub"], offset, limit)
 
     def _deleteUser(self, userId: str, request: Request) -> bool:
         """
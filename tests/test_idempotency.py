@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException, Request
+
+from repo.idempotencyMemory import IdempotencyMemoryRepo
+from util.idempotency import IdempotencyGuard
+
+
+def makeRequest(key: str = "key-1", query: str = "", sub: str = "user-1") -> Request:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/reward/purchase",
+        "query_string": query.encode(),
+        "headers": [(b"idempotency-key", key.encode())],
+        "state": {"auth": {"sub": sub}},
+    }
+    return Request(scope, receive)
+
+
+def makeGuard(**kwargs):
+    calls = []
+
+    async def endpoint(request: Request, delay: float = 0, status: int = 0):
+        calls.append(request.url.query)
+        await asyncio.sleep(delay)
+        if status:
+            raise HTTPException(status_code=status, detail="failed")
+        return {"count": len(calls)}
+
+    guard = IdempotencyGuard(IdempotencyMemoryRepo(), **kwargs)
+    return guard, guard.wrap(endpoint), calls
+
+
+def test_retry_replays_stored_response():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        first = await endpoint(request=makeRequest())
+        second = await endpoint(request=makeRequest())
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == {"count": 1}
+    assert second.headers[IdempotencyGuard.REPLAY_HEADER] == "true"
+    assert second.body == b'{"count":1}'
+    assert len(calls) == 1
+
+
+def test_keys_are_scoped_by_user():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        await endpoint(request=makeRequest(sub="user-1"))
+        await endpoint(request=makeRequest(sub="user-2"))
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_concurrent_duplicates_share_one_call():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        return await asyncio.gather(*[endpoint(request=makeRequest(), delay=0.05) for _ in range(5)])
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert guard.metrics()["coalesced"] == 4
+    assert results[0] == {"count": 1}
+
+
+def test_reused_key_with_different_request_is_rejected():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        await endpoint(request=makeRequest(query="rewardId=a"))
+        await endpoint(request=makeRequest(query="rewardId=b"))
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(run())
+    assert e.value.status_code == 422
+    assert calls == ["rewardId=a"]
+
+
+def test_client_errors_are_replayed():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(HTTPException) as e:
+                await endpoint(request=makeRequest(), status=400)
+            assert e.value.status_code == 400
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("status", [409, 500])
+def test_conflicts_and_server_errors_release_the_key(status):
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        with pytest.raises(HTTPException):
+            await endpoint(request=makeRequest(), status=status)
+        return await endpoint(request=makeRequest())
+
+    assert asyncio.run(run()) == {"count": 2}
+    assert len(calls) == 2
+
+
+def test_slow_handler_keeps_its_reservation():
+    guard, endpoint, calls = makeGuard(pendingTtl=0.1)
+    repo = guard._idempotencyRepo
+
+    async def run():
+        task = asyncio.create_task(endpoint(request=makeRequest(), delay=0.35))
+        await asyncio.sleep(0.25)
+        scopedKey = next(iter(repo._records))
+        # A duplicate from another worker finds the reservation still held
+        pending = repo.reserveKey(scopedKey, "", 0.1)
+        return pending, await task
+
+    pending, result = asyncio.run(run())
+    assert pending is not None and not pending.done
+    assert result == {"count": 1}
+    assert len(calls) == 1
+
+
+def test_requests_without_key_run_every_time():
+    guard, endpoint, calls = makeGuard()
+
+    async def run():
+        request = makeRequest()
+        request.scope["headers"] = []
+        await endpoint(request=request)
+        await endpoint(request=request)
+
+    asyncio.run(run())
+    assert len(calls) == 2
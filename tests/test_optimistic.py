@@ -0,0 +1,58 @@
+import pytest
+
+from util.optimistic import OptimisticRetry, VersionConflictError
+
+
+def makeModify(conflicts: int):
+    seen = []
+
+    def modify(document):
+        seen.append(document)
+        if len(seen) <= conflicts:
+            raise VersionConflictError()
+        return document
+
+    return modify, seen
+
+
+def test_retries_with_reloaded_document():
+    retry = OptimisticRetry(attempts=3, backoff=0)
+    versions = iter(range(2, 10))
+    modify, seen = makeModify(conflicts=2)
+
+    assert retry.run("update", load=lambda: next(versions), modify=modify, current=1) == 3
+    assert seen == [1, 2, 3]
+    assert retry.metrics() == dict(conflicts={"update": 2}, exhausted=dict())
+
+
+def test_raises_conflict_after_last_attempt():
+    retry = OptimisticRetry(attempts=2, backoff=0)
+    modify, seen = makeModify(conflicts=5)
+
+    with pytest.raises(VersionConflictError) as e:
+        retry.run("update", load=lambda: 0, modify=modify)
+    assert e.value.status_code == 409
+    assert len(seen) == 2
+    assert retry.metrics()["exhausted"] == {"update": 1}
+
+
+def test_single_attempt_only_counts_conflict():
+    retry = OptimisticRetry(attempts=3, backoff=0)
+    modify, seen = makeModify(conflicts=1)
+
+    with pytest.raises(VersionConflictError):
+        retry.run("update", load=lambda: 0, modify=modify, attempts=1)
+    assert len(seen) == 1
+
+
+def test_other_errors_are_not_retried():
+    retry = OptimisticRetry(attempts=3, backoff=0)
+    calls = []
+
+    def modify(document):
+        calls.append(document)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        retry.run("update", load=lambda: 0, modify=modify)
+    assert len(calls) == 1
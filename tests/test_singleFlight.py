@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.routing import APIRoute
+
+from util.singleFlight import SingleFlight, coalesced
+
+
+def runConcurrently(count: int, func):
+    results = [None] * count
+    barrier = threading.Barrier(count)
+
+    def worker(index: int):
+        barrier.wait()
+        results[index] = func()
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_calls_share_one_result():
+    singleFlight = SingleFlight(window=0)
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return {"value": 1}
+
+    results = runConcurrently(8, lambda: singleFlight.do(("challenge", "a"), load))
+    assert len(calls) == 1
+    assert all(result == {"value": 1} for result in results)
+    assert singleFlight.metrics()["coalesced"] == 7
+
+
+def test_copy_gives_each_caller_its_own_result():
+    singleFlight = SingleFlight(window=1)
+    first = singleFlight.do(("challenge", "a"), lambda: {"value": 1}, copy=dict)
+    first["value"] = 2
+    assert singleFlight.do(("challenge", "a"), lambda: {"value": 3}, copy=dict) == {"value": 1}
+
+
+def test_results_expire_after_window():
+    singleFlight = SingleFlight(window=0.01)
+    singleFlight.do(("challenge", "a"), lambda: 1)
+    assert singleFlight.do(("challenge", "a"), lambda: 2) == 1
+    time.sleep(0.02)
+    assert singleFlight.do(("challenge", "a"), lambda: 3) == 3
+
+
+def test_forget_stops_sharing_by_prefix():
+    singleFlight = SingleFlight(window=1)
+    singleFlight.do(("challenge", "a", "x"), lambda: 1)
+    singleFlight.do(("challenge", "b", "x"), lambda: 1)
+    singleFlight.do(("user", "a"), lambda: 1)
+
+    singleFlight.forget("challenge", "a")
+    assert singleFlight.do(("challenge", "a", "x"), lambda: 2) == 2
+    assert singleFlight.do(("challenge", "b", "x"), lambda: 2) == 1
+
+    singleFlight.forget("challenge")
+    assert singleFlight.do(("challenge", "b", "x"), lambda: 3) == 3
+    assert singleFlight.do(("user", "a"), lambda: 3) == 1
+
+
+def test_errors_are_shared_but_not_kept():
+    singleFlight = SingleFlight(window=1)
+
+    def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        singleFlight.do(("challenge", "a"), fail)
+    assert singleFlight.do(("challenge", "a"), lambda: 1) == 1
+
+
+def test_async_callers_share_one_threadpool_call():
+    singleFlight = SingleFlight(window=0)
+    threads = set()
+
+    def load():
+        threads.add(threading.get_ident())
+        time.sleep(0.05)
+        return b"body"
+
+    async def run():
+        return await asyncio.gather(*[singleFlight.doAsync(("challenge", "a"), load) for _ in range(200)])
+
+    assert asyncio.run(run()) == [b"body"] * 200
+    assert len(threads) == 1
+    assert singleFlight.metrics()["coalesced"] == 199
+    assert singleFlight.metrics()["inflight"] == 0
+
+
+def test_async_call_survives_cancelled_leader():
+    singleFlight = SingleFlight(window=0)
+
+    def load():
+        time.sleep(0.05)
+        return 1
+
+    async def run():
+        leader = asyncio.create_task(singleFlight.doAsync(("challenge", "a"), load))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(singleFlight.doAsync(("challenge", "a"), load))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(run()) == 1
+    assert singleFlight.metrics()["executed"] == 1
+
+
+def test_async_errors_are_shared_but_not_kept():
+    singleFlight = SingleFlight(window=1)
+
+    def fail():
+        raise ValueError("failed")
+
+    async def run():
+        results = await asyncio.gather(*[singleFlight.doAsync(("challenge", "a"), fail) for _ in range(3)],
+                                       return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        return await singleFlight.doAsync(("challenge", "a"), lambda: 1)
+
+    assert asyncio.run(run()) == 1
+
+
+def test_forget_drops_async_results():
+    singleFlight = SingleFlight(window=1)
+
+    async def run():
+        await singleFlight.doAsync(("challenge", "a"), lambda: 1)
+        assert await singleFlight.doAsync(("challenge", "a"), lambda: 2) == 1
+        singleFlight.forget("challenge", "a")
+        return await singleFlight.doAsync(("challenge", "a"), lambda: 3)
+
+    assert asyncio.run(run()) == 3
+
+
+def test_coalesced_endpoint_runs_on_event_loop():
+    def getChallenge(challengeId: str):
+        return {"id": challengeId}
+
+    endpoint = coalesced(SingleFlight(), getChallenge, lambda challengeId, **_: ("challenge", challengeId))
+    app = FastAPI()
+    app.add_api_route("/{challengeId}", endpoint, methods=["GET"])
+    route = next(route for route in app.routes if isinstance(route, APIRoute))
+
+    assert asyncio.iscoroutinefunction(route.dependant.call)
+    assert [param.name for param in route.dependant.path_params] == ["challengeId"]
+    response = asyncio.run(endpoint(challengeId="a"))
+    assert response.body == b'{"id":"a"}'
@@ -1,85 +1,285 @@
 import asyncio
 import base64
+import functools
 import hashlib
 import json
+import logging
+import multiprocessing
+import os
 import time
 import urllib.request
+from concurrent.futures import Executor, ProcessPoolExecutor
 
+from ecdsa.der import UnexpectedDER
 from ecdsa.keys import BadSignatureError, VerifyingKey
 from ecdsa.util import sigdecode_der
 
+from core.model import AdLogItem
+from core.repo import AdLogRepository
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+except ImportError:
+    load_pem_public_key = None
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=32)
+def _load_ecdsa_key(pem: str) -> VerifyingKey:
+    return VerifyingKey.from_pem(pem)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_cryptography_key(pem: str):
+    return load_pem_public_key(pem.encode("utf-8"))
+
+
+def _verify_ecdsa(pem: str, message: bytes, signature: bytes) -> bool:
+    try:
+        return _load_ecdsa_key(pem).verify(signature, message, hashfunc=hashlib.sha256,
+                                           sigdecode=sigdecode_der)
+    except BadSignatureError:
+        return False
+
+
+def _verify_cryptography(pem: str, message: bytes, signature: bytes) -> bool:
+    try:
+        _load_cryptography_key(pem).verify(
+            signature, message, ec.ECDSA(hashes.SHA256()))
+        return True
+    except InvalidSignature:
+        return False
+
+
+SIGNATURE_BACKENDS = {"ecdsa": _verify_ecdsa}
+if load_pem_public_key is not None:
+    SIGNATURE_BACKENDS["cryptography"] = _verify_cryptography
+
+
+def verify_signature(pem: str, message: bytes, signature: bytes, backend: str = "ecdsa") -> bool:
+    """
+    Verify a DER encoded ECDSA-SHA256 signature.
+    Module level so it can run in a process pool; parsed keys are cached per process.
+    """
+    try:
+        return SIGNATURE_BACKENDS[backend](pem, message, signature)
+    except (ValueError, UnexpectedDER):
+        # Malformed DER signature or key
+        return False
+
 
 class AdVerifier:
     ADMOBKEYURL = "https://www.gstatic.com/admob/reward/verifier-keys.json"
+    ADMOB_KEY_TIMEOUT = 10
+    # Minimum seconds between refetches caused by unknown key ids
+    ADMOB_KEY_REFETCH_INTERVAL = 60
 
-    def __init__(self):
+    def __init__(self, ad_log_repo: AdLogRepository, verify_workers: int = 2, backend: str = "auto",
+                 key_snapshot_path: str = ".admob_keys.json"):
+        """
+        Args:
+            ad_log_repo (AdLogRepository): Store for verified ad logs
+            verify_workers (int): Size of the signature verification process pool.
+                0 verifies in the default thread pool instead.
+            backend (str): "ecdsa", "cryptography" or "auto" to prefer cryptography when installed
+            key_snapshot_path (str): File the AdMob key list is persisted to and loaded from at start-up
+        """
         self.admob_key = dict()
-        self.ad_verify_log = []
-        self.lock = asyncio.Lock()
-        self.get_admob_key()
+        self.ad_log_repo = ad_log_repo
 
-    def get_admob_key(self):
-        self.admob_key = dict()
-        response = urllib.request.urlopen(self.ADMOBKEYURL)
+        if backend == "auto":
+            backend = "cryptography" if "cryptography" in SIGNATURE_BACKENDS else "ecdsa"
+        if backend not in SIGNATURE_BACKENDS:
+            raise ValueError(f"Unavailable signature backend: {backend}")
+        self.backend = backend
+
+        self.verify_workers = verify_workers
+        self._executor: Executor = None
+        # Bound callbacks waiting for the pool so bursts queue here, not in the pool
+        self._verify_slots = asyncio.Semaphore(max(1, verify_workers) * 4)
+
+        self.key_snapshot_path = key_snapshot_path
+        self._key_refresh_task: asyncio.Task = None
+        self._key_refreshed_at = 0.0
+
+        # Start from the last persisted key list; the network is only used by refresh_admob_key
+        self.load_key_snapshot()
+
+    def load_key_snapshot(self) -> bool:
+        try:
+            with open(self.key_snapshot_path, "r", encoding="utf-8") as f:
+                keys = json.load(f)
+            self.set_admob_key(keys['keys'])
+            return True
+        except (OSError, ValueError, KeyError):
+            logger.warning("No usable AdMob key snapshot at %s",
+                           self.key_snapshot_path)
+            return False
+
+    def _save_key_snapshot(self, keys: dict):
+        tmp_path = f"{self.key_snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(keys, f)
+        os.replace(tmp_path, self.key_snapshot_path)
+
+    def _fetch_admob_key(self):
+        """
+        Fetch the AdMob key list document. Blocking, run in a thread.
+        """
+        response = urllib.request.urlopen(
+            self.ADMOBKEYURL, timeout=self.ADMOB_KEY_TIMEOUT)
         if response.status != 200:
-            return
+            return None
 
         keys_data = response.read().decode("utf-8")
         if not keys_data:
-            return
+            return None
 
         keys = json.loads(keys_data)
         if not keys or 'keys' not in keys:
-            return
+            return None
+
+        return keys
 
-        for key in keys['keys']:
-            self.admob_key[str(key['keyId'])] = dict(
+    async def _refresh_admob_key(self):
+        try:
+            keys = await asyncio.to_thread(self._fetch_admob_key)
+        except Exception:
+            logger.exception("Failed to refresh AdMob keys")
+            return False
+        finally:
+            self._key_refreshed_at = time.monotonic()
+
+        if not keys:
+            return False
+        try:
+            self.set_admob_key(keys['keys'])
+        except Exception:
+            # Keep the previous keys rather than ending the refresh loop
+            logger.exception("Failed to load refreshed AdMob keys")
+            return False
+
+        # The keys are already in use; a failed snapshot only affects the next start-up
+        try:
+            await asyncio.to_thread(self._save_key_snapshot, keys)
+        except OSError as e:
+            logger.warning("Failed to save AdMob key snapshot to %s: %s",
+                           self.key_snapshot_path, e)
+        return True
+
+    async def refresh_admob_key(self, min_interval: float = 0):
+        """
+        Refresh the AdMob key list. Concurrent callers share one fetch.
+
+        Args:
+            min_interval (float): Skip the fetch if the last one finished less than this many seconds ago
+        """
+        if self._key_refresh_task is None or self._key_refresh_task.done():
+            if time.monotonic() - self._key_refreshed_at < min_interval:
+                return False
+            self._key_refresh_task = asyncio.create_task(
+                self._refresh_admob_key())
+        return await asyncio.shield(self._key_refresh_task)
+
+    async def run_key_refresh(self, interval: float = 60 * 60):
+        """
+        Refresh the AdMob key list periodically, starting immediately
+        """
+        while True:
+            try:
+                await self.refresh_admob_key()
+            except Exception:
+                logger.exception("AdMob key refresh failed")
+            await asyncio.sleep(interval)
+
+    def set_admob_key(self, keys: list[dict]):
+        admob_key = dict()
+        for key in keys:
+            admob_key[str(key['keyId'])] = dict(
                 pem=key['pem'],
                 base64=key['base64']
             )
+            # Parse once here instead of on every callback
+            _load_ecdsa_key(key['pem'])
+        self.admob_key = admob_key
+
+    @staticmethod
+    def build_ssv_message(query_params: dict) -> str:
+        return "&".join([f"{k}={v}" for k, v in sorted(
+            query_params.items(), key=lambda x: x[0]) if k not in ["key_id", "signature"]])
+
+    def _prepare_ssv(self, message: str, key_id: str, signature: str):
+        key = self.admob_key.get(key_id)
+        if key is None:
+            return None
+
+        try:
+            signature = base64.urlsafe_b64decode(
+                signature + '=' * (-len(signature) % 4))
+        except ValueError:
+            return None
+        return key['pem'], message.encode("utf-8"), signature
 
     def verify_admob_ssv(self, message: str, key_id: str, signature: str):
-        if key_id not in self.admob_key:
+        args = self._prepare_ssv(message, key_id, signature)
+        if args is None:
             return False
+        return verify_signature(*args, self.backend)
 
-        key = self.admob_key[key_id]
-        vk = VerifyingKey.from_pem(key['pem'])
-        signature = base64.urlsafe_b64decode(
-            signature + '=' * (4 - len(signature) % 4))
-        message = message.encode("utf-8")
-        try:
-            vk.verify(signature, message, hashfunc=hashlib.sha256,
-                      sigdecode=sigdecode_der)
-            return True
-        except BadSignatureError:
+    async def verify_admob_ssv_async(self, message: str, key_id: str, signature: str):
+        """
+        Verify the SSV signature off the event loop.
+        An unknown key_id triggers a (rate limited) key refetch to pick up rotated keys.
+        """
+        if key_id not in self.admob_key:
+            await self.refresh_admob_key(min_interval=self.ADMOB_KEY_REFETCH_INTERVAL)
+
+        args = self._prepare_ssv(message, key_id, signature)
+        if args is None:
             return False
 
+        if self._executor is None and self.verify_workers > 0:
+            # Forking a process that runs scheduler and prefetch threads can deadlock
+            # the children on locks held at fork time, so start them from a clean server
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.verify_workers, mp_context=multiprocessing.get_context("forkserver"))
+
+        async with self._verify_slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, verify_signature, *args, self.backend)
+
+    def close(self):
+        if self._key_refresh_task is not None:
+            self._key_refresh_task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
     async def add_log(self, log: dict):
+        # The repository may block on the database, keep it off the event loop
         try:
-            async with self.lock:
-                self.ad_verify_log.append(log)
+            await asyncio.to_thread(self.ad_log_repo.addLog, AdLogItem(
+                userId=log["user_id"],
+                rewardAmount=int(log["reward_amount"]),
+                timestamp=int(log["timestamp"]),
+            ))
             return True
         except Exception:
+            logger.exception("Failed to add ad log for user %s", log.get("user_id"))
             return False
 
     async def check_log(self, user_id: str):
-        for i in range(len(self.ad_verify_log)):
-            if self.ad_verify_log[i].get("user_id") == user_id:
-                log = self.ad_verify_log[i]
-                if time.time() - (int(log['timestamp']) / 1000) < 60 * 5:
-                    # TODO: Delete checked log
-                    try:
-                        async with self.lock:
-                            self.ad_verify_log.pop(i)
-                        return int(log['reward_amount'])
-                    except Exception:
-                        return -1
-        return -1
+        log = await asyncio.to_thread(self.ad_log_repo.consumeLog, user_id)
+        if log is None:
+            return -1
+        return log.rewardAmount
 
     def remove_old_log(self):
         try:
-            with self.lock:
-                self.ad_verify_log = [log for log in self.ad_verify_log if time.time() - (int(log['timestamp']) / 1000) < 60 * 5]
+            self.ad_log_repo.removeOldLogs()
             return True
         except Exception:
             return False
@@ -53,10 +53,18 @@ for key in kakao_public_keys:
 
 
 class AuthParser(HTTPBearer):
+    # Scope key carrying the auth of a batch request into its sub-requests.
+    # Scopes are built by the server, so clients cannot set it.
+    PRESET_AUTH_KEY = "eco.batchAuth"
+
     def __init__(self):
         super().__init__()
 
     async def __call__(self, request: Request):
+        if self.PRESET_AUTH_KEY in request.scope:
+            request.state.auth = request.scope[self.PRESET_AUTH_KEY]
+            return
+
         try:
             auth_header = request.headers.get("Authorization")
 
@@ -0,0 +1,113 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+
+from core.model import CouponUnitItem
+from core.repo import RewardRepository
+
+logger = logging.getLogger(__name__)
+
+
+class CouponPrefetcher:
+    """
+    Keeps a few reserved coupon units per reward in memory for fast checkout.
+
+    A purchase claims a buffered unit with one conditional update, or claims
+    straight from the inventory when the buffer is empty. Buffers are refilled
+    in a background thread. Reservations lapse after ttl seconds, so units held
+    by a process that dies become available again.
+    """
+
+    def __init__(self, rewardRepo: RewardRepository, bufferSize: int = 5, ttl: int = 300):
+        self._rewardRepo = rewardRepo
+        self._bufferSize = bufferSize
+        self._ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._buffers: dict[str, deque[tuple[float, CouponUnitItem]]] = dict()
+        self._refilling: set[str] = set()
+        self._lock = threading.Lock()
+
+        self._bufferHits = 0
+        self._bufferMisses = 0
+
+    def claim(self, rewardId: str, userId: str) -> CouponUnitItem:
+        """
+        Claim a coupon unit of a reward for a user
+
+        Args:
+            rewardId (str): Reward ID
+            userId (str): User claiming the unit
+
+        Returns:
+            CouponUnitItem: Claimed unit, or None if out of stock
+        """
+        unit = self._claimBuffered(rewardId, userId)
+        if unit is None:
+            self._bufferMisses += 1
+            unit = self._rewardRepo.claimUnit(rewardId, userId)
+        else:
+            self._bufferHits += 1
+
+        if self._bufferSize > 0:
+            self._startRefill(rewardId)
+        return unit
+
+    def _claimBuffered(self, rewardId: str, userId: str) -> CouponUnitItem:
+        # Leave a margin so a unit is not claimed right as its reservation lapses
+        deadline = time.time() + 1
+        while True:
+            with self._lock:
+                buffer = self._buffers.get(rewardId)
+                if not buffer:
+                    return None
+                reservedUntil, unit = buffer.popleft()
+            if reservedUntil > deadline and self._rewardRepo.claimReservedUnit(unit, self.owner, userId):
+                return unit
+
+    def _startRefill(self, rewardId: str):
+        with self._lock:
+            if rewardId in self._refilling or len(self._buffers.get(rewardId, ())) > self._bufferSize // 2:
+                return
+            self._refilling.add(rewardId)
+        threading.Thread(target=self._refill, args=(rewardId,),
+                         name="coupon-prefetch", daemon=True).start()
+
+    def _refill(self, rewardId: str):
+        try:
+            while True:
+                with self._lock:
+                    if len(self._buffers.get(rewardId, ())) >= self._bufferSize:
+                        return
+                unit = self._rewardRepo.reserveUnit(rewardId, self.owner, self._ttl)
+                if unit is None:
+                    return
+                with self._lock:
+                    self._buffers.setdefault(rewardId, deque()).append(
+                        (time.time() + self._ttl, unit))
+        except Exception:
+            logger.exception("Failed to prefetch coupons of reward %s", rewardId)
+        finally:
+            with self._lock:
+                self._refilling.discard(rewardId)
+
+    def releaseAll(self):
+        """
+        Return every buffered unit to the inventory
+        """
+        with self._lock:
+            self._buffers.clear()
+        self._rewardRepo.releaseReservations(self.owner)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            buffered = {rewardId: len(buffer)
+                        for rewardId, buffer in self._buffers.items()}
+        return dict(
+            buffered=buffered,
+            bufferHits=self._bufferHits,
+            bufferMisses=self._bufferMisses,
+        )
@@ -0,0 +1,57 @@
+from fastapi import Request
+
+from core.model import UserItemMeta
+from core.repo import UserRepository
+
+
+class UserLoader:
+    """
+    Request-scoped batch loader for user profiles.
+
+    Ids requested while building a response are collected and fetched with a
+    single UserRepository.getUsers call; profiles are cached for the request.
+    """
+
+    def __init__(self, userRepo: UserRepository):
+        self._userRepo = userRepo
+        self._cache: dict[str, UserItemMeta] = dict()
+        self._pending: set[str] = set()
+
+    @classmethod
+    def fromRequest(cls, request: Request, userRepo: UserRepository) -> "UserLoader":
+        """
+        Get the loader of a request, creating it on first use
+        """
+        loader = getattr(request.state, "userLoader", None)
+        if loader is None:
+            loader = cls(userRepo)
+            request.state.userLoader = loader
+        return loader
+
+    def request(self, userIds: list[str]):
+        """
+        Queue user ids to be fetched by the next dispatch
+        """
+        self._pending.update(
+            userId for userId in userIds if userId not in self._cache)
+
+    def dispatch(self):
+        """
+        Fetch every queued user id in one query
+        """
+        if not self._pending:
+            return
+        userIds, self._pending = self._pending, set()
+        for userId in userIds:
+            self._cache[userId] = None
+        for user in self._userRepo.getUsers(list(userIds)):
+            self._cache[user.id] = UserItemMeta(
+                id=user.id, username=user.username, thumbnailId=user.thumbnailId)
+
+    def loadMany(self, userIds: list[str]) -> list[UserItemMeta]:
+        """
+        Get user profiles in the given order, skipping users that do not exist
+        """
+        self.request(userIds)
+        self.dispatch()
+        return [self._cache[userId] for userId in userIds if self._cache.get(userId)]
@@ -0,0 +1,127 @@
+import heapq
+import logging
+import threading
+import time
+from typing import Callable
+
+from core.repo import ChallengeRepository
+
+logger = logging.getLogger(__name__)
+
+
+class ChallengeDeadlineScheduler:
+    """
+    Finishes challenges exactly at their dateEndAt.
+
+    Upcoming deadlines are kept in a min-heap and a background thread sleeps
+    until the earliest one. Rescheduled or cancelled challenges leave stale heap
+    entries that are skipped when they reach the top.
+    """
+
+    def __init__(self, challengeRepo: ChallengeRepository):
+        self._challengeRepo = challengeRepo
+        self._heap: list[tuple[int, str]] = []
+        self._deadlines: dict[str, int] = dict()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread = None
+        self._running = False
+        self._listeners: list[Callable[[str], None]] = []
+
+    def addListener(self, listener: Callable[[str], None]):
+        """
+        Register a function called with the challenge id after a challenge is finished
+        """
+        self._listeners.append(listener)
+
+    def schedule(self, challengeId: str, deadline: int):
+        """
+        Schedule or reschedule the deadline of a challenge
+
+        Args:
+            challengeId (str): Challenge id
+            deadline (int): Unix timestamp in seconds
+        """
+        if deadline is None:
+            return
+        with self._cond:
+            if self._deadlines.get(challengeId) == deadline:
+                return
+            self._deadlines[challengeId] = deadline
+            heapq.heappush(self._heap, (deadline, challengeId))
+            if self._heap[0] == (deadline, challengeId):
+                self._cond.notify()
+
+    def cancel(self, challengeId: str):
+        with self._cond:
+            self._deadlines.pop(challengeId, None)
+
+    def reload(self):
+        """
+        Rebuild the heap from the deadlines stored in the repository
+        """
+        deadlines = dict(self._challengeRepo.getChallengeDeadlines())
+        with self._cond:
+            self._deadlines = deadlines
+            self._heap = [(deadline, challengeId)
+                          for challengeId, deadline in deadlines.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    def start(self):
+        self.reload()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="challenge-deadline", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _nextDue(self) -> str:
+        """
+        Wait until the earliest deadline passes and pop it
+
+        Returns:
+            str: Challenge id, or None when stopped
+        """
+        with self._cond:
+            while self._running:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, challengeId = self._heap[0]
+                if self._deadlines.get(challengeId) != deadline:
+                    heapq.heappop(self._heap)
+                    continue
+
+                delay = deadline - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+                del self._deadlines[challengeId]
+                return challengeId
+        return None
+
+    def _run(self):
+        while True:
+            challengeId = self._nextDue()
+            if challengeId is None:
+                return
+
+            try:
+                if not self._challengeRepo.finishChallenge(challengeId, int(time.time())):
+                    # Already finished elsewhere or deadline moved
+                    continue
+                logger.info("Challenge %s finished", challengeId)
+                for listener in self._listeners:
+                    listener(challengeId)
+            except Exception:
+                logger.exception("Failed to finish challenge %s", challengeId)
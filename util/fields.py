@@ -0,0 +1,62 @@
+from functools import lru_cache
+
+from fastapi import HTTPException
+from pydantic import BaseModel, create_model
+
+PARTIAL_MODEL_CACHE_SIZE = 256
+
+
+def parseFields(model: type[BaseModel], fields: str) -> frozenset[str]:
+    """
+    Parse a comma separated fields query parameter
+
+    Args:
+        model (type[BaseModel]): Model the fields belong to
+        fields (str): Comma separated field names, e.g. "id,name,state"
+
+    Raises:
+        HTTPException(status_code=400): If a field does not exist in the model
+
+    Returns:
+        frozenset[str]: Requested field names including id, None if no fields are given
+    """
+    if not fields:
+        return None
+
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - model.model_fields.keys()
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    if "id" in model.model_fields:
+        names.add("id")
+    return frozenset(names)
+
+
+def projection(fields: frozenset[str]) -> dict:
+    """
+    Build a MongoDB projection for the given fields
+    """
+    if fields is None:
+        return None
+    return {name: 1 for name in fields} | {"_id": 0}
+
+
+# Field sets are chosen by clients, so only the most used models are kept
+@lru_cache(maxsize=PARTIAL_MODEL_CACHE_SIZE)
+def partialModel(model: type[BaseModel], fields: frozenset[str]) -> type[BaseModel]:
+    """
+    Build a model with only the given fields of another model
+
+    Field types, defaults and config are kept; recently used field sets are cached.
+
+    Args:
+        model (type[BaseModel]): Full model
+        fields (frozenset[str]): Field names to keep
+
+    Returns:
+        type[BaseModel]: Trimmed model
+    """
+    definitions = {name: (info.annotation, info)
+                   for name, info in model.model_fields.items() if name in fields}
+    return create_model(f"{model.__name__}Partial", __config__=model.model_config, **definitions)
@@ -0,0 +1,201 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
+import time
+from typing import Callable
+
+from fastapi import HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from core.model import IdempotencyRecord
+from core.repo import IdempotencyRepository
+
+
+class IdempotencyGuard:
+    """
+    Replays the stored response of requests retried with the same Idempotency-Key.
+
+    Keys are scoped by user, method and path. The first request reserves its
+    key and stores its response; retries get that response without running
+    the handler again. Duplicates arriving while the first is in flight wait
+    for it: in the same worker through a shared future, in other workers by
+    polling the store. Server errors and version conflicts release the key so
+    the client can retry. A key reused with a different query or body is
+    rejected with 422.
+
+    Reservations last pendingTtl seconds and are extended while the handler
+    runs, so a slow handler is never run twice.
+    """
+
+    HEADER = "Idempotency-Key"
+    REPLAY_HEADER = "Idempotent-Replayed"
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, idempotencyRepo: IdempotencyRepository, ttl: int = 60 * 60 * 24,
+                 pendingTtl: int = 30, waitTimeout: float = 10):
+        self._idempotencyRepo = idempotencyRepo
+        self._ttl = ttl
+        self._pendingTtl = pendingTtl
+        self._waitTimeout = waitTimeout
+        self._inflight: dict[str, tuple[asyncio.Future, str]] = dict()
+
+        self._executed = 0
+        self._replayed = 0
+        self._coalesced = 0
+        self._conflicts = 0
+        self._mismatches = 0
+
+    def wrap(self, endpoint: Callable) -> Callable:
+        """
+        Wrap a route endpoint taking a request argument. The signature is kept for FastAPI.
+
+        Args:
+            endpoint (Callable): Sync or async endpoint
+
+        Returns:
+            Callable: Async endpoint honouring the Idempotency-Key header
+        """
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            request: Request = kwargs.get("request")
+            key = request.headers.get(self.HEADER) if request is not None else None
+            auth = request.state.auth if key else None
+            if not auth or not auth.get("sub"):
+                return await self._call(endpoint, args, kwargs)
+
+            scopedKey = f"{auth['sub']}:{request.method}:{request.url.path}:{key}"
+            fingerprint = hashlib.sha256(
+                request.url.query.encode() + b"\n" + await request.body()).hexdigest()
+            inflight = self._inflight.get(scopedKey)
+            if inflight is not None:
+                self._checkFingerprint(inflight[1], fingerprint)
+                self._coalesced += 1
+                return self._replay(await asyncio.shield(inflight[0]))
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[scopedKey] = (future, fingerprint)
+            try:
+                record, result = await self._execute(scopedKey, fingerprint, endpoint, args, kwargs)
+                future.set_result(record)
+            except BaseException as e:
+                future.set_exception(e)
+                # Mark the exception as retrieved when no duplicate is waiting
+                future.exception()
+                raise
+            finally:
+                del self._inflight[scopedKey]
+            return result
+
+        return wrapper
+
+    async def _call(self, endpoint: Callable, args: tuple, kwargs: dict):
+        if inspect.iscoroutinefunction(endpoint):
+            return await endpoint(*args, **kwargs)
+        return await run_in_threadpool(endpoint, *args, **kwargs)
+
+    def _checkFingerprint(self, stored: str, fingerprint: str):
+        if stored and stored != fingerprint:
+            self._mismatches += 1
+            raise HTTPException(
+                status_code=422, detail="Idempotency-Key was already used for a different request")
+
+    async def _execute(self, scopedKey: str, fingerprint: str, endpoint: Callable, args: tuple, kwargs: dict):
+        """
+        Run the endpoint once per key
+
+        Returns:
+            tuple[IdempotencyRecord, object]: Stored record and the response to return
+        """
+        record = await asyncio.to_thread(
+            self._idempotencyRepo.reserveKey, scopedKey, fingerprint, self._pendingTtl)
+        if record is not None:
+            self._checkFingerprint(record.fingerprint, fingerprint)
+            if not record.done:
+                record = await self._waitDone(scopedKey)
+            self._replayed += 1
+            return record, self._replay(record)
+
+        self._executed += 1
+        heartbeat = asyncio.create_task(self._extend(scopedKey))
+        try:
+            result = await self._call(endpoint, args, kwargs)
+        except HTTPException as e:
+            # Conflicts are transient too, a retry must run again instead of replaying them
+            if e.status_code >= 500 or e.status_code == 409:
+                await asyncio.to_thread(self._idempotencyRepo.releaseKey, scopedKey)
+                raise
+            await self._complete(scopedKey, e.status_code, e.detail)
+            raise
+        except BaseException:
+            await asyncio.to_thread(self._idempotencyRepo.releaseKey, scopedKey)
+            raise
+        finally:
+            heartbeat.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await heartbeat
+
+        record = await self._complete(scopedKey, 200, result)
+        return record, result
+
+    async def _extend(self, scopedKey: str):
+        """
+        Extend the reservation of a running request until cancelled
+        """
+        while True:
+            await asyncio.sleep(self._pendingTtl / 3)
+            await asyncio.to_thread(self._idempotencyRepo.extendKey, scopedKey, self._pendingTtl)
+
+    async def _complete(self, scopedKey: str, statusCode: int, content) -> IdempotencyRecord:
+        body = json.dumps(jsonable_encoder(content))
+        await asyncio.to_thread(self._idempotencyRepo.completeKey,
+                                scopedKey, statusCode, body, self._ttl)
+        return IdempotencyRecord(key=scopedKey, done=True, statusCode=statusCode, body=body)
+
+    async def _waitDone(self, scopedKey: str) -> IdempotencyRecord:
+        """
+        Wait for a request with the same key running in another worker
+        """
+        deadline = time.monotonic() + self._waitTimeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            record = await asyncio.to_thread(self._idempotencyRepo.getKey, scopedKey)
+            if record is None:
+                # Released after a failure; let the client retry
+                break
+            if record.done:
+                return record
+
+        self._conflicts += 1
+        raise HTTPException(
+            status_code=409, detail="A request with this Idempotency-Key is in progress")
+
+    def _replay(self, record: IdempotencyRecord):
+        content = json.loads(record.body)
+        if record.statusCode >= 400:
+            raise HTTPException(status_code=record.statusCode, detail=content)
+        return JSONResponse(content=content, status_code=record.statusCode,
+                            headers={self.REPLAY_HEADER: "true"})
+
+    def metrics(self) -> dict:
+        return dict(
+            inflight=len(self._inflight),
+            executed=self._executed,
+            replayed=self._replayed,
+            coalesced=self._coalesced,
+            conflicts=self._conflicts,
+            mismatches=self._mismatches,
+        )
+
+
+def idempotent(guard: IdempotencyGuard, endpoint: Callable) -> Callable:
+    """
+    Wrap an endpoint with guard if one is configured
+    """
+    if guard is None:
+        return endpoint
+    return guard.wrap(endpoint)
@@ -0,0 +1,93 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable
+
+from core.repo import LeaseRepository
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderJobRunner:
+    """
+    Runs scheduler jobs in only one process per job.
+
+    Each job is guarded by a lease. The process holding it runs the job and
+    keeps the lease alive with heartbeat(); other processes skip the run. If
+    the leader dies its lease expires after ttl seconds and the next process
+    to run the job takes over.
+    """
+
+    def __init__(self, leaseRepo: LeaseRepository, ttl: int = 60):
+        self._leaseRepo = leaseRepo
+        self._ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._held: set[str] = set()
+        self._lock = threading.Lock()
+        self._metrics: dict[str, dict] = dict()
+
+    def wrap(self, jobName: str, func: Callable[[], object]) -> Callable[[], None]:
+        """
+        Wrap a job function so it only runs while this process holds its lease
+
+        Args:
+            jobName (str): Unique job name, used as the lease name
+            func (Callable[[], object]): Job function
+
+        Returns:
+            Callable[[], None]: Function to register with the scheduler
+        """
+        metrics = self._metrics.setdefault(jobName, dict(
+            runs=0, skips=0, failures=0, lastRun=None, lastDuration=None, isLeader=False))
+
+        def run():
+            isLeader = self._leaseRepo.acquireLease(jobName, self.owner, self._ttl)
+            with self._lock:
+                if isLeader:
+                    self._held.add(jobName)
+                else:
+                    self._held.discard(jobName)
+            metrics["isLeader"] = isLeader
+            if not isLeader:
+                metrics["skips"] += 1
+                return
+
+            start = time.monotonic()
+            try:
+                func()
+            except Exception:
+                metrics["failures"] += 1
+                logger.exception("Job %s failed", jobName)
+            finally:
+                metrics["runs"] += 1
+                metrics["lastRun"] = time.time()
+                metrics["lastDuration"] = time.monotonic() - start
+
+        return run
+
+    def heartbeat(self):
+        """
+        Renew every lease held by this process. Schedule well within ttl.
+        """
+        with self._lock:
+            held = list(self._held)
+        for jobName in held:
+            if not self._leaseRepo.acquireLease(jobName, self.owner, self._ttl):
+                logger.warning("Lost leadership of job %s", jobName)
+                with self._lock:
+                    self._held.discard(jobName)
+                self._metrics[jobName]["isLeader"] = False
+
+    def releaseAll(self):
+        with self._lock:
+            held = list(self._held)
+            self._held.clear()
+        for jobName in held:
+            self._leaseRepo.releaseLease(jobName, self.owner)
+            self._metrics[jobName]["isLeader"] = False
+
+    def metrics(self) -> dict:
+        return dict(owner=self.owner, jobs={name: dict(metrics) for name, metrics in self._metrics.items()})
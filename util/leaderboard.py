@@ -0,0 +1,94 @@
+import bisect
+import threading
+
+from core.model import LeaderboardEntry, UserItem
+
+
+class Leaderboard:
+    """
+    In-memory top-K of users by point, updated incrementally on writes.
+
+    Entries are kept sorted by (-point, id), so ties are ranked by user id.
+    When a member drops to the bottom or is removed, a user outside the board
+    may belong in it; the board is then marked stale and reloaded by its owner.
+    """
+
+    def __init__(self, size: int = 100):
+        self._size = size
+        self._keys: list[tuple[int, str]] = []
+        self._entries: dict[str, LeaderboardEntry] = dict()
+        self._lock = threading.Lock()
+        self._stale = True
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def stale(self) -> bool:
+        return self._stale
+
+    def load(self, users: list[UserItem]):
+        """
+        Replace the board with the top users, ordered by point descending
+        """
+        with self._lock:
+            users = users[:self._size]
+            self._entries = {user.id: self._meta(user) for user in users}
+            self._keys = sorted((-user.point, user.id) for user in users)
+            self._stale = False
+
+    def update(self, user: UserItem):
+        """
+        Apply the new point of a user
+        """
+        with self._lock:
+            old = self._entries.pop(user.id, None)
+            if old is not None:
+                self._keys.remove((-old.point, old.id))
+
+            key = (-user.point, user.id)
+            full = len(self._keys) + (old is not None) >= self._size
+            if full and self._keys and key > self._keys[-1]:
+                if old is not None:
+                    # Dropped to the bottom; a user outside the board may rank higher
+                    self._stale = True
+                return
+
+            bisect.insort(self._keys, key)
+            self._entries[user.id] = self._meta(user)
+            if len(self._keys) > self._size:
+                _, evicted = self._keys.pop()
+                del self._entries[evicted]
+
+    def remove(self, userId: str):
+        with self._lock:
+            old = self._entries.pop(userId, None)
+            if old is not None:
+                self._keys.remove((-old.point, old.id))
+                self._stale = True
+
+    def top(self, limit: int) -> list[LeaderboardEntry]:
+        with self._lock:
+            return [self._entry(rank, self._entries[userId])
+                    for rank, (_, userId) in enumerate(self._keys[:limit], start=1)]
+
+    def rank(self, userId: str) -> LeaderboardEntry:
+        """
+        Get the entry of a user on the board, None if the user is not on it
+        """
+        with self._lock:
+            user = self._entries.get(userId)
+            if user is None:
+                return None
+            return self._entry(bisect.bisect_left(self._keys, (-user.point, user.id)) + 1, user)
+
+    @staticmethod
+    def _meta(user: UserItem) -> LeaderboardEntry:
+        # Keep only what the board shows, not the whole user document
+        return LeaderboardEntry(rank=0, id=user.id, username=user.username,
+                                thumbnailId=user.thumbnailId, point=user.point)
+
+    @staticmethod
+    def _entry(rank: int, entry: LeaderboardEntry) -> LeaderboardEntry:
+        return entry.model_copy(update={"rank": rank})
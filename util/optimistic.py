@@ -0,0 +1,81 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, TypeVar
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+D = TypeVar("D")
+T = TypeVar("T")
+
+
+class VersionConflictError(HTTPException):
+    """
+    Raised by a repository when a document changed since it was read
+    """
+
+    def __init__(self, detail: str = "Modified concurrently, please retry"):
+        super().__init__(status_code=409, detail=detail)
+
+
+class OptimisticRetry:
+    """
+    Re-runs read-modify-write operations that lost a version race.
+
+    Each retry reloads the document, so the change is applied to the latest
+    version instead of overwriting a concurrent write. After the last attempt
+    the conflict is raised to the client as 409.
+    """
+
+    def __init__(self, attempts: int = 3, backoff: float = 0.02):
+        self._attempts = attempts
+        self._backoff = backoff
+        self._lock = threading.Lock()
+        self._conflicts: dict[str, int] = dict()
+        self._exhausted: dict[str, int] = dict()
+
+    def run(self, name: str, load: Callable[[], D], modify: Callable[[D], T],
+            current: D = None, attempts: int = None) -> T:
+        """
+        Apply a change to a document, reloading it and trying again on version conflicts
+
+        Args:
+            name (str): Name of the operation in the metrics
+            load (Callable[[], D]): Reads the latest version of the document
+            modify (Callable[[D], T]): Applies the change to the document and writes it
+            current (D): Document already read by the caller, used for the first attempt
+            attempts (int): Overrides the number of attempts, 1 only counts the conflict
+
+        Raises:
+            VersionConflictError: If every attempt conflicted
+
+        Returns:
+            T: Result of modify
+        """
+        attempts = attempts or self._attempts
+        for attempt in range(1, attempts + 1):
+            if current is None:
+                current = load()
+            try:
+                return modify(current)
+            except VersionConflictError:
+                self._count(self._conflicts, name)
+                if attempt == attempts:
+                    self._count(self._exhausted, name)
+                    if attempts > 1:
+                        logger.warning("Gave up %s after %d conflicts", name, attempt)
+                    raise
+            current = None
+            # Jitter so the losers of a race do not collide again
+            time.sleep(random.uniform(0, self._backoff * attempt))
+
+    def _count(self, counter: dict[str, int], name: str):
+        with self._lock:
+            counter[name] = counter.get(name, 0) + 1
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict(conflicts=dict(self._conflicts), exhausted=dict(self._exhausted))
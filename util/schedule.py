@@ -1,8 +1,11 @@
-from datetime import datetime
+import logging
+import time
 
-from core.model import ItemState
-from core.repo import ChallengeRepository
+from core.repo import ChallengeRepository, CouponRepository
 from util.adVerifier import AdVerifier
+from util.settlement import ChallengeSettlement
+
+logger = logging.getLogger(__name__)
 
 
 def check_ad_log(adVerifier: AdVerifier):
@@ -11,12 +14,17 @@ def check_ad_log(adVerifier: AdVerifier):
     return
 
 
-def check_challenge_expiry(challengeRepository: ChallengeRepository):
-    challenges = challengeRepository.getAllChallenges()
-    for challenge in challenges:
-        if int(float(challenge.dateEnd)) < datetime.now().timestamp():
-            challenge_detail = challengeRepository.getChallenge(challenge.id)
-            challenge_detail.state = ItemState.FINISHED
-            challengeRepository.updateChallenge(challenge_detail)
+def check_challenge_expiry(challengeRepository: ChallengeRepository, settlement: ChallengeSettlement) -> int:
+    expired = challengeRepository.expireChallenges(int(time.time()))
+    settled = settlement.settlePending()
+    logger.info("Finished %d expired challenges, settled %d", expired, settled)
 
-    return
+    return expired
+
+
+def check_coupon_expiry(couponRepository: CouponRepository) -> int:
+    expired = couponRepository.expireCoupons(int(time.time()))
+    if expired:
+        logger.info("Expired %d coupons", expired)
+
+    return expired
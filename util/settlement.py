@@ -0,0 +1,90 @@
+import logging
+import math
+
+from core.model import ItemState
+from core.repo import ChallengeRepository, UserRepository
+
+logger = logging.getLogger(__name__)
+
+
+class ChallengeSettlement:
+    """
+    Pays out the rewards of finished challenges in one pass per challenge,
+    using the record counters maintained on the challenge.
+
+    Every participant gets the base reward plus a share of the additional reward
+    proportional to their records. Payouts are applied with one bulk write that
+    skips users already paid, so settling a challenge twice is harmless.
+    """
+
+    # Participation fee (500) + 100
+    REWARD_BASE_POINT = 600
+    REWARD_ADDITIONAL_POINT = 2000
+
+    def __init__(self, userRepo: UserRepository, challengeRepo: ChallengeRepository):
+        self._userRepo = userRepo
+        self._challengeRepo = challengeRepo
+
+    @classmethod
+    def computePayouts(cls, participantIds: list[str], recordCounts: dict[str, int]) -> dict[str, int]:
+        """
+        Compute the reward of every participant
+
+        Args:
+            participantIds (list[str]): Ids of the participants
+            recordCounts (dict[str, int]): Number of records by user id
+
+        Returns:
+            dict[str, int]: Reward points by user id
+        """
+        totalRecords = sum(recordCounts.values())
+        payouts = dict()
+        for userId in participantIds:
+            payout = cls.REWARD_BASE_POINT
+            if totalRecords:
+                payout += math.floor(cls.REWARD_ADDITIONAL_POINT *
+                                     (recordCounts.get(userId, 0) / totalRecords))
+            payouts[userId] = payout
+        return payouts
+
+    def settleChallenge(self, challengeId: str) -> dict[str, int]:
+        """
+        Settle a finished challenge
+
+        Args:
+            challengeId (str): Challenge id
+
+        Returns:
+            dict[str, int]: Reward points by user id, None if the challenge is not finished
+        """
+        challenge = self._challengeRepo.getChallenge(challengeId)
+        if challenge is None or challenge.state != ItemState.FINISHED:
+            return None
+        if challenge.settled:
+            return dict()
+
+        payouts = self.computePayouts(
+            self._challengeRepo.getParticipantIds(challengeId),
+            self._challengeRepo.countRecordsByUser(challengeId))
+        paid = self._userRepo.addSettlementPoints(challengeId, payouts)
+        self._challengeRepo.markChallengeSettled(challengeId)
+        logger.info("Settled challenge %s: %d of %d participants paid",
+                    challengeId, paid, len(payouts))
+
+        return payouts
+
+    def settlePending(self) -> int:
+        """
+        Settle every finished challenge that has not been settled yet
+
+        Returns:
+            int: Number of settled challenges
+        """
+        settled = 0
+        for challengeId in self._challengeRepo.getUnsettledChallenges():
+            try:
+                if self.settleChallenge(challengeId) is not None:
+                    settled += 1
+            except Exception:
+                logger.exception("Failed to settle challenge %s", challengeId)
+        return settled
@@ -0,0 +1,210 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, TypeVar
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+
+T = TypeVar("T")
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "finishedAt")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Exception = None
+        self.finishedAt: float = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls into one.
+
+    The first caller of a key runs the call; callers arriving while it runs
+    wait for it and share its result or error. Results are also shared for a
+    short window after the call finishes, so a burst of requests arriving
+    just too late still shares one call. Nothing is kept beyond the window.
+
+    A shared result may be up to one call plus the window old. Writers call
+    forget so callers after a write never join a call started before it.
+
+    do blocks waiting threads and suits repository callers already running in
+    a thread. doAsync waits on the event loop, so a burst of requests never
+    holds more than one threadpool thread per key.
+    """
+
+    def __init__(self, window: float = 0.0005):
+        self._window = window
+        self._inflight: dict[Hashable, _Call] = dict()
+        # Calls started by doAsync, awaited on the event loop
+        self._tasks: dict[Hashable, asyncio.Future] = dict()
+        # Finished calls still inside the window, oldest first
+        self._finished: OrderedDict[Hashable, _Call] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._executed = 0
+        self._coalesced = 0
+        self._windowHits = 0
+
+    def do(self, key: tuple, func: Callable[[], T], copy: Callable[[T], T] = None) -> T:
+        """
+        Run func once for concurrent callers of the same key
+
+        Args:
+            key (tuple): Identifies the call, starting with the namespace forget matches on
+            func (Callable[[], T]): The call to run
+            copy (Callable[[T], T]): Gives every sharing caller its own copy of a mutable result
+
+        Returns:
+            T: Result of func
+        """
+        with self._lock:
+            self._removeExpired(time.monotonic())
+            call = self._inflight.get(key)
+            if call is not None:
+                self._coalesced += 1
+            else:
+                call = self._finished.get(key)
+                if call is not None:
+                    self._windowHits += 1
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._inflight[key] = call
+                self._executed += 1
+
+        if leader:
+            try:
+                result = func()
+                call.result = copy(result) if copy is not None else result
+                return result
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                self._finish(key, call)
+
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return copy(call.result) if copy is not None else call.result
+
+    async def doAsync(self, key: tuple, func: Callable[[], T]) -> T:
+        """
+        Run the blocking func once in the threadpool for concurrent callers of the same key
+
+        Waiters do not hold a thread. The call keeps running if the caller that
+        started it is cancelled, so the others still get its result.
+
+        Args:
+            key (tuple): Identifies the call, starting with the namespace forget matches on
+            func (Callable[[], T]): The call to run, its result is shared as is and must not be modified
+
+        Returns:
+            T: Result of func
+        """
+        with self._lock:
+            self._removeExpired(time.monotonic())
+            task = self._tasks.get(key)
+            if task is not None:
+                self._coalesced += 1
+            else:
+                call = self._finished.get(key)
+                if call is not None:
+                    self._windowHits += 1
+                    return call.result
+                task = asyncio.ensure_future(run_in_threadpool(func))
+                task.add_done_callback(functools.partial(self._finishTask, key))
+                self._tasks[key] = task
+                self._executed += 1
+
+        return await asyncio.shield(task)
+
+    def _finishTask(self, key: tuple, task: asyncio.Future):
+        # Retrieve the error even if every caller was cancelled
+        error = task.exception() if not task.cancelled() else asyncio.CancelledError()
+        with self._lock:
+            # A forgotten call is no longer shared
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+                if error is None and self._window > 0:
+                    call = _Call()
+                    call.result = task.result()
+                    call.finishedAt = time.monotonic()
+                    call.done.set()
+                    self._finished[key] = call
+                    self._finished.move_to_end(key)
+
+    def _finish(self, key: tuple, call: _Call):
+        with self._lock:
+            call.finishedAt = time.monotonic()
+            # A forgotten call is no longer shared
+            if self._inflight.get(key) is call:
+                del self._inflight[key]
+                if call.error is None and self._window > 0:
+                    self._finished[key] = call
+                    self._finished.move_to_end(key)
+        call.done.set()
+
+    def _removeExpired(self, now: float):
+        while self._finished:
+            key, call = next(iter(self._finished.items()))
+            if now - call.finishedAt <= self._window:
+                return
+            del self._finished[key]
+
+    def forget(self, *prefix):
+        """
+        Stop sharing the calls whose key starts with prefix, e.g. after a write
+        """
+        size = len(prefix)
+        with self._lock:
+            for calls in (self._inflight, self._tasks, self._finished):
+                for key in [key for key in calls if key[:size] == prefix]:
+                    del calls[key]
+
+    def metrics(self) -> dict:
+        with self._lock:
+            inflight = len(self._inflight) + len(self._tasks)
+        return dict(
+            inflight=inflight,
+            executed=self._executed,
+            coalesced=self._coalesced,
+            windowHits=self._windowHits,
+        )
+
+
+def coalesced(singleFlight: SingleFlight, endpoint: Callable, key: Callable[..., tuple]) -> Callable:
+    """
+    Share one serialized JSON response between concurrent identical requests of a sync endpoint
+
+    The sync endpoint runs in the threadpool once per key; waiting requests stay
+    on the event loop instead of each blocking a threadpool thread.
+
+    Args:
+        singleFlight (SingleFlight): Coalescing layer, the endpoint is returned unchanged if None
+        endpoint (Callable): Sync route endpoint whose response does not depend on the caller
+        key (Callable[..., tuple]): Builds the key from the endpoint arguments
+
+    Returns:
+        Callable: Async endpoint returning the shared response body
+    """
+    if singleFlight is None:
+        return endpoint
+
+    def render(*args, **kwargs) -> bytes:
+        result = endpoint(*args, **kwargs)
+        return JSONResponse(content=jsonable_encoder(result)).body
+
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        body = await singleFlight.doAsync(key(**kwargs), lambda: render(*args, **kwargs))
+        return Response(content=body, media_type="application/json")
+
+    return wrapper
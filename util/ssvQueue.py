@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+
+from core.repo import UserRepository
+from util.adVerifier import AdVerifier
+
+logger = logging.getLogger(__name__)
+
+
+class SSVQueue:
+    """
+    Bounded in-process queue for AdMob SSV callbacks.
+
+    Callbacks are checked cheaply and acknowledged on enqueue; worker tasks
+    verify signatures, look up users and store ad logs in batches.
+    """
+
+    REQUIRED_PARAMS = ("key_id", "signature", "user_id",
+                       "reward_amount", "timestamp")
+
+    def __init__(self, userRepo: UserRepository, adVerifier: AdVerifier,
+                 maxsize: int = 10000, workers: int = 4, batchSize: int = 32):
+        self._userRepo = userRepo
+        self._adVerifier = adVerifier
+        self._maxsize = maxsize
+        self._workers = workers
+        self._batchSize = batchSize
+        self._queue: asyncio.Queue = None
+        self._tasks: list[asyncio.Task] = []
+
+        self._enqueued = 0
+        self._dropped = 0
+        self._processed = 0
+        self._rejected = 0
+        self._unknownUser = 0
+        self._lastLag = 0.0
+        self._maxLag = 0.0
+
+    @classmethod
+    def validate(cls, queryParams: dict) -> bool:
+        """
+        Cheap checks done before acknowledging a callback
+        """
+        if any(not queryParams.get(param) for param in cls.REQUIRED_PARAMS):
+            return False
+        return queryParams["reward_amount"].isdigit() and queryParams["timestamp"].isdigit()
+
+    def enqueue(self, queryParams: dict) -> bool:
+        """
+        Enqueue a callback for verification
+
+        Args:
+            queryParams (dict): Query parameters of the SSV callback
+
+        Returns:
+            bool: True if enqueued, False if the queue is full or not started
+        """
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait((time.monotonic(), queryParams))
+        except asyncio.QueueFull:
+            self._dropped += 1
+            return False
+        self._enqueued += 1
+        return True
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._tasks = [asyncio.create_task(self._worker())
+                       for _ in range(self._workers)]
+
+    async def stop(self, timeout: float = 5):
+        """
+        Drain the queue for up to timeout seconds, then stop the workers
+        """
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %d unverified SSV callbacks on shutdown",
+                           self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self._batchSize and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._processBatch(batch)
+            except Exception:
+                logger.exception("Failed to process SSV batch")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _processBatch(self, batch: list):
+        now = time.monotonic()
+        for enqueuedAt, _ in batch:
+            self._lastLag = now - enqueuedAt
+            self._maxLag = max(self._maxLag, self._lastLag)
+
+        verified = await asyncio.gather(*(self._adVerifier.verify_admob_ssv_async(
+            self._adVerifier.build_ssv_message(queryParams),
+            queryParams["key_id"], queryParams["signature"]) for _, queryParams in batch))
+
+        userIds = {queryParams["user_id"]
+                   for (_, queryParams), isValid in zip(batch, verified) if isValid}
+        knownUsers = set()
+        if userIds:
+            users = await asyncio.to_thread(self._userRepo.getUsers, list(userIds))
+            knownUsers = {user.id for user in users}
+
+        for (_, queryParams), isValid in zip(batch, verified):
+            self._processed += 1
+            if not isValid:
+                self._rejected += 1
+                continue
+
+            userId = queryParams["user_id"]
+            if userId not in knownUsers:
+                self._unknownUser += 1
+                continue
+
+            await self._adVerifier.add_log(dict(
+                user_id=userId,
+                reward_amount=queryParams["reward_amount"],
+                timestamp=queryParams["timestamp"],
+            ))
+
+    def metrics(self) -> dict:
+        return dict(
+            depth=self._queue.qsize() if self._queue is not None else 0,
+            maxsize=self._maxsize,
+            enqueued=self._enqueued,
+            dropped=self._dropped,
+            processed=self._processed,
+            rejected=self._rejected,
+            unknownUser=self._unknownUser,
+            lastLagSeconds=self._lastLag,
+            maxLagSeconds=self._maxLag,
+        )